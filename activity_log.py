@@ -0,0 +1,247 @@
+"""
+Buffered writer for the JSON activity logs under logs/.
+
+log_activity() only serializes the entry and appends it to an in-memory
+buffer, which is safe to do while holding session_lock. A writer thread
+drains the buffer once ACTIVITY_LOG_FLUSH_BYTES are waiting or every
+ACTIVITY_LOG_FLUSH_INTERVAL seconds, writing each log's lines with one call
+to a file it keeps open. A log reaching ACTIVITY_LOG_MAX_BYTES is rotated to
+<type>.log.1.gz, keeping ACTIVITY_LOG_BACKUPS compressed files, and is
+compressed in blocks that yield to other threads in between.
+
+Every worker process appends to the same logs, so each log has a lock file:
+writers hold a shared flock while appending and the rotating process an
+exclusive one. A writer checks before appending that its open file is still
+the log on disk, and reopens it after another process rotated it. Locks are
+never waited for, which would stall the event loop: lines that find the log
+being rotated stay buffered for the next flush.
+
+When the disk cannot keep up and ACTIVITY_LOG_QUEUE_SIZE entries are
+waiting, new entries are dropped and counted rather than blocking the
+request that logs them. Anything still buffered is written at exit.
+"""
+
+import os
+import json
+import time
+import zlib
+import fcntl
+import threading
+from collections import deque
+from datetime import datetime
+
+ACTIVITY_LOG_DIR = 'logs'
+ACTIVITY_LOG_QUEUE_SIZE = int(os.environ.get('ACTIVITY_LOG_QUEUE_SIZE', 10000))  # Entries buffered before dropping
+ACTIVITY_LOG_FLUSH_BYTES = int(os.environ.get('ACTIVITY_LOG_FLUSH_BYTES', 64 * 1024))
+ACTIVITY_LOG_FLUSH_INTERVAL = float(os.environ.get('ACTIVITY_LOG_FLUSH_INTERVAL', 1.0))  # Seconds
+ACTIVITY_LOG_MAX_BYTES = int(os.environ.get('ACTIVITY_LOG_MAX_BYTES', 10 * 1024 * 1024))  # 0 disables rotation
+ACTIVITY_LOG_BACKUPS = int(os.environ.get('ACTIVITY_LOG_BACKUPS', 5))
+ACTIVITY_LOG_COMPRESS_BLOCK = 256 * 1024
+
+# (log type, serialized line) waiting for the writer
+log_buffer = deque()
+log_buffer_lock = threading.Lock()
+log_ready = threading.Event()
+# Serializes the writer thread against the final flush at exit
+log_write_lock = threading.Lock()
+# Log type -> open file, and log type -> lock file descriptor, used only with log_write_lock held
+log_files = {}
+log_locks = {}
+activity_log_state = {
+    'started': False,
+    'pid': os.getpid(),
+    'buffered_bytes': 0,
+    'written': 0,
+    'dropped': 0,
+    'flushes': 0,
+    'rotations': 0,
+    'errors': 0
+}
+
+
+def log_activity(log_type, data):
+    """Queue an entry for logs/<log_type>.log without touching the disk"""
+    line = json.dumps({'timestamp': datetime.now().isoformat(), **data}) + '\n'
+    with log_buffer_lock:
+        if len(log_buffer) >= ACTIVITY_LOG_QUEUE_SIZE:
+            activity_log_state['dropped'] += 1
+            return
+        log_buffer.append((log_type, line))
+        activity_log_state['buffered_bytes'] += len(line)
+        flush_due = activity_log_state['buffered_bytes'] >= ACTIVITY_LOG_FLUSH_BYTES
+    if flush_due:
+        log_ready.set()
+
+
+def compress_file(source_path, destination_path):
+    """Gzip a rotated log block by block, yielding between blocks"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes a gzip header and trailer
+    temp_path = destination_path + '.tmp'
+    with open(source_path, 'rb') as source, open(temp_path, 'wb') as destination:
+        while True:
+            block = source.read(ACTIVITY_LOG_COMPRESS_BLOCK)
+            if not block:
+                break
+            destination.write(compressor.compress(block))
+            time.sleep(0)
+        destination.write(compressor.flush())
+    os.replace(temp_path, destination_path)
+    os.unlink(source_path)
+
+
+def rotate_log(log_type, log_file):
+    """Close a full log and shift it into the compressed backups - caller must hold log_write_lock"""
+    log_file.close()
+    del log_files[log_type]
+    log_path = os.path.join(ACTIVITY_LOG_DIR, f'{log_type}.log')
+    if ACTIVITY_LOG_BACKUPS <= 0:
+        os.unlink(log_path)
+        return
+    for index in range(ACTIVITY_LOG_BACKUPS - 1, 0, -1):
+        backup_path = f'{log_path}.{index}.gz'
+        if os.path.exists(backup_path):
+            os.replace(backup_path, f'{log_path}.{index + 1}.gz')
+    rotated_path = f'{log_path}.rotating'
+    os.replace(log_path, rotated_path)
+    compress_file(rotated_path, f'{log_path}.1.gz')
+    activity_log_state['rotations'] += 1
+
+
+def close_inherited_files():
+    """Drop files and locks opened before this worker was forked - flock cannot tell apart processes sharing them"""
+    if activity_log_state['pid'] == os.getpid():
+        return
+    for log_file in log_files.values():
+        log_file.close()
+    for fd in log_locks.values():
+        os.close(fd)
+    log_files.clear()
+    log_locks.clear()
+    activity_log_state['pid'] = os.getpid()
+
+
+def lock_log(log_type, operation, wait=False):
+    """flock a log's lock file. Returns False if another process holds it and wait is False."""
+    fd = log_locks.get(log_type)
+    if fd is None:
+        os.makedirs(ACTIVITY_LOG_DIR, exist_ok=True)
+        fd = log_locks[log_type] = os.open(os.path.join(ACTIVITY_LOG_DIR, f'{log_type}.log.lock'),
+                                           os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, operation if wait else operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def open_log(log_type):
+    """This process's file for a log, reopened if another process rotated the log away from it"""
+    log_path = os.path.join(ACTIVITY_LOG_DIR, f'{log_type}.log')
+    log_file = log_files.get(log_type)
+    if log_file is not None:
+        try:
+            current_inode = os.stat(log_path).st_ino
+        except FileNotFoundError:
+            current_inode = None
+        if current_inode != os.fstat(log_file.fileno()).st_ino:
+            log_file.close()
+            log_file = None
+    if log_file is None:
+        os.makedirs(ACTIVITY_LOG_DIR, exist_ok=True)
+        log_file = log_files[log_type] = open(log_path, 'a')
+    return log_file
+
+
+def write_log_lines(log_type, lines, wait=False):
+    """Append lines to one log, rotating it once full - caller must hold log_write_lock.
+
+    Returns False without writing if another process is rotating the log and wait is False.
+    """
+    close_inherited_files()
+    if not lock_log(log_type, fcntl.LOCK_SH, wait):
+        return False
+    try:
+        log_file = open_log(log_type)
+        log_file.write(''.join(lines))
+        log_file.flush()
+        if (ACTIVITY_LOG_MAX_BYTES and os.fstat(log_file.fileno()).st_size >= ACTIVITY_LOG_MAX_BYTES and
+                lock_log(log_type, fcntl.LOCK_EX)):
+            # Another process may have rotated the log before the exclusive lock was granted
+            log_file = open_log(log_type)
+            if os.fstat(log_file.fileno()).st_size >= ACTIVITY_LOG_MAX_BYTES:
+                rotate_log(log_type, log_file)
+    finally:
+        fcntl.flock(log_locks[log_type], fcntl.LOCK_UN)
+    return True
+
+
+def flush_activity_log(wait=False):
+    """Write out everything buffered, one write per log.
+
+    Lines for a log another process is rotating go back to the buffer, unless
+    wait is set - as it is at exit - to wait for the rotation instead.
+    """
+    with log_buffer_lock:
+        entries = list(log_buffer)
+        log_buffer.clear()
+        activity_log_state['buffered_bytes'] = 0
+    if not entries:
+        return
+
+    lines_by_type = {}
+    for log_type, line in entries:
+        lines_by_type.setdefault(log_type, []).append(line)
+    deferred = []
+    with log_write_lock:
+        for log_type, lines in lines_by_type.items():
+            try:
+                if not write_log_lines(log_type, lines, wait):
+                    deferred.extend((log_type, line) for line in lines)
+                    continue
+                activity_log_state['written'] += len(lines)
+            except Exception as e:
+                print(f"Activity log write error for {log_type}: {str(e)}")
+                activity_log_state['errors'] += 1
+                log_file = log_files.pop(log_type, None)
+                if log_file is not None:
+                    log_file.close()
+    if deferred:
+        with log_buffer_lock:
+            log_buffer.extendleft(reversed(deferred))
+            activity_log_state['buffered_bytes'] += sum(len(line) for _, line in deferred)
+    activity_log_state['flushes'] += 1
+
+
+def run_activity_log_writer():
+    """Writer thread main loop"""
+    while True:
+        log_ready.wait(ACTIVITY_LOG_FLUSH_INTERVAL)
+        log_ready.clear()
+        try:
+            flush_activity_log()
+        except Exception as e:
+            print(f"Activity log writer error: {str(e)}")
+
+
+def start_activity_log_writer():
+    """Start the writer thread once"""
+    with log_buffer_lock:
+        if activity_log_state['started']:
+            return
+        activity_log_state['started'] = True
+    threading.Thread(target=run_activity_log_writer, daemon=True).start()
+    print(f"Activity log writer started (flush every {ACTIVITY_LOG_FLUSH_INTERVAL}s or "
+          f"{ACTIVITY_LOG_FLUSH_BYTES} bytes)")
+
+
+def get_activity_log_stats():
+    """Writer backlog and counters for health reporting"""
+    return {
+        'queued': len(log_buffer),
+        'queuedBytes': activity_log_state['buffered_bytes'],
+        'written': activity_log_state['written'],
+        'dropped': activity_log_state['dropped'],
+        'flushes': activity_log_state['flushes'],
+        'rotations': activity_log_state['rotations'],
+        'errors': activity_log_state['errors']
+    }
@@ -0,0 +1,169 @@
+"""
+Streaming zip and tar.gz archives of directories.
+
+Archives are generated while they are sent: each file is read in blocks,
+compressed and yielded, so memory stays constant whatever the directory size
+and nothing is written to disk. The number of archives built at once is
+bounded by a semaphore, since each one keeps a worker busy compressing.
+"""
+
+import os
+import stat
+import time
+import zlib
+import tarfile
+import zipfile
+import threading
+
+ARCHIVE_MAX_CONCURRENT = int(os.environ.get('ARCHIVE_MAX_CONCURRENT', 2))
+ARCHIVE_BLOCK_SIZE = 256 * 1024
+ARCHIVE_FORMATS = {
+    'zip': ('application/zip', '.zip'),
+    'tar.gz': ('application/gzip', '.tar.gz')
+}
+
+archive_slots = threading.BoundedSemaphore(ARCHIVE_MAX_CONCURRENT)
+
+
+class StreamBuffer:
+    """Write-only file object whose contents are drained by the generator after each write"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def walk_archive_entries(root_dir, arc_root, exclude):
+    """Yield (path, arcname, lstat) for root_dir and everything beneath it, without following symlinks"""
+    for dir_path, dir_names, file_names in os.walk(root_dir):
+        dir_names[:] = sorted(name for name in dir_names if name not in exclude)
+        relative_dir = os.path.relpath(dir_path, root_dir)
+        arc_dir = arc_root if relative_dir == '.' else f'{arc_root}/{relative_dir}'
+        try:
+            yield dir_path, arc_dir, os.lstat(dir_path)
+        except OSError:
+            continue
+        # Symlinked directories are listed as files by os.walk's lstat, so add them here
+        for name in sorted(file_names + [name for name in dir_names if os.path.islink(os.path.join(dir_path, name))]):
+            if name in exclude:
+                continue
+            path = os.path.join(dir_path, name)
+            try:
+                yield path, f'{arc_dir}/{name}', os.lstat(path)
+            except OSError:
+                continue
+        dir_names[:] = [name for name in dir_names if not os.path.islink(os.path.join(dir_path, name))]
+
+
+def read_blocks(path, size):
+    """Yield exactly size bytes of a file in blocks, zero-padded if it shrank while being read"""
+    remaining = size
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            block = f.read(min(ARCHIVE_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    while remaining > 0:
+        padding = min(ARCHIVE_BLOCK_SIZE, remaining)
+        remaining -= padding
+        yield b'\0' * padding
+
+
+def stream_tar_gz(root_dir, arc_root, exclude=()):
+    """Yield a gzip-compressed tar archive of root_dir.
+
+    Headers come from tarfile, but file data is fed to the compressor block by
+    block, since TarFile.addfile() would copy each file in one call.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes a gzip header and trailer
+    for path, arcname, file_stat in walk_archive_entries(root_dir, arc_root, exclude):
+        info = tarfile.TarInfo(arcname)
+        info.mtime = int(file_stat.st_mtime)
+        info.mode = stat.S_IMODE(file_stat.st_mode)
+        if stat.S_ISDIR(file_stat.st_mode):
+            info.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(file_stat.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+        elif stat.S_ISREG(file_stat.st_mode):
+            info.size = file_stat.st_size
+        else:
+            continue  # Sockets, fifos and devices
+
+        try:
+            blocks = read_blocks(path, info.size) if info.size else iter(())
+            first_block = next(blocks, b'')
+        except OSError:
+            continue  # Unreadable - leave it out rather than fail the whole archive
+
+        yield compressor.compress(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+        yield compressor.compress(first_block)
+        for block in blocks:
+            yield compressor.compress(block)
+        if info.size % tarfile.BLOCKSIZE:
+            yield compressor.compress(b'\0' * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE))
+
+    # End of archive marker: two empty blocks
+    yield compressor.compress(b'\0' * (tarfile.BLOCKSIZE * 2))
+    yield compressor.flush()
+
+
+def stream_zip(root_dir, arc_root, exclude=()):
+    """Yield a zip archive of root_dir.
+
+    zipfile writes data descriptors when its output cannot seek, so entries
+    can be sent as soon as they are compressed.
+    """
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as archive:
+        for path, arcname, file_stat in walk_archive_entries(root_dir, arc_root, exclude):
+            date_time = time.localtime(max(file_stat.st_mtime, 315532800))[:6]  # Zip dates start in 1980
+            if stat.S_ISDIR(file_stat.st_mode):
+                info = zipfile.ZipInfo(arcname + '/', date_time)
+                info.external_attr = (stat.S_IFDIR | stat.S_IMODE(file_stat.st_mode)) << 16 | 0x10
+                archive.writestr(info, b'')
+            elif stat.S_ISLNK(file_stat.st_mode):
+                # Stored the way Info-ZIP does: the link target as the entry's data
+                info = zipfile.ZipInfo(arcname, date_time)
+                info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                archive.writestr(info, os.readlink(path))
+            elif stat.S_ISREG(file_stat.st_mode):
+                info = zipfile.ZipInfo(arcname, date_time)
+                info.external_attr = (stat.S_IFREG | stat.S_IMODE(file_stat.st_mode)) << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.file_size = file_stat.st_size  # Lets zipfile choose zip64 up front
+                try:
+                    blocks = read_blocks(path, file_stat.st_size)
+                    first_block = next(blocks, b'')
+                except OSError:
+                    continue
+                with archive.open(info, 'w') as entry:
+                    entry.write(first_block)
+                    yield buffer.drain()
+                    for block in blocks:
+                        entry.write(block)
+                        yield buffer.drain()
+            yield buffer.drain()
+    # Central directory
+    yield buffer.drain()
+
+
+def stream_archive(archive_format, root_dir, arc_root, exclude=()):
+    """Generator for an archive in one of ARCHIVE_FORMATS, skipping empty chunks"""
+    generate = stream_zip if archive_format == 'zip' else stream_tar_gz
+    for chunk in generate(root_dir, arc_root, exclude):
+        if chunk:
+            yield chunk
@@ -0,0 +1,108 @@
+"""
+Shared helpers for the benchmark scripts.
+
+Benchmarks run the server in-process against a scratch working directory so
+they never touch the real logs/ and user_data/ directories and need no network.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def prepare_workspace():
+    """Create a scratch working directory that links the repo's static assets and user scripts"""
+    workspace = tempfile.mkdtemp(prefix='terminal-bench-')
+    for name in ('static', 'user_scripts'):
+        os.symlink(os.path.join(REPO_ROOT, name), os.path.join(workspace, name))
+    os.chdir(workspace)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    return workspace
+
+
+def cleanup_workspace(workspace):
+    """Remove a scratch workspace created by prepare_workspace()"""
+    os.chdir(REPO_ROOT)
+    shutil.rmtree(workspace, ignore_errors=True)
+
+
+def load_server():
+    """Import flask_server after monkey patching and run its startup phase synchronously"""
+    import eventlet
+    os.environ['EVENTLET_NO_GREENDNS'] = '1'
+    eventlet.monkey_patch()
+
+    import flask_server
+    # Run every startup phase inline so measurements start from a warm, idle server
+    flask_server.FAST_START = False
+    flask_server.start_background_services()
+    return flask_server
+
+
+def summarize(samples):
+    """Summarize a list of durations in seconds as milliseconds"""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    count = len(ordered)
+    return {
+        'count': count,
+        'min_ms': round(ordered[0] * 1000, 3),
+        'mean_ms': round(sum(ordered) / count * 1000, 3),
+        'p50_ms': round(ordered[count // 2] * 1000, 3),
+        'p95_ms': round(ordered[min(count - 1, int(count * 0.95))] * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3)
+    }
+
+
+def timed(func, *args, **kwargs):
+    """Call func and return (result, elapsed seconds)"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def count_inodes(path):
+    """Count files, directories and links under path, including path itself"""
+    total = 1
+    for _, dirs, files in os.walk(path):
+        total += len(dirs) + len(files)
+    return total
+
+
+def git_revision():
+    """Return the current commit hash, or None outside a git checkout"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def write_results(benchmark, results, output=None):
+    """Write results as JSON with enough metadata to compare runs across commits"""
+    report = {
+        'benchmark': benchmark,
+        'revision': git_revision(),
+        'timestamp': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': results
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    # The server logs with print(), so benchmarks send stdout to stderr while they run
+    print(text, file=sys.__stdout__)
+    return report
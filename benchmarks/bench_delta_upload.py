@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Delta upload benchmark.
+
+Edits a large text file the way a user would (one changed line, an inserted
+line, appended lines) and syncs each version back twice, once through
+/files/upload and once through /files/signature and /files/delta, in-process
+with the Flask test client:
+
+    python benchmarks/bench_delta_upload.py --size-mb 20 --output delta.json
+
+Reports bytes sent over the wire and end-to-end time for both. The client
+side of the protocol is implemented here as a reference: blocks are matched
+with a rolling Adler-32 checksum confirmed by the strong checksum.
+"""
+
+import io
+import os
+import sys
+import json
+import zlib
+import random
+import hashlib
+import argparse
+import contextlib
+
+from bench_common import prepare_workspace, cleanup_workspace, load_server, timed, write_results
+
+MB = 1024 * 1024
+ADLER_MOD = 65521
+
+
+def roll_adler32(checksum, out_byte, in_byte, length):
+    """Slide an Adler-32 window one byte: drop out_byte from the front, add in_byte at the end"""
+    a = checksum & 0xffff
+    b = checksum >> 16
+    a = (a - out_byte + in_byte) % ADLER_MOD
+    b = (b - length * out_byte + a - 1) % ADLER_MOD
+    return (b << 16) | a
+
+
+def compute_delta(signature, data):
+    """Reconstruction ops and literal bytes turning the server's file into data"""
+    block_size = signature['blockSize']
+    blocks = {}
+    for index, (weak, strong) in enumerate(zip(signature['weak'], signature['strong'])):
+        blocks.setdefault(weak, []).append((index, strong))
+    last_index = len(signature['weak']) - 1
+    last_length = signature['size'] - last_index * block_size
+
+    def find_block(start, length, weak):
+        for index, strong in blocks.get(weak, ()):
+            full_length = last_length if index == last_index else block_size
+            if full_length == length and hashlib.sha256(data[start:start + length]).hexdigest()[:32] == strong:
+                return index
+        return None
+
+    ops = []
+    literal = io.BytesIO()
+    literal_start = 0
+    position = 0
+    weak = None
+    while position < len(data):
+        length = min(block_size, len(data) - position)
+        if weak is None:
+            weak = zlib.adler32(data[position:position + length])
+        index = find_block(position, length, weak)
+        if index is not None:
+            if literal_start < position:
+                literal.write(data[literal_start:position])
+                ops.append(['data', position - literal_start])
+            if ops and ops[-1][0] == 'copy' and ops[-1][1] + ops[-1][2] == index:
+                ops[-1][2] += 1
+            else:
+                ops.append(['copy', index, 1])
+            position += length
+            literal_start = position
+            weak = None
+        elif length == block_size and position + length < len(data):
+            weak = roll_adler32(weak, data[position], data[position + length], length)
+            position += 1
+        else:
+            # Too short for a full block: the rest is literal
+            position = len(data)
+    if literal_start < len(data):
+        literal.write(data[literal_start:])
+        ops.append(['data', len(data) - literal_start])
+    return ops, literal.getvalue()
+
+
+def full_upload(client, headers, name, data):
+    response = client.post('/files/upload', headers=headers, data={
+        'path': '', 'file': (io.BytesIO(data), name)
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200, response.json
+    return len(data)
+
+
+def delta_upload(client, headers, name, data):
+    signature_response = client.get(f'/files/signature?path={name}', headers=headers)
+    signature = signature_response.json
+    ops, literal = compute_delta(signature, data)
+    script = {
+        'blockSize': signature['blockSize'],
+        'baseEtag': signature['etag'],
+        'size': len(data),
+        'checksum': hashlib.sha256(data).hexdigest(),
+        'ops': ops
+    }
+    response = client.post('/files/delta', headers=headers, data={
+        'path': name, 'script': json.dumps(script), 'data': (io.BytesIO(literal), 'delta.bin')
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200, response.json
+    return len(signature_response.data) + response.json['bytesUploaded'], response.json['bytesSaved']
+
+
+def make_versions(size):
+    """A text file and three edited versions of it"""
+    rng = random.Random(42)
+    lines = []
+    total = 0
+    while total < size:
+        line = f'{len(lines):08d} ' + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz ') for _ in range(70)) + '\n'
+        lines.append(line)
+        total += len(line)
+    middle = len(lines) // 2
+    changed = lines[:middle] + ['changed line\n'] + lines[middle + 1:]
+    inserted = lines[:middle] + ['inserted line\n'] + lines[middle:]
+    appended = lines + [f'appended {i}\n' for i in range(100)]
+    encode = lambda version: ''.join(version).encode('utf-8')
+    return encode(lines), {'changed_line': encode(changed), 'inserted_line': encode(inserted),
+                           'appended_lines': encode(appended)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark delta uploads against full uploads')
+    parser.add_argument('--size-mb', type=int, default=20, help='Size of the edited file')
+    parser.add_argument('--output', help='Also write the JSON report to this file')
+    args = parser.parse_args()
+
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        workspace = prepare_workspace()
+        fs = load_server()
+        # Full uploads of the test file must fit the request limit
+        fs.app.config['MAX_CONTENT_LENGTH'] = max(fs.app.config.get('MAX_CONTENT_LENGTH') or 0,
+                                                  (args.size_mb + 1) * MB)
+        client = fs.app.test_client()
+        session_id = client.post('/create-session', json={'userId': 'bench-delta'}).json['sessionId']
+        headers = {'X-Session-Id': session_id}
+        home_dir = fs.sessions[session_id]['home_dir']
+
+        original, versions = make_versions(args.size_mb * MB)
+        results = {}
+        for scenario, data in versions.items():
+            full_upload(client, headers, 'data.txt', original)
+            full_bytes, full_time = timed(full_upload, client, headers, 'data.txt', data)
+
+            full_upload(client, headers, 'data.txt', original)
+            (delta_bytes, saved), delta_time = timed(delta_upload, client, headers, 'data.txt', data)
+            with open(os.path.join(home_dir, 'data.txt'), 'rb') as f:
+                assert f.read() == data, f'{scenario}: rebuilt file differs'
+
+            results[scenario] = {
+                'full_bytes': full_bytes,
+                'full_ms': round(full_time * 1000, 1),
+                'delta_bytes': delta_bytes,
+                'delta_ms': round(delta_time * 1000, 1),
+                'bytes_saved': saved
+            }
+
+        cleanup_workspace(workspace)
+
+    write_results('delta_upload', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Directory listing benchmarks on a large directory (50k entries by default).
+
+Compares the previous listdir + stat + isdir listing with the os.scandir
+scan, a validated listing cache hit (one stat), and the /files endpoint with
+the listing cache cold and warm:
+
+    python benchmarks/bench_directory_listing.py --entries 50000 --output listing.json
+"""
+
+import os
+import sys
+import time
+import argparse
+import contextlib
+from datetime import datetime
+
+from bench_common import prepare_workspace, cleanup_workspace, load_server, summarize, timed, write_results
+
+
+def legacy_listing(dir_path):
+    """The listing get_directory_stats() produced before the scandir cache (two syscalls per entry)"""
+    item_stats = []
+    for item in os.listdir(dir_path):
+        item_path = os.path.join(dir_path, item)
+        try:
+            item_stat = os.stat(item_path)
+            item_stats.append({
+                'name': item,
+                'path': item_path,
+                'is_dir': os.path.isdir(item_path),
+                'size': item_stat.st_size,
+                'modified': datetime.fromtimestamp(item_stat.st_mtime).isoformat()
+            })
+        except (FileNotFoundError, PermissionError):
+            pass
+    return item_stats
+
+
+def populate(dir_path, entries):
+    """Create entries files (with one subdirectory per thousand) and age the directory's mtime"""
+    os.makedirs(dir_path, exist_ok=True)
+    for i in range(entries):
+        name = os.path.join(dir_path, f'file-{i:06d}.txt')
+        if i % 1000 == 0:
+            os.makedirs(name + '.d', exist_ok=True)
+        else:
+            with open(name, 'w') as f:
+                f.write('x')
+    # Outside the racy window, so the scan can be cached
+    old = time.time() - 60
+    os.utime(dir_path, (old, old))
+
+
+def repeat(func, iterations, *args):
+    samples = []
+    for _ in range(iterations):
+        _, elapsed = timed(func, *args)
+        samples.append(elapsed)
+    return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark large directory listings')
+    parser.add_argument('--entries', type=int, default=50000, help='Entries in the test directory')
+    parser.add_argument('--iterations', type=int, default=5, help='Samples per measurement')
+    parser.add_argument('--output', help='Also write the JSON report to this file')
+    args = parser.parse_args()
+
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        workspace = prepare_workspace()
+        fs = load_server()
+        import file_management as fm
+
+        client = fs.app.test_client()
+        session_id = client.post('/create-session', json={'userId': 'bench-listing'}).json['sessionId']
+        home_dir = fs.sessions[session_id]['home_dir']
+        big_dir = os.path.join(home_dir, 'big')
+        populate(big_dir, args.entries)
+
+        def scan_cold():
+            fm.directory_listing_cache.clear()
+            return fm.get_directory_stats(big_dir)
+
+        def endpoint(clear_listing):
+            fm.path_cache.clear()
+            if clear_listing:
+                fm.directory_listing_cache.clear()
+            response = client.get('/files?path=big', headers={'X-Session-Id': session_id})
+            assert response.status_code == 200, response.status_code
+            return response
+
+        fm.get_directory_stats(big_dir)
+        results = {
+            'entries': args.entries,
+            'legacy_listdir_stat_isdir': repeat(legacy_listing, args.iterations, big_dir),
+            'scandir_cold': repeat(scan_cold, args.iterations),
+            'listing_cache_hit': repeat(fm.get_directory_stats, args.iterations * 100, big_dir),
+            'files_endpoint_listing_cold': repeat(endpoint, args.iterations, True),
+            'files_endpoint_listing_hit': repeat(endpoint, args.iterations, False)
+        }
+
+        cleanup_workspace(workspace)
+
+    write_results('directory_listing', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+File serving benchmarks.
+
+Measures throughput and Python memory for /static/<path> and /files/download
+with 1 MB and 100 MB files, in-process with the Flask test client:
+
+    python benchmarks/bench_file_serving.py --output after.json
+
+Memory is reported from tracemalloc: 'peak' is the most Python heap in use
+while one response is generated and consumed, 'retained' is what is still
+allocated afterwards (bodies pinned by caches).
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tracemalloc
+import contextlib
+
+from bench_common import REPO_ROOT, prepare_workspace, cleanup_workspace, load_server, summarize, write_results
+
+MB = 1024 * 1024
+CHUNK = 4 * MB
+
+
+def write_file(path, size):
+    """Write size bytes of incompressible data"""
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            block = min(CHUNK, remaining)
+            f.write(os.urandom(block))
+            remaining -= block
+
+
+def fetch(client, url, headers):
+    """Issue a GET and consume the streamed body, returning (status, bytes read)"""
+    response = client.get(url, headers=headers, buffered=False)
+    total = 0
+    try:
+        for chunk in response.response:
+            total += len(chunk)
+    finally:
+        response.close()
+    return response.status_code, total
+
+
+def measure(client, url, headers, iterations):
+    """Throughput and tracemalloc memory for repeated requests to one URL"""
+    samples = []
+    peaks = []
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    size = 0
+    status = None
+    for _ in range(iterations):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        status, size = fetch(client, url, headers)
+        samples.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    retained = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    mean = sum(samples) / len(samples)
+    return {
+        'status': status,
+        'bytes': size,
+        'latency': summarize(samples),
+        'throughput_mb_s': round(size / MB / mean, 1) if mean else None,
+        'peak_python_mb': round(max(peaks) / MB, 2),
+        'retained_python_mb': round(retained / MB, 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark static and download file serving')
+    parser.add_argument('--iterations', type=int, default=5, help='Requests per file')
+    parser.add_argument('--sizes', default='1,100', help='Comma-separated file sizes in MB')
+    parser.add_argument('--output', help='Also write the JSON report to this file')
+    args = parser.parse_args()
+
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    with contextlib.redirect_stdout(sys.stderr):
+        workspace = prepare_workspace()
+        # Serve a private copy of static/ so large test files stay out of the repo
+        os.unlink('static')
+        shutil.copytree(os.path.join(REPO_ROOT, 'static'), 'static')
+
+        fs = load_server()
+        client = fs.app.test_client()
+
+        session_id = client.post('/create-session', json={'userId': 'bench-files'}).json['sessionId']
+        home_dir = fs.sessions[session_id]['home_dir']
+
+        results = {}
+        for size_mb in sizes:
+            # Created after startup so they are served from disk rather than the precompressed store
+            static_name = f'bench-{size_mb}mb.js'
+            download_name = f'bench-{size_mb}mb.log'
+            write_file(os.path.join('static', static_name), size_mb * MB)
+            write_file(os.path.join(home_dir, download_name), size_mb * MB)
+
+            results[f'{size_mb}mb'] = {
+                'static': measure(client, f'/static/{static_name}', {}, args.iterations),
+                'download': measure(client, f'/files/download?path={download_name}',
+                                    {'X-Session-Id': session_id}, args.iterations)
+            }
+
+        cleanup_workspace(workspace)
+
+    write_results('file_serving', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Session lifecycle benchmarks.
+
+Drives the Flask app in-process with its test client and the Socket.IO test
+client - no network - and prints JSON so results can be compared across commits:
+
+    python benchmarks/bench_session_lifecycle.py --output before.json
+
+Measures:
+- /create-session latency with the session pool warm and cold
+- setup_user_environment() time and the number of inodes it creates
+- get_session() throughput, single-threaded and under contention
+- first and steady-state /execute-command latency (HTTP and Socket.IO)
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+import contextlib
+
+from bench_common import prepare_workspace, cleanup_workspace, load_server, summarize, timed, count_inodes, write_results
+
+
+def bench_create_session(fs, client, iterations):
+    """Measure /create-session with the pool pre-filled and with the pool empty"""
+    results = {}
+
+    # Warm: the pool holds enough sessions for every request
+    original_pool_size = fs.SESSION_POOL_SIZE
+    fs.SESSION_POOL_SIZE = iterations + 1
+    fs.initialize_session_pool(wait=True)
+    samples = []
+    from_pool = 0
+    for _ in range(iterations):
+        response, elapsed = timed(client.post, '/create-session', json={'userId': 'bench-warm'})
+        samples.append(elapsed)
+        from_pool += response.headers.get('X-Session-From-Pool') == 'True'
+    results['warm_pool'] = dict(summarize(samples), from_pool=from_pool)
+
+    # Cold: an empty pool that is not refilled forces the setup_user_environment() path
+    fs.SESSION_POOL_SIZE = 0
+    with fs.session_pool_lock:
+        fs.session_pool.clear()
+    samples = []
+    from_pool = 0
+    for _ in range(iterations):
+        response, elapsed = timed(client.post, '/create-session', json={'userId': 'bench-cold'})
+        samples.append(elapsed)
+        from_pool += response.headers.get('X-Session-From-Pool') == 'True'
+    results['cold_pool'] = dict(summarize(samples), from_pool=from_pool)
+
+    fs.SESSION_POOL_SIZE = original_pool_size
+    return results
+
+
+def bench_setup_environment(fs, iterations):
+    """Measure setup_user_environment() on fresh homes and count the inodes it creates"""
+    samples = []
+    inodes = []
+    for i in range(iterations):
+        home_dir = os.path.join('user_data', f'bench-setup-{i}')
+        _, elapsed = timed(fs.setup_user_environment, home_dir)
+        samples.append(elapsed)
+        inodes.append(count_inodes(home_dir))
+
+    # Re-running on an existing home is the renewal / missing-directory path
+    rerun_samples = []
+    for i in range(iterations):
+        home_dir = os.path.join('user_data', f'bench-setup-{i}')
+        _, elapsed = timed(fs.setup_user_environment, home_dir)
+        rerun_samples.append(elapsed)
+
+    return {
+        'fresh_home': summarize(samples),
+        'existing_home': summarize(rerun_samples),
+        'inodes_per_home': max(inodes) if inodes else 0
+    }
+
+
+def bench_get_session(fs, threads, lookups, session_count=100):
+    """Measure get_session() lookups per second with one thread and with several"""
+    session_ids = []
+    with fs.session_lock:
+        for i in range(session_count):
+            session_id = f'bench-lookup-{i}'
+            fs.sessions[session_id] = {
+                'user_id': f'bench-user-{i}',
+                'client_ip': '127.0.0.1',
+                'created': time.time(),
+                'last_accessed': time.time(),
+                'home_dir': os.path.join('user_data', session_id)
+            }
+            session_ids.append(session_id)
+
+    def worker(count):
+        rng = random.Random(count)
+        for _ in range(count):
+            fs.get_session(rng.choice(session_ids))
+
+    results = {}
+    for thread_count in (1, threads):
+        workers = [threading.Thread(target=worker, args=(lookups,)) for _ in range(thread_count)]
+        start = time.perf_counter()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = time.perf_counter() - start
+        results[f'threads_{thread_count}'] = {
+            'lookups': thread_count * lookups,
+            'seconds': round(elapsed, 4),
+            'lookups_per_second': round(thread_count * lookups / elapsed, 1)
+        }
+
+    with fs.session_lock:
+        for session_id in session_ids:
+            fs.sessions.pop(session_id, None)
+    return results
+
+
+def bench_execute_command(client, iterations, command='echo ok'):
+    """Measure the first command in a new session and then steady-state commands"""
+    session_id = client.post('/create-session', json={'userId': 'bench-exec'}).json['sessionId']
+    headers = {'X-Session-Id': session_id}
+
+    _, first = timed(client.post, '/execute-command', json={'command': command}, headers=headers)
+    samples = []
+    for _ in range(iterations):
+        _, elapsed = timed(client.post, '/execute-command', json={'command': command}, headers=headers)
+        samples.append(elapsed)
+
+    return {
+        'first_ms': round(first * 1000, 3),
+        'steady_state': summarize(samples)
+    }
+
+
+def wait_for_event(socket_client, name, timeout=30):
+    """Poll the Socket.IO test client until an event arrives"""
+    import eventlet
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        for packet in socket_client.get_received():
+            if packet['name'] == name:
+                return packet['args'][0]
+        eventlet.sleep(0.001)
+    raise TimeoutError(f"No '{name}' event within {timeout} seconds")
+
+
+def bench_socket_command(fs, iterations, command='echo ok'):
+    """Measure Socket.IO execute_command until command_complete, first and steady-state"""
+    socket_client = fs.socketio.test_client(fs.app)
+    socket_client.get_received()
+
+    start = time.perf_counter()
+    socket_client.emit('create_session', {'userId': 'bench-socket'})
+    session_id = wait_for_event(socket_client, 'session_created')['sessionId']
+    create_elapsed = time.perf_counter() - start
+
+    def run_once():
+        start = time.perf_counter()
+        socket_client.emit('execute_command', {'command': command, 'session_id': session_id})
+        wait_for_event(socket_client, 'command_complete')
+        return time.perf_counter() - start
+
+    first = run_once()
+    samples = [run_once() for _ in range(iterations)]
+    socket_client.disconnect()
+
+    return {
+        'create_session_ms': round(create_elapsed * 1000, 3),
+        'first_ms': round(first * 1000, 3),
+        'steady_state': summarize(samples)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the session lifecycle hot paths')
+    parser.add_argument('--iterations', type=int, default=20, help='Samples per latency measurement')
+    parser.add_argument('--threads', type=int, default=8, help='Threads for the get_session contention test')
+    parser.add_argument('--lookups', type=int, default=5000, help='get_session calls per thread')
+    parser.add_argument('--output', help='Also write the JSON report to this file')
+    parser.add_argument('--keep-workspace', action='store_true', help='Keep the scratch user_data and logs for inspection')
+    args = parser.parse_args()
+
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        workspace = prepare_workspace()
+        fs = load_server()
+        client = fs.app.test_client()
+
+        results = {
+            'create_session': bench_create_session(fs, client, args.iterations),
+            'setup_user_environment': bench_setup_environment(fs, args.iterations),
+            'get_session': bench_get_session(fs, args.threads, args.lookups),
+            'execute_command': bench_execute_command(client, args.iterations),
+            'socket_execute_command': bench_socket_command(fs, args.iterations)
+        }
+
+        if args.keep_workspace:
+            results['workspace'] = workspace
+        else:
+            cleanup_workspace(workspace)
+
+    write_results('session_lifecycle', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Per-worker memory with private and shared static assets and user scripts.
+
+Starts several worker processes at once, each loading the precompressed static
+store and the script cache the way a server worker does at startup, once with
+SHARED_ASSETS=false (every worker compresses and keeps its own copy) and once
+with the shared segment:
+
+    python benchmarks/bench_shared_assets.py --workers 4 --extra-mb 4 --output shared.json
+
+RSS counts shared pages in every worker; USS (pages only this worker uses) and
+PSS (shared pages split between the workers mapping them) show what each
+additional worker really costs. Synthetic 1 MB scripts are added to a copy of
+static/ so the difference is visible above measurement noise.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+
+from bench_common import REPO_ROOT, prepare_workspace, cleanup_workspace, write_results
+
+MB = 1024 * 1024
+
+
+def memory_snapshot(pid=None):
+    import psutil
+    info = psutil.Process(pid).memory_full_info()
+    return {
+        'rss_mb': round(info.rss / MB, 2),
+        'uss_mb': round(info.uss / MB, 2),
+        'pss_mb': round(getattr(info, 'pss', 0) / MB, 2)
+    }
+
+
+def worker(workspace, shared, segment_dir, report_dir):
+    """Load the assets like a server worker, report, then idle until terminated"""
+    os.environ['SHARED_ASSETS'] = 'true' if shared else 'false'
+    os.environ['SHARED_ASSETS_DIR'] = segment_dir
+    os.chdir(workspace)
+    sys.path.insert(0, REPO_ROOT)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        import eventlet
+        eventlet.monkey_patch()
+        import flask_server
+        import static_assets
+
+        before = memory_snapshot()
+        start = time.perf_counter()
+        static_assets.build_static_asset_store()
+        flask_server.warm_tool_artifacts()
+        elapsed = time.perf_counter() - start
+
+        # Touch every body, as serving them would, so mapped pages are resident
+        for asset in static_assets.static_asset_store.values():
+            for data in asset['variants'].values():
+                sum(memoryview(data)[::4096])
+        for content in flask_server.script_cache.values():
+            sum(memoryview(content)[::4096])
+
+    # Files rather than multiprocessing queues and barriers, which deadlock
+    # against eventlet's green threads
+    report_path = os.path.join(report_dir, f'{os.getpid()}.json')
+    with open(report_path + '.tmp', 'w') as f:
+        json.dump({'load_ms': round(elapsed * 1000, 1), 'before': before}, f)
+    os.replace(report_path + '.tmp', report_path)
+    while True:
+        time.sleep(1)
+
+
+def run_workers(workspace, shared, workers):
+    segment_dir = tempfile.mkdtemp(prefix='terminal-bench-shm-',
+                                   dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    report_dir = tempfile.mkdtemp(prefix='terminal-bench-reports-')
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=worker, args=(workspace, shared, segment_dir, report_dir), daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    # Measure once every worker is loaded and alive, so PSS splits the shared pages
+    while len([name for name in os.listdir(report_dir) if name.endswith('.json')]) < workers:
+        if not all(process.is_alive() for process in processes):
+            raise RuntimeError('A worker exited before reporting')
+        time.sleep(0.2)
+
+    reports = []
+    for process in processes:
+        with open(os.path.join(report_dir, f'{process.pid}.json')) as f:
+            report = json.load(f)
+        after = memory_snapshot(process.pid)
+        report.update({
+            'after': after,
+            'delta_uss_mb': round(after['uss_mb'] - report['before']['uss_mb'], 2),
+            'delta_pss_mb': round(after['pss_mb'] - report['before']['pss_mb'], 2)
+        })
+        reports.append(report)
+
+    for process in processes:
+        process.terminate()
+        process.join()
+    shutil.rmtree(segment_dir, ignore_errors=True)
+    shutil.rmtree(report_dir, ignore_errors=True)
+
+    return {
+        'workers': reports,
+        'total_delta_uss_mb': round(sum(report['delta_uss_mb'] for report in reports), 2),
+        'total_delta_pss_mb': round(sum(report['delta_pss_mb'] for report in reports), 2),
+        'max_load_ms': max(report['load_ms'] for report in reports)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark per-worker memory for shared assets')
+    parser.add_argument('--workers', type=int, default=4, help='Worker processes to start together')
+    parser.add_argument('--extra-mb', type=int, default=4, help='Synthetic 1 MB static scripts to add')
+    parser.add_argument('--output', help='Also write the JSON report to this file')
+    args = parser.parse_args()
+
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        workspace = prepare_workspace()
+        # A private static directory, so synthetic assets never touch the repo
+        os.unlink('static')
+        shutil.copytree(os.path.join(REPO_ROOT, 'static'), 'static')
+        for i in range(args.extra_mb):
+            with open(os.path.join('static', f'bench-asset-{i}.js'), 'w') as f:
+                f.write(f'var data{i} = "' + os.urandom(MB // 2 - 32).hex() + '";\n')
+
+        results = {
+            'workers': args.workers,
+            'extra_mb': args.extra_mb,
+            'private': run_workers(workspace, False, args.workers),
+            'shared': run_workers(workspace, True, args.workers)
+        }
+
+        cleanup_workspace(workspace)
+
+    write_results('shared_assets', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
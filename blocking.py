@@ -0,0 +1,22 @@
+"""
+Running blocking calls without stalling the event loop.
+
+Under eventlet every request is a green thread on one hub, so a long file
+read, hash or directory walk holds up every other request in the worker.
+run_blocking hands such calls to eventlet's pool of OS threads instead. The
+call must not take green locks or touch sockets; without eventlet it simply
+runs in the calling thread.
+"""
+
+import eventlet
+from eventlet import tpool
+
+
+def run_blocking(func, *args):
+    """Run a blocking call in eventlet's OS thread pool, so the hub keeps serving other requests.
+    
+    func must not take green locks or touch sockets. Without eventlet it is called directly.
+    """
+    if eventlet.patcher.is_monkey_patched('thread'):
+        return tpool.execute(func, *args)
+    return func(*args)
@@ -0,0 +1,112 @@
+"""
+Central registry for the server's in-memory caches.
+
+Each cache registers functions reporting its size in bytes and entries and
+evicting its least valuable entries down to a byte target. The registry
+enforces one global byte budget across all caches, and under memory pressure
+shrinks every cache in proportion to its size instead of clearing them all
+at once, which avoids a miss storm.
+"""
+
+import os
+import threading
+
+CACHE_MEMORY_BUDGET_BYTES = int(os.environ.get('CACHE_MEMORY_BUDGET_BYTES', 64 * 1024 * 1024))
+
+# Cache name -> {'size': fn() -> bytes, 'entries': fn() -> int, 'evict': fn(target_bytes) -> bytes freed, ...}
+cache_registry = {}
+cache_registry_lock = threading.Lock()
+
+
+def register_cache(name, size, entries, evict):
+    """
+    Register a cache with the manager.
+
+    Args:
+        name: Name used in stats
+        size: Function returning the cache's approximate size in bytes
+        entries: Function returning the number of cached entries
+        evict: Function evicting entries until the cache is at or below a byte
+            target, returning the number of bytes freed
+    """
+    with cache_registry_lock:
+        cache_registry[name] = {
+            'size': size,
+            'entries': entries,
+            'evict': evict,
+            'evictions': 0,
+            'evicted_bytes': 0
+        }
+
+
+def evict_to_target(total_target):
+    """Shrink every cache by the same fraction so their sum is at most total_target bytes"""
+    with cache_registry_lock:
+        caches = list(cache_registry.items())
+
+    sizes = {name: cache['size']() for name, cache in caches}
+    total = sum(sizes.values())
+    if total <= total_target:
+        return 0
+
+    keep_fraction = max(0.0, total_target / total) if total else 0.0
+    freed_total = 0
+    for name, cache in caches:
+        if sizes[name] == 0:
+            continue
+        try:
+            freed = cache['evict'](int(sizes[name] * keep_fraction))
+        except Exception as e:
+            print(f"Error evicting from cache {name}: {str(e)}")
+            continue
+        if freed:
+            cache['evictions'] += 1
+            cache['evicted_bytes'] += freed
+            freed_total += freed
+    return freed_total
+
+
+def enforce_cache_budget():
+    """Evict proportionally from all caches when their total exceeds the global budget"""
+    return evict_to_target(CACHE_MEMORY_BUDGET_BYTES)
+
+
+def pressure_target(mem_percent, warning_threshold, emergency_threshold):
+    """
+    Byte target for all caches at a given memory usage.
+
+    The full budget below the warning threshold, shrinking linearly to nothing
+    at the emergency threshold.
+    """
+    if mem_percent <= warning_threshold:
+        return CACHE_MEMORY_BUDGET_BYTES
+    if mem_percent >= emergency_threshold:
+        return 0
+    headroom = (emergency_threshold - mem_percent) / (emergency_threshold - warning_threshold)
+    return int(CACHE_MEMORY_BUDGET_BYTES * headroom)
+
+
+def relieve_memory_pressure(mem_percent, warning_threshold, emergency_threshold):
+    """Evict in proportion to memory pressure. Returns (byte target, bytes freed)."""
+    target = pressure_target(mem_percent, warning_threshold, emergency_threshold)
+    return target, evict_to_target(target)
+
+
+def get_cache_stats():
+    """Per-cache size and eviction stats"""
+    with cache_registry_lock:
+        caches = list(cache_registry.items())
+
+    stats = {}
+    for name, cache in caches:
+        stats[name] = {
+            'bytes': cache['size'](),
+            'entries': cache['entries'](),
+            'evictions': cache['evictions'],
+            'evictedBytes': cache['evicted_bytes']
+        }
+    return {
+        'budgetBytes': CACHE_MEMORY_BUDGET_BYTES,
+        'totalBytes': sum(cache['bytes'] for cache in stats.values()),
+        'caches': stats
+    }
@@ -0,0 +1,258 @@
+"""
+Content-addressed storage for uploaded files.
+
+With DEDUP_UPLOADS=reflink, uploads are hashed as they are written and kept
+once per distinct content under user_data/.blobs/<aa>/<sha256>. The file in
+the session home is a reflink (copy-on-write clone) of the blob, so the same
+wheel or dataset uploaded by many sessions shares its data blocks on
+filesystems that support them (btrfs, XFS).
+
+Each clone is an independent inode: a session writing to its file, even as
+root, only unshares the blocks it changes and never affects another
+session's copy. Hardlinks would share the inode itself, so they are never
+used. On filesystems without reflink support the upload simply becomes the
+home's own file.
+
+Clones carry no reference count, so a blob is marked as used each time it is
+cloned and a periodic sweep removes blobs unused for DEDUP_BLOB_GRACE seconds.
+"""
+
+import os
+import time
+import uuid
+import errno
+import fcntl
+import shutil
+import hashlib
+import threading
+
+DEDUP_UPLOADS = os.environ.get('DEDUP_UPLOADS', 'off').lower()  # off or reflink
+DEDUP_MIN_SIZE = int(os.environ.get('DEDUP_MIN_SIZE', 64 * 1024))  # Smaller files are stored normally
+DEDUP_BLOB_GRACE = int(os.environ.get('DEDUP_BLOB_GRACE', 3600))  # Seconds an unreferenced blob is kept
+DEDUP_GC_INTERVAL = 600  # Seconds between sweeps of the store
+DEDUP_COPY_BUFFER_SIZE = 256 * 1024
+DEDUP_STORE_DIR_NAME = '.blobs'
+FICLONE = 0x40049409  # ioctl from <linux/fs.h>, not exposed by fcntl before Python 3.12
+
+# Serializes cloning against the sweep, so a blob cannot be removed between lookup and clone
+dedup_lock = threading.Lock()
+dedup_state = {
+    'started': False,
+    'stored': 0,
+    'hits': 0,
+    'bytes_saved': 0,
+    'fallbacks': 0,
+    'collected': 0,
+    'sweep': None
+}
+
+
+def dedup_enabled(size=None):
+    """Whether uploads of this size go through the store"""
+    if DEDUP_UPLOADS != 'reflink':
+        return False
+    return size is None or size >= DEDUP_MIN_SIZE
+
+
+def store_dir_for(home_dir):
+    """Blob store shared by every home: a sibling of the homes, so clones stay on one filesystem"""
+    return os.path.join(os.path.dirname(os.path.normpath(home_dir)), DEDUP_STORE_DIR_NAME)
+
+
+def blob_path(store_dir, digest):
+    return os.path.join(store_dir, digest[:2], digest)
+
+
+def clone_file(source_path, destination_path):
+    """Reflink source to a new destination file, raising OSError if the filesystem cannot"""
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+
+
+def place_clone(source_path, target_path):
+    """Replace target_path with a reflink of source_path. Returns False if the filesystem cannot clone it."""
+    temp_path = os.path.join(os.path.dirname(target_path),
+                             f'.{os.path.basename(target_path)}.dedup-{uuid.uuid4().hex}')
+    try:
+        clone_file(source_path, temp_path)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, target_path)
+    except OSError as e:
+        if os.path.lexists(temp_path):
+            os.unlink(temp_path)
+        if e.errno in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+            # Another filesystem, or no reflink support
+            return False
+        raise
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return True
+
+
+def add_to_store(home_dir, source_path, digest, target_path):
+    """
+    Put a complete file at target_path as a clone of its blob, storing the blob if it is new.
+
+    Args:
+        home_dir: Session home the file belongs to
+        source_path: Finished temporary file, consumed by the call
+        digest: Hex SHA-256 of its contents
+        target_path: Where the file belongs in the home
+
+    Returns:
+        True if the content was already stored and only a clone was added
+    """
+    store_dir = store_dir_for(home_dir)
+    blob = blob_path(store_dir, digest)
+    size = os.path.getsize(source_path)
+    with dedup_lock:
+        existing = os.path.exists(blob)
+        shared = place_clone(blob if existing else source_path, target_path)
+        if not shared:
+            # No reflinks here - the upload itself becomes the home's private file
+            shutil.move(source_path, target_path)
+        elif existing:
+            os.unlink(source_path)
+            # Marks the blob as used, which keeps it past the sweep's grace period
+            os.utime(blob)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(source_path, blob)
+
+    if not shared:
+        dedup_state['fallbacks'] += 1
+    elif existing:
+        dedup_state['hits'] += 1
+        dedup_state['bytes_saved'] += size
+    else:
+        dedup_state['stored'] += 1
+    return shared and existing
+
+
+def save_stream_deduplicated(home_dir, stream, target_path):
+    """Write an upload stream into the store, hashing it on the way, and clone it to target_path.
+
+    Returns the hex SHA-256 of the upload.
+    """
+    temp_dir = os.path.join(store_dir_for(home_dir), 'tmp')
+    os.makedirs(temp_dir, exist_ok=True)
+    temp_path = os.path.join(temp_dir, uuid.uuid4().hex)
+    digest = hashlib.sha256()
+    try:
+        with open(temp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(DEDUP_COPY_BUFFER_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                digest.update(chunk)
+            size = f.tell()
+        if size < DEDUP_MIN_SIZE:
+            # Not worth a blob
+            shutil.move(temp_path, target_path)
+        else:
+            add_to_store(home_dir, temp_path, digest.hexdigest(), target_path)
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return digest.hexdigest()
+
+
+def sweep_store(data_dir='user_data'):
+    """Remove blobs no upload has used within the grace period, and tally store usage for reporting"""
+    store_dir = os.path.join(data_dir, DEDUP_STORE_DIR_NAME)
+    current_time = time.time()
+    blobs = 0
+    stored_bytes = 0
+    collected = 0
+    try:
+        prefixes = os.listdir(store_dir)
+    except FileNotFoundError:
+        prefixes = []
+    for prefix in prefixes:
+        prefix_dir = os.path.join(store_dir, prefix)
+        if prefix == 'tmp':
+            # Uploads interrupted by a restart
+            for name in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, name)
+                try:
+                    if current_time - os.lstat(path).st_mtime > DEDUP_BLOB_GRACE:
+                        os.unlink(path)
+                except OSError:
+                    pass
+            continue
+        try:
+            names = os.listdir(prefix_dir)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(prefix_dir, name)
+            with dedup_lock:
+                try:
+                    blob_stat = os.lstat(path)
+                    # add_to_store touches a blob each time it is cloned
+                    if current_time - blob_stat.st_mtime > DEDUP_BLOB_GRACE:
+                        os.unlink(path)
+                        collected += 1
+                        continue
+                except OSError:
+                    continue
+            blobs += 1
+            stored_bytes += blob_stat.st_size
+        # Pause between directories so a large store does not hold up requests
+        time.sleep(0)
+
+    dedup_state['collected'] += collected
+    dedup_state['sweep'] = {
+        'at': current_time,
+        'blobs': blobs,
+        'storedBytes': stored_bytes,
+        'collected': collected
+    }
+
+
+def run_dedup_collector(data_dir):
+    """Collector thread main loop"""
+    while True:
+        try:
+            sweep_store(data_dir)
+        except Exception as e:
+            print(f"Dedup store sweep error: {str(e)}")
+        time.sleep(DEDUP_GC_INTERVAL)
+
+
+def start_dedup_collector(data_dir='user_data'):
+    """Start the sweep thread once, when deduplication is enabled"""
+    if not dedup_enabled():
+        if DEDUP_UPLOADS != 'off':
+            print(f"Ignoring DEDUP_UPLOADS={DEDUP_UPLOADS}: only reflink deduplication is supported")
+        return
+    with dedup_lock:
+        if dedup_state['started']:
+            return
+        dedup_state['started'] = True
+    threading.Thread(target=run_dedup_collector, args=(data_dir,), daemon=True).start()
+    print("Dedup store enabled with reflink copies")
+
+
+def get_dedup_stats():
+    """Store usage and savings for health reporting"""
+    sweep = dedup_state['sweep'] or {}
+    stored_bytes = sweep.get('storedBytes', 0)
+    # What the store would hold without sharing: the blobs plus every clone that reused one
+    logical_bytes = stored_bytes + dedup_state['bytes_saved']
+    return {
+        'mode': DEDUP_UPLOADS if dedup_enabled() else 'off',
+        'blobs': sweep.get('blobs', 0),
+        'storedBytes': stored_bytes,
+        'logicalBytes': logical_bytes,
+        'ratio': round(logical_bytes / stored_bytes, 2) if stored_bytes else None,
+        'hits': dedup_state['hits'],
+        'bytesSaved': dedup_state['bytes_saved'],
+        'fallbacks': dedup_state['fallbacks'],
+        'collected': dedup_state['collected'],
+        'lastSweep': sweep.get('at')
+    }
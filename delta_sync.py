@@ -0,0 +1,161 @@
+"""
+Block-level delta uploads, in the style of rsync.
+
+The server describes an existing file as a list of fixed-size blocks, each
+with a weak rolling checksum (zlib.adler32, which a client can roll one byte
+at a time) and a strong checksum (the first 16 bytes of its SHA-256). The
+client finds the blocks it already shares with the server and sends only a
+reconstruction script plus the bytes that changed:
+
+    {"blockSize": 4096, "baseEtag": "...", "size": 20971523, "checksum": "<sha256>",
+     "ops": [["copy", 0, 812], ["data", 5], ["copy", 813, 4307]]}
+
+"copy" repeats count blocks of the old file starting at a block index, and
+"data" takes the next length bytes of the uploaded data. The new file is
+written next to the old one and renamed over it only once it is complete and
+its checksum matches.
+"""
+
+import os
+import math
+import uuid
+import zlib
+import hashlib
+
+DELTA_MIN_BLOCK_SIZE = 1024
+DELTA_MAX_BLOCK_SIZE = 1024 * 1024
+DELTA_MAX_OPS = 1_000_000
+DELTA_COPY_BUFFER_SIZE = 256 * 1024
+
+
+def default_block_size(size):
+    """Block size for a file: about the square root of its size, like rsync, rounded to 1 KB"""
+    block_size = int(math.sqrt(size)) // 1024 * 1024
+    return max(DELTA_MIN_BLOCK_SIZE, min(block_size, 64 * 1024))
+
+
+def strong_checksum(block):
+    return hashlib.sha256(block).hexdigest()[:32]
+
+
+def file_signature(path, block_size):
+    """Weak and strong checksums of every block of a file, the last block possibly short"""
+    weak = []
+    strong = []
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            weak.append(zlib.adler32(block))
+            strong.append(strong_checksum(block))
+    return weak, strong
+
+
+def validate_delta_script(script, base_size, data_length, max_size):
+    """Check a reconstruction script against the base file and uploaded data. Returns (ops as tuples, error)."""
+    if not isinstance(script, dict):
+        return None, 'Script must be a JSON object'
+    block_size = script.get('blockSize')
+    size = script.get('size')
+    ops = script.get('ops')
+    if not isinstance(block_size, int) or not DELTA_MIN_BLOCK_SIZE <= block_size <= DELTA_MAX_BLOCK_SIZE:
+        return None, 'Invalid blockSize'
+    if not isinstance(size, int) or not 0 <= size <= max_size:
+        return None, 'Invalid size'
+    if not isinstance(ops, list) or len(ops) > DELTA_MAX_OPS:
+        return None, 'ops must be a list'
+
+    block_count = (base_size + block_size - 1) // block_size
+    resolved = []
+    output_size = 0
+    data_used = 0
+    for op in ops:
+        if not isinstance(op, list) or not op or not all(isinstance(value, int) for value in op[1:]):
+            return None, f'Invalid op: {op!r}'
+        if op[0] == 'copy' and len(op) == 3:
+            _, first, count = op
+            if first < 0 or count < 1 or first + count > block_count:
+                return None, f'Block range {first}+{count} is outside the base file'
+            start = first * block_size
+            length = min((first + count) * block_size, base_size) - start
+            resolved.append(('copy', start, length))
+        elif op[0] == 'data' and len(op) == 2:
+            length = op[1]
+            if length < 1 or data_used + length > data_length:
+                return None, 'Data ops use more bytes than were uploaded'
+            data_used += length
+            resolved.append(('data', length))
+        else:
+            return None, f'Invalid op: {op!r}'
+        output_size += length
+
+    if data_used != data_length:
+        return None, f'{data_length - data_used} uploaded bytes are not used by any op'
+    if output_size != size:
+        return None, f'Ops produce {output_size} bytes, expected {size}'
+    return resolved, None
+
+
+def copy_exactly(source, destination, length, digest):
+    """Copy length bytes between file objects. Returns False if the source ends early."""
+    while length > 0:
+        chunk = source.read(min(DELTA_COPY_BUFFER_SIZE, length))
+        if not chunk:
+            return False
+        destination.write(chunk)
+        digest.update(chunk)
+        length -= len(chunk)
+    return True
+
+
+def apply_delta(base_path, ops, data_stream, base_stat):
+    """
+    Rebuild a file from its old version and a validated script into a temporary file beside it.
+
+    Args:
+        base_path: The file being replaced
+        ops: Ops returned by validate_delta_script()
+        data_stream: File object holding the uploaded data bytes, in op order
+        base_stat: os.stat() of the base file the script was validated against
+
+    Returns:
+        (temporary path, hex SHA-256 of the new contents, error). On error
+        nothing is left behind; otherwise the caller renames the temporary
+        file into place or removes it.
+    """
+    temp_path = os.path.join(os.path.dirname(base_path), f'.{os.path.basename(base_path)}.delta-{uuid.uuid4().hex}')
+    digest = hashlib.sha256()
+    error = None
+    try:
+        with open(base_path, 'rb') as base, open(temp_path, 'wb') as output:
+            for op in ops:
+                if op[0] == 'copy':
+                    base.seek(op[1])
+                    complete = copy_exactly(base, output, op[2], digest)
+                else:
+                    complete = copy_exactly(data_stream, output, op[1], digest)
+                if not complete:
+                    error = 'Base file or uploaded data ended early'
+                    break
+            output.flush()
+            os.fsync(output.fileno())
+            # Blocks copied from a file that changed meanwhile may be a mix of two versions
+            current = os.fstat(base.fileno())
+            if (current.st_mtime_ns, current.st_size) != (base_stat.st_mtime_ns, base_stat.st_size):
+                error = 'Base file changed during reconstruction'
+        if error is None:
+            os.chmod(temp_path, base_stat.st_mode & 0o7777)
+            return temp_path, digest.hexdigest(), None
+    except BaseException:
+        remove_quietly(temp_path)
+        raise
+    remove_quietly(temp_path)
+    return None, None, error
+
+
+def remove_quietly(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
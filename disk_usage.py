@@ -0,0 +1,312 @@
+"""
+Per-session disk usage accounting and quotas.
+
+Usage is kept up to date incrementally: the server's own write paths
+(uploads, deletes, batch operations, delta uploads) record the size change of
+every path they touch, so checking a quota never walks the home directory.
+Changes the server cannot size cheaply - directory trees, commands run by the
+user - mark the home dirty instead, and a background thread rescans a dirty
+home DISK_USAGE_DIRTY_DELAY seconds after the first such change, however many
+follow, and every home periodically. Rescans are throttled and yield between
+batches of entries, so they run at low priority next to request handling. A
+home whose usage is still unknown when its quota is first checked is scanned
+at full speed in an OS thread instead, while the request waits.
+
+Quotas have a soft limit, above which writes still succeed with a warning,
+and a hard limit, which rejects uploads and caps the size of files written
+by commands through RLIMIT_FSIZE.
+"""
+
+import os
+import stat
+import time
+import resource
+import threading
+import contextlib
+from blocking import run_blocking
+
+DISK_QUOTA_SOFT_BYTES = int(os.environ.get('DISK_QUOTA_SOFT_BYTES', 1024 * 1024 * 1024))
+DISK_QUOTA_HARD_BYTES = int(os.environ.get('DISK_QUOTA_HARD_BYTES', 2 * 1024 * 1024 * 1024))  # 0 disables quotas
+DISK_USAGE_RECONCILE_INTERVAL = int(os.environ.get('DISK_USAGE_RECONCILE_INTERVAL', 900))
+DISK_USAGE_SCAN_RATE = int(os.environ.get('DISK_USAGE_SCAN_RATE', 20000))  # Entries per second while rescanning
+# Seconds after the first unsized change before the home is rescanned - later changes wait for the same rescan
+DISK_USAGE_DIRTY_DELAY = int(os.environ.get('DISK_USAGE_DIRTY_DELAY', 300))
+DISK_USAGE_SCAN_BATCH = 500  # Entries between pauses while rescanning
+
+# Home directory -> {'bytes', 'files', 'reconciled', 'dirty_since', 'scanning', 'scan_delta', 'drift'}
+disk_usage = {}
+disk_usage_lock = threading.Lock()
+disk_usage_state = {
+    'started': False,
+    'scans': 0,
+    'scan_seconds': 0.0,
+    'last_drift': 0
+}
+
+
+def usage_entry(home_dir):
+    """Accounting entry for a home directory - caller must hold disk_usage_lock"""
+    entry = disk_usage.get(home_dir)
+    if entry is None:
+        # Unknown until the first scan, which the reconciler runs right away
+        entry = disk_usage[home_dir] = {
+            'bytes': 0,
+            'files': 0,
+            'reconciled': None,
+            'dirty_since': time.time(),
+            'scanning': False,
+            'scan_delta': 0,
+            'drift': 0
+        }
+    return entry
+
+
+def track_home(home_dir):
+    """Start accounting for a home directory"""
+    with disk_usage_lock:
+        usage_entry(os.path.normpath(home_dir))
+
+
+def untrack_home(home_dir):
+    """Stop accounting for a home directory whose session ended"""
+    with disk_usage_lock:
+        disk_usage.pop(os.path.normpath(home_dir), None)
+
+
+def record_usage(home_dir, delta_bytes):
+    """Apply a known size change to a home's usage"""
+    if not delta_bytes:
+        return
+    with disk_usage_lock:
+        entry = usage_entry(os.path.normpath(home_dir))
+        entry['bytes'] = max(0, entry['bytes'] + delta_bytes)
+        if entry['scanning']:
+            entry['scan_delta'] += delta_bytes
+
+
+def mark_dirty(home_dir):
+    """Note a change of unknown size, so the home is rescanned soon"""
+    with disk_usage_lock:
+        entry = usage_entry(os.path.normpath(home_dir))
+        if entry['dirty_since'] is None:
+            entry['dirty_since'] = time.time()
+
+
+def path_bytes(path):
+    """Bytes a path adds to usage: its size for files and links, 0 if missing, None for directories"""
+    try:
+        path_stat = os.lstat(path)
+    except FileNotFoundError:
+        return 0
+    except OSError:
+        return None
+    if stat.S_ISDIR(path_stat.st_mode):
+        return None
+    return path_stat.st_size
+
+
+@contextlib.contextmanager
+def tracked_paths(home_dir, *paths):
+    """Record the size change of paths across the block, even if it fails partway"""
+    before = [path_bytes(path) for path in paths]
+    try:
+        yield
+    finally:
+        after = [path_bytes(path) for path in paths]
+        if None in before or None in after:
+            mark_dirty(home_dir)
+        else:
+            record_usage(home_dir, sum(after) - sum(before))
+
+
+def get_usage(home_dir):
+    with disk_usage_lock:
+        return usage_entry(os.path.normpath(home_dir))['bytes']
+
+
+def ensure_scanned(home_dir):
+    """Scan a home whose usage is still unknown (new, or tracked since a restart) before enforcing its quota,
+    waiting for the reconciler instead if it is already scanning it"""
+    home_dir = os.path.normpath(home_dir)
+    while True:
+        with disk_usage_lock:
+            if usage_entry(home_dir)['reconciled'] is not None:
+                return
+        if reconcile_home(home_dir, throttled=False):
+            return
+        time.sleep(0.05)
+
+
+def check_quota(home_dir, additional_bytes):
+    """
+    Check whether a write of additional_bytes fits the quota.
+
+    Returns (error, warning): error is a message when the hard limit would be
+    exceeded, warning a message when usage is over the soft limit.
+    """
+    if not DISK_QUOTA_HARD_BYTES:
+        return None, None
+    ensure_scanned(home_dir)
+    usage = get_usage(home_dir)
+    if usage + max(0, additional_bytes) > DISK_QUOTA_HARD_BYTES:
+        return (f'Disk quota exceeded: {usage} of {DISK_QUOTA_HARD_BYTES} bytes used, '
+                f'{additional_bytes} more requested'), None
+    if DISK_QUOTA_SOFT_BYTES and usage + max(0, additional_bytes) > DISK_QUOTA_SOFT_BYTES:
+        return None, f'Over soft disk quota: {usage} of {DISK_QUOTA_SOFT_BYTES} bytes used'
+    return None, None
+
+
+def command_preexec(home_dir):
+    """preexec_fn for user commands: a new process group, with file sizes capped at the remaining quota"""
+    limit = resource.RLIM_INFINITY
+    if DISK_QUOTA_HARD_BYTES:
+        ensure_scanned(home_dir)
+        limit = max(0, DISK_QUOTA_HARD_BYTES - get_usage(home_dir))
+
+    def preexec():
+        os.setsid()
+        resource.setrlimit(resource.RLIMIT_FSIZE, (limit, limit))
+    return preexec
+
+
+def scan_usage(home_dir, throttled=True):
+    """Walk a home directory counting bytes of files and links, each hardlinked inode once.
+
+    Unthrottled scans never pause, so they can run in an OS thread.
+    Returns (bytes, files), or None if the directory is gone.
+    """
+    total = 0
+    files = 0
+    seen_inodes = set()
+    pending = [home_dir]
+    visited = 0
+    batch_start = time.time()
+    while pending:
+        dir_path = pending.pop()
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if stat.S_ISDIR(entry_stat.st_mode):
+                        pending.append(entry.path)
+                    else:
+                        if entry_stat.st_nlink > 1:
+                            key = (entry_stat.st_dev, entry_stat.st_ino)
+                            if key in seen_inodes:
+                                continue
+                            seen_inodes.add(key)
+                        total += entry_stat.st_size
+                        files += 1
+                    visited += 1
+                    if throttled and visited % DISK_USAGE_SCAN_BATCH == 0:
+                        # Throttle to DISK_USAGE_SCAN_RATE, always yielding to other threads
+                        pause = DISK_USAGE_SCAN_BATCH / DISK_USAGE_SCAN_RATE - (time.time() - batch_start)
+                        time.sleep(max(0, pause))
+                        batch_start = time.time()
+        except FileNotFoundError:
+            if dir_path == home_dir:
+                return None
+        except OSError:
+            continue
+    return total, files
+
+
+def reconcile_home(home_dir, throttled=True):
+    """Rescan one home and replace its tracked usage, keeping changes recorded during the scan.
+
+    An unthrottled rescan walks the home at full speed in an OS thread, for a
+    request waiting on it. Returns False without scanning if another thread
+    is already scanning the home.
+    """
+    with disk_usage_lock:
+        entry = usage_entry(home_dir)
+        if entry['scanning']:
+            return False
+        entry['scanning'] = True
+        entry['scan_delta'] = 0
+        entry['dirty_since'] = None
+
+    start_time = time.time()
+    try:
+        scanned = scan_usage(home_dir) if throttled else run_blocking(scan_usage, home_dir, False)
+    finally:
+        with disk_usage_lock:
+            entry['scanning'] = False
+
+    with disk_usage_lock:
+        if scanned is None:
+            disk_usage.pop(home_dir, None)
+            return True
+        total = scanned[0] + entry['scan_delta']
+        entry['drift'] = total - entry['bytes']
+        entry['bytes'] = total
+        entry['files'] = scanned[1]
+        entry['reconciled'] = time.time()
+        disk_usage_state['scans'] += 1
+        disk_usage_state['scan_seconds'] += time.time() - start_time
+        disk_usage_state['last_drift'] = entry['drift']
+    return True
+
+
+def homes_to_reconcile():
+    """Homes that are dirty for a while or were not rescanned within the interval"""
+    current_time = time.time()
+    with disk_usage_lock:
+        return [home_dir for home_dir, entry in disk_usage.items()
+                if entry['reconciled'] is None
+                or (entry['dirty_since'] is not None and current_time - entry['dirty_since'] >= DISK_USAGE_DIRTY_DELAY)
+                or current_time - entry['reconciled'] >= DISK_USAGE_RECONCILE_INTERVAL]
+
+
+def run_usage_reconciler():
+    """Reconciler thread main loop"""
+    while True:
+        try:
+            for home_dir in homes_to_reconcile():
+                reconcile_home(home_dir)
+        except Exception as e:
+            print(f"Disk usage reconciler error: {str(e)}")
+        time.sleep(1)
+
+
+def start_usage_reconciler():
+    """Start the reconciler thread once"""
+    with disk_usage_lock:
+        if disk_usage_state['started']:
+            return
+        disk_usage_state['started'] = True
+    threading.Thread(target=run_usage_reconciler, daemon=True).start()
+    print(f"Disk usage reconciler started (hard quota {DISK_QUOTA_HARD_BYTES} bytes)")
+
+
+def quota_status(home_dir):
+    """Usage and limits of one home, for /session"""
+    with disk_usage_lock:
+        entry = dict(usage_entry(os.path.normpath(home_dir)))
+    return {
+        'bytes': entry['bytes'],
+        'files': entry['files'],
+        'softLimit': DISK_QUOTA_SOFT_BYTES or None,
+        'hardLimit': DISK_QUOTA_HARD_BYTES or None,
+        'overSoftLimit': bool(DISK_QUOTA_SOFT_BYTES) and entry['bytes'] > DISK_QUOTA_SOFT_BYTES,
+        'overHardLimit': bool(DISK_QUOTA_HARD_BYTES) and entry['bytes'] >= DISK_QUOTA_HARD_BYTES,
+        'reconciledAt': entry['reconciled'],
+        'pendingRescan': entry['dirty_since'] is not None
+    }
+
+
+def get_disk_usage_stats():
+    """Reconciler status for health reporting"""
+    with disk_usage_lock:
+        homes = len(disk_usage)
+        total = sum(entry['bytes'] for entry in disk_usage.values())
+    return {
+        'homes': homes,
+        'bytes': total,
+        'scans': disk_usage_state['scans'],
+        'scanSeconds': round(disk_usage_state['scan_seconds'], 3),
+        'lastDrift': disk_usage_state['last_drift']
+    }
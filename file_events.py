@@ -0,0 +1,305 @@
+"""
+File change notifications pushed to Socket.IO clients.
+
+Clients subscribe to directories in their session home over their existing
+connection instead of re-requesting /files. Changes reported by file_watcher
+are collected for a short debounce window and then compared with the
+directory's last known state, so a burst of writes to one file becomes a
+single 'modified' event and a file created and removed within the window is
+not reported at all.
+"""
+
+import os
+import stat
+import threading
+from datetime import datetime
+from flask import request
+from file_watcher import watch_directory, unwatch_directory, take_snapshot
+
+FILE_EVENTS_MAX_WATCHES = int(os.environ.get('FILE_EVENTS_MAX_WATCHES', 32))  # Subscribed directories per session
+FILE_EVENTS_DEBOUNCE = float(os.environ.get('FILE_EVENTS_DEBOUNCE', 0.3))  # Seconds to coalesce changes
+FILE_EVENTS_MAX_CHANGES = 500  # Larger bursts are sent as a resync request instead of a change list
+
+# Absolute directory -> {'sids': set, 'relative': path from the home, 'snapshot': name -> (mtime_ns, size, ino)}
+subscribed_directories = {}
+# Socket ID -> {'session_id', 'directories': set of absolute directories}
+socket_subscriptions = {}
+# Absolute directory -> changed names waiting for the debounce timer (None means rescan)
+pending_changes = {}
+file_events_lock = threading.Lock()
+file_events_state = {
+    'timer': None,
+    'emit': None,
+    'changes': 0,
+    'emitted': 0
+}
+
+
+def change_entry(directory, relative_dir, name, change_type):
+    """Event payload for one entry, in the same shape as a /files listing item"""
+    entry = {
+        'type': change_type,
+        'name': name,
+        'path': os.path.join(relative_dir, name) if relative_dir else name
+    }
+    if change_type != 'deleted':
+        try:
+            entry_stat = os.lstat(os.path.join(directory, name))
+        except OSError:
+            return None
+        entry.update({
+            'is_dir': stat.S_ISDIR(entry_stat.st_mode),
+            'size': entry_stat.st_size,
+            'modified': datetime.fromtimestamp(entry_stat.st_mtime).isoformat()
+        })
+    return entry
+
+
+def entry_state(path):
+    try:
+        entry_stat = os.lstat(path)
+    except OSError:
+        return None
+    return (entry_stat.st_mtime_ns, entry_stat.st_size, entry_stat.st_ino)
+
+
+def on_subscribed_change(directory, name):
+    """File watcher callback - queue the change and start the debounce timer"""
+    with file_events_lock:
+        if directory not in subscribed_directories:
+            return
+        pending_changes.setdefault(directory, set()).add(name)
+        file_events_state['changes'] += 1
+        if file_events_state['timer'] is None:
+            timer = threading.Timer(FILE_EVENTS_DEBOUNCE, flush_pending_changes)
+            timer.daemon = True
+            file_events_state['timer'] = timer
+            timer.start()
+
+
+def diff_directory(directory, names, previous):
+    """Compare changed names with the previous state. Returns (new snapshot or None if gone, changes)."""
+    if None in names:
+        # Events may have been lost - compare the whole directory
+        snapshot = take_snapshot(directory)
+        if snapshot is None:
+            return None, []
+        names = set(previous) | set(snapshot)
+    else:
+        if not os.path.isdir(directory):
+            return None, []
+        snapshot = dict(previous)
+        for name in names:
+            state = entry_state(os.path.join(directory, name))
+            if state is None:
+                snapshot.pop(name, None)
+            else:
+                snapshot[name] = state
+
+    changes = []
+    for name in sorted(names):
+        before, after = previous.get(name), snapshot.get(name)
+        if before == after:
+            continue
+        if before is None:
+            changes.append((name, 'created'))
+        elif after is None:
+            changes.append((name, 'deleted'))
+        else:
+            changes.append((name, 'modified'))
+    return snapshot, changes
+
+
+def flush_pending_changes():
+    """Send the changes collected during the debounce window to every subscribed socket"""
+    with file_events_lock:
+        batch = dict(pending_changes)
+        pending_changes.clear()
+        file_events_state['timer'] = None
+        emit = file_events_state['emit']
+
+    for directory, names in batch.items():
+        with file_events_lock:
+            subscription = subscribed_directories.get(directory)
+            if subscription is None:
+                continue
+            previous = subscription['snapshot']
+            relative_dir = subscription['relative']
+
+        snapshot, changes = diff_directory(directory, names, previous)
+
+        if snapshot is None:
+            # The directory itself is gone - end its subscriptions
+            with file_events_lock:
+                subscription = subscribed_directories.pop(directory, None)
+                sids = subscription['sids'] if subscription else set()
+                for sid in sids:
+                    if sid in socket_subscriptions:
+                        socket_subscriptions[sid]['directories'].discard(directory)
+            unwatch_directory(directory, on_subscribed_change)
+            for sid in sids:
+                emit('files_unsubscribed', {'path': relative_dir, 'reason': 'deleted'}, to=sid)
+            continue
+
+        if None in names:
+            # The watch may have been dropped (evicted or overflowed) - make sure it is back
+            watch_directory(directory, on_subscribed_change)
+
+        with file_events_lock:
+            subscription = subscribed_directories.get(directory)
+            if subscription is None:
+                continue
+            subscription['snapshot'] = snapshot
+            sids = set(subscription['sids'])
+        if not changes:
+            continue
+
+        if len(changes) > FILE_EVENTS_MAX_CHANGES:
+            payload = {'path': relative_dir, 'resync': True, 'changes': []}
+        else:
+            entries = [change_entry(directory, relative_dir, name, change_type) for name, change_type in changes]
+            payload = {'path': relative_dir, 'resync': False, 'changes': [entry for entry in entries if entry]}
+        for sid in sids:
+            emit('file_changes', payload, to=sid)
+        file_events_state['emitted'] += len(sids)
+
+
+def subscribe_directory(sid, session_id, home_dir, target_path):
+    """
+    Subscribe a socket to changes in one directory.
+
+    Returns (subscribed directories for the socket, error message or None).
+    """
+    directory = os.path.abspath(target_path)
+    with file_events_lock:
+        subscriptions = socket_subscriptions.get(sid)
+        if subscriptions is not None and directory in subscriptions['directories']:
+            return len(subscriptions['directories']), None
+        session_watches = sum(len(other['directories']) for other in socket_subscriptions.values()
+                              if other['session_id'] == session_id)
+        if session_watches >= FILE_EVENTS_MAX_WATCHES:
+            return None, f'At most {FILE_EVENTS_MAX_WATCHES} directories can be watched per session'
+
+    if not watch_directory(directory, on_subscribed_change):
+        unwatch_directory(directory, on_subscribed_change)
+        return None, 'File watcher is not running'
+    # Taken after the watch is in place, so no change can fall between the two
+    snapshot = take_snapshot(directory) or {}
+
+    relative_dir = os.path.relpath(target_path, home_dir)
+    with file_events_lock:
+        subscription = subscribed_directories.get(directory)
+        if subscription is None:
+            subscription = subscribed_directories[directory] = {
+                'sids': set(),
+                'relative': '' if relative_dir == '.' else relative_dir,
+                'snapshot': snapshot
+            }
+        subscription['sids'].add(sid)
+        subscriptions = socket_subscriptions.setdefault(sid, {'session_id': session_id, 'directories': set()})
+        subscriptions['directories'].add(directory)
+        return len(subscriptions['directories']), None
+
+
+def unsubscribe_directory(sid, target_path):
+    """Remove one socket's subscription, and the watch once no socket uses it"""
+    directory = os.path.abspath(target_path)
+    with file_events_lock:
+        subscriptions = socket_subscriptions.get(sid)
+        if subscriptions is not None:
+            subscriptions['directories'].discard(directory)
+            if not subscriptions['directories']:
+                del socket_subscriptions[sid]
+        subscription = subscribed_directories.get(directory)
+        if subscription is None:
+            return
+        subscription['sids'].discard(sid)
+        if subscription['sids']:
+            return
+        del subscribed_directories[directory]
+        pending_changes.pop(directory, None)
+    unwatch_directory(directory, on_subscribed_change)
+
+
+def release_file_subscriptions(sid):
+    """Drop every subscription of a disconnected socket"""
+    with file_events_lock:
+        subscriptions = socket_subscriptions.get(sid)
+        directories = list(subscriptions['directories']) if subscriptions else []
+    for directory in directories:
+        unsubscribe_directory(sid, directory)
+    with file_events_lock:
+        socket_subscriptions.pop(sid, None)
+
+
+def get_file_event_stats():
+    """Subscription counts for health reporting"""
+    return {
+        'directories': len(subscribed_directories),
+        'sockets': len(socket_subscriptions),
+        'changes': file_events_state['changes'],
+        'emitted': file_events_state['emitted']
+    }
+
+
+def register_file_event_handlers(socketio, get_session):
+    """
+    Register the Socket.IO handlers for file change subscriptions.
+
+    Args:
+        socketio: The SocketIO instance
+        get_session: Function to retrieve a valid session
+    """
+    file_events_state['emit'] = socketio.emit
+
+    def resolve_subscription_path(data):
+        """Session and directory for a subscription request, or None after reporting the error"""
+        session_id = data.get('session_id')
+        if not session_id:
+            socketio.emit('error', {'error': 'No session ID provided'}, to=request.sid)
+            return None
+
+        session = get_session(session_id)
+        if not session:
+            socketio.emit('session_expired', {'message': 'Session expired or invalid'}, to=request.sid)
+            return None
+
+        path = data.get('path', '')
+        # Sanitize path to prevent path traversal
+        base_dir = session['home_dir']
+        target_path = os.path.normpath(os.path.join(base_dir, path))
+
+        # Ensure the path is within the user's home directory
+        if not target_path.startswith(base_dir):
+            socketio.emit('files_subscription_error', {'path': path, 'error': 'Invalid path'}, to=request.sid)
+            return None
+        return session_id, base_dir, path, target_path
+
+    @socketio.on('subscribe_files')
+    def handle_subscribe_files(data):
+        """Start pushing changes in a directory to this socket"""
+        resolved = resolve_subscription_path(data)
+        if resolved is None:
+            return
+        session_id, base_dir, path, target_path = resolved
+
+        if not os.path.isdir(target_path):
+            socketio.emit('files_subscription_error', {'path': path, 'error': 'Path is not a directory'},
+                          to=request.sid)
+            return
+
+        count, error = subscribe_directory(request.sid, session_id, base_dir, target_path)
+        if error:
+            socketio.emit('files_subscription_error', {'path': path, 'error': error}, to=request.sid)
+            return
+        socketio.emit('files_subscribed', {'path': path, 'subscriptions': count}, to=request.sid)
+
+    @socketio.on('unsubscribe_files')
+    def handle_unsubscribe_files(data):
+        """Stop pushing changes in a directory to this socket"""
+        resolved = resolve_subscription_path(data)
+        if resolved is None:
+            return
+        _, _, path, target_path = resolved
+        unsubscribe_directory(request.sid, target_path)
+        socketio.emit('files_unsubscribed', {'path': path, 'reason': 'requested'}, to=request.sid)
@@ -3,43 +3,810 @@ File management API endpoints for Termux-like file access.
 These endpoints provide a RESTful interface for managing files and directories.
 """
 
+import io
 import os
+import re
+import json
+import uuid
 import shutil
 import time
-from datetime import datetime
-from functools import lru_cache
-from flask import jsonify, request, send_file, make_response
+import base64
+import fnmatch
+import hashlib
+import mimetypes
+import threading
+import contextlib
+import errno
+from collections import OrderedDict
+from datetime import datetime, timezone
+from flask import jsonify, request, send_file, make_response, Response, g
+from werkzeug.http import is_resource_modified
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import ClientDisconnected, HTTPException
+from file_watcher import watch_directory
+from blocking import run_blocking
+from cache_registry import register_cache
+from disk_usage import check_quota, quota_status, tracked_paths, path_bytes
+from trash import remove_tree
+from dedup_store import dedup_enabled, add_to_store, save_stream_deduplicated
+from file_viewer import (READ_DEFAULT_BYTES, READ_MAX_BYTES, READ_DEFAULT_LINES, READ_MAX_LINES, decode_text,
+                         read_file_slice)
+from archives import ARCHIVE_FORMATS, archive_slots, stream_archive
+from file_search import (SEARCH_DEFAULT_RESULTS, SEARCH_MAX_RESULTS, SEARCH_INDEX_ENABLED, SEARCH_REGEX_MAX_LENGTH,
+                         stream_search)
+from delta_sync import (DELTA_MIN_BLOCK_SIZE, DELTA_MAX_BLOCK_SIZE, default_block_size, file_signature,
+                        validate_delta_script, apply_delta, remove_quietly)
 
 # Path cache to avoid repeated disk stats for directories that rarely change
-# Keyed by (session_id, path) and stores the directory listing with a timestamp
+# Keyed by the normalized directory path and stores the listing with a timestamp
 path_cache = {}
-PATH_CACHE_TIMEOUT = 10  # 10 seconds cache for directory listings
+PATH_CACHE_TIMEOUT = 10  # 10 seconds cache for directory listings without a file watch
+PATH_CACHE_WATCHED_TIMEOUT = 3600  # Watched listings are invalidated on change instead
 PATH_CACHE_SIZE = 100    # Maximum number of cached directory listings
 
-@lru_cache(maxsize=100)
-def get_directory_stats(dir_path, last_modified=None):
-    """Get directory stats with caching based on last modification time"""
-    # If last_modified is None or the directory has been changed, recalculate
-    if last_modified is None or os.path.getmtime(dir_path) > last_modified:
-        last_modified = os.path.getmtime(dir_path)
-        item_stats = []
-        for item in os.listdir(dir_path):
-            item_path = os.path.join(dir_path, item)
+# Simple cache for tiny hot files - everything else streams from disk
+# Keyed by the normalized file path
+small_file_cache = {}
+SMALL_FILE_CACHE_SIZE = 50     # Maximum number of files to cache
+SMALL_FILE_MAX_SIZE = 1024*16  # Only cache files under 16KB
+
+# Directory listing cache keyed by directory identity (st_dev, st_ino) and
+# validated by the directory's st_mtime_ns, in least recently used order.
+# In-place edits leave the mtime alone, so scans are only kept for long while
+# the directory is watched; others expire after PATH_CACHE_TIMEOUT.
+directory_listing_cache = OrderedDict()
+DIRECTORY_LISTING_CACHE_SIZE = 256  # Maximum number of cached directory scans
+# Directories modified this recently may change again within the same mtime
+# tick, so their scans are not cached (the same guard git uses for its index)
+DIRECTORY_LISTING_RACY_WINDOW_NS = 1_000_000_000
+directory_listing_lock = threading.Lock()
+# Bumped on every invalidation, so a scan that raced with one is not cached
+directory_listing_state = {'invalidations': 0}
+
+# Approximate memory of one listing entry dict (keys, isoformat string, ints)
+# before its name and path, used to report cache sizes to the registry
+LISTING_ENTRY_BYTES = 360
+
+def listing_size(items):
+    """Approximate bytes held by a directory listing"""
+    return sum(LISTING_ENTRY_BYTES + len(item['name']) + len(item.get('path', '')) for item in items)
+
+def trim_oldest(cache, target_bytes, entry_size, lock=None):
+    """Evict entries in insertion (or LRU) order until the cache holds at most target_bytes"""
+    with lock or contextlib.nullcontext():
+        size = sum(entry_size(entry) for entry in cache.values())
+        freed = 0
+        for key in list(cache.keys()):
+            if size - freed <= target_bytes:
+                break
+            entry = cache.pop(key, None)
+            if entry is not None:
+                freed += entry_size(entry)
+        return freed
+
+register_cache('path_cache', lambda: sum(entry['size'] for entry in list(path_cache.values())),
+               lambda: len(path_cache),
+               lambda target: trim_oldest(path_cache, target, lambda entry: entry['size']))
+register_cache('small_file_cache', lambda: sum(len(entry['data']) for entry in list(small_file_cache.values())),
+               lambda: len(small_file_cache),
+               lambda target: trim_oldest(small_file_cache, target, lambda entry: len(entry['data'])))
+register_cache('directory_listing_cache',
+               lambda: sum(entry['size'] for entry in list(directory_listing_cache.values())),
+               lambda: len(directory_listing_cache),
+               lambda target: trim_oldest(directory_listing_cache, target, lambda entry: entry['size'],
+                                          directory_listing_lock))
+
+def scan_directory(dir_path):
+    """Read a directory with os.scandir - one stat per entry, type from the DirEntry"""
+    item_stats = []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
             try:
-                item_stat = os.stat(item_path)
+                item_stat = entry.stat()
                 item_stats.append({
-                    'name': item,
-                    'path': item_path,
-                    'is_dir': os.path.isdir(item_path),
+                    'name': entry.name,
+                    'is_dir': entry.is_dir(),
                     'size': item_stat.st_size,
+                    'mtime': item_stat.st_mtime,
                     'modified': datetime.fromtimestamp(item_stat.st_mtime).isoformat()
                 })
             except (FileNotFoundError, PermissionError):
                 # Skip files that can't be accessed
                 pass
-        return item_stats, last_modified
-    return None, last_modified
+    return item_stats
+
+def load_directory_entry(dir_path):
+    """Get a directory's listing cache entry, re-scanning only when its mtime or inode changed.
+    
+    Returns (entry, cache_hit). Entries for directories inside the racy window,
+    or invalidated while being scanned, are built but not cached, and have no
+    'views'.
+    """
+    dir_stat = os.stat(dir_path)
+    cache_key = (dir_stat.st_dev, dir_stat.st_ino)
+    
+    with directory_listing_lock:
+        cached = directory_listing_cache.get(cache_key)
+        if (cached is not None and cached['mtime_ns'] == dir_stat.st_mtime_ns and
+                (cached['expires'] is None or time.time() < cached['expires'])):
+            directory_listing_cache.move_to_end(cache_key)
+            return cached, True
+    
+    # Watch before scanning, so an edit made during the scan invalidates it
+    watched = watch_directory(dir_path, on_user_file_change)
+    invalidations = directory_listing_state['invalidations']
+    items = scan_directory(dir_path)
+    entry = {
+        'mtime_ns': dir_stat.st_mtime_ns,
+        'items': items,
+        'size': listing_size(items),
+        'expires': None if watched else time.time() + PATH_CACHE_TIMEOUT
+    }
+    
+    if (time.time_ns() - dir_stat.st_mtime_ns > DIRECTORY_LISTING_RACY_WINDOW_NS and
+            directory_listing_state['invalidations'] == invalidations):
+        entry['views'] = OrderedDict()
+        with directory_listing_lock:
+            directory_listing_cache[cache_key] = entry
+            directory_listing_cache.move_to_end(cache_key)
+            while len(directory_listing_cache) > DIRECTORY_LISTING_CACHE_SIZE:
+                directory_listing_cache.popitem(last=False)
+    return entry, False
+
+def get_directory_stats(dir_path):
+    """Get directory entries, re-scanning only when the directory's mtime or inode changed.
+    
+    Returns (items, cache_hit). A hit costs a single stat of the directory.
+    Items are shared between callers and must not be modified.
+    """
+    entry, hit = load_directory_entry(dir_path)
+    return entry['items'], hit
+
+# Sorted and filtered views of a listing are cached with its scan, so paging
+# through a huge directory sorts it once rather than once per page
+LISTING_SORT_KEYS = {
+    'name': lambda item: (item['name'].lower(), item['name']),
+    'size': lambda item: (item['size'], item['name']),
+    'mtime': lambda item: (item['mtime'], item['name'])
+}
+LISTING_VIEW_CACHE_SIZE = 8      # Views kept per directory (sort order and filter combinations)
+LISTING_VIEW_ENTRY_BYTES = 16    # A list slot and a positions slot per entry
+LISTING_MAX_PAGE_SIZE = 5000     # Largest page a client may request
+
+def build_directory_view(items, sort, descending, dirs_first, pattern, kind, hidden=()):
+    """Filter and sort listing items, leaving out the names in hidden"""
+    if hidden:
+        items = [item for item in items if item['name'] not in hidden]
+    if pattern:
+        pattern = pattern.lower()
+        items = [item for item in items if fnmatch.fnmatchcase(item['name'].lower(), pattern)]
+    if kind:
+        items = [item for item in items if item['is_dir'] == (kind == 'dir')]
+    view = sorted(items, key=LISTING_SORT_KEYS[sort], reverse=descending)
+    if dirs_first:
+        view = [item for item in view if item['is_dir']] + [item for item in view if not item['is_dir']]
+    return {'items': view, 'positions': None}
+
+def get_directory_view(dir_path, sort='name', descending=False, dirs_first=True, pattern=None, kind=None,
+                       hidden=()):
+    """Sorted, filtered listing of a directory. Returns (view, version, listing_hit).
+    
+    The version is the directory's mtime, which cursors carry to detect that
+    the directory changed between pages.
+    """
+    entry, hit = load_directory_entry(dir_path)
+    view_key = (sort, descending, dirs_first, pattern, kind, hidden)
+    views = entry.get('views')
+    
+    if views is not None:
+        with directory_listing_lock:
+            view = views.get(view_key)
+            if view is not None:
+                views.move_to_end(view_key)
+                return view, entry['mtime_ns'], hit
+    
+    view = build_directory_view(entry['items'], sort, descending, dirs_first, pattern, kind, hidden)
+    
+    if views is not None:
+        with directory_listing_lock:
+            views[view_key] = view
+            entry['size'] += LISTING_VIEW_ENTRY_BYTES * len(view['items'])
+            while len(views) > LISTING_VIEW_CACHE_SIZE:
+                _, evicted = views.popitem(last=False)
+                entry['size'] -= LISTING_VIEW_ENTRY_BYTES * len(evicted['items'])
+    return view, entry['mtime_ns'], hit
+
+def encode_listing_cursor(name, index, version):
+    """Opaque cursor for the page after the entry called name"""
+    state = json.dumps({'n': name, 'i': index, 'v': version}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(state.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_listing_cursor(cursor):
+    """Decode a cursor, or return None if it is malformed"""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if isinstance(state['n'], str) and isinstance(state['i'], int) and isinstance(state['v'], int):
+            return state
+    except (ValueError, TypeError, KeyError):
+        pass
+    return None
+
+def listing_page_start(view, version, state):
+    """Index of the first entry after a cursor.
+    
+    While the directory is unchanged the cursor's index is exact. After a
+    change the page resumes after the cursor's entry by name, so entries are
+    neither skipped nor repeated because others were added or removed.
+    """
+    if state['v'] == version:
+        return min(state['i'], len(view['items']))
+    if view['positions'] is None:
+        view['positions'] = {item['name']: index for index, item in enumerate(view['items'])}
+    position = view['positions'].get(state['n'])
+    if position is None:
+        return min(state['i'], len(view['items']))
+    return position + 1
+
+def listing_item(item, relative_dir):
+    """Listing entry as returned by /files"""
+    return {
+        'name': item['name'],
+        'is_dir': item['is_dir'],
+        'size': item['size'],
+        'modified': item['modified'],
+        'path': item['name'] if relative_dir == '.' else os.path.join(relative_dir, item['name'])
+    }
+
+def invalidate_directory_listing(dir_path):
+    """Drop the cached scan of a directory.
+    
+    Needed for in-place file edits, which change an entry's size and mtime
+    without touching the directory's own mtime.
+    """
+    with directory_listing_lock:
+        directory_listing_state['invalidations'] += 1
+    try:
+        dir_stat = os.stat(dir_path)
+    except OSError:
+        return
+    with directory_listing_lock:
+        directory_listing_cache.pop((dir_stat.st_dev, dir_stat.st_ino), None)
+
+def invalidate_path(changed_path):
+    """Drop cached data for a changed file or directory.
+    
+    Removes the listing of the path itself, the listing of its parent (which
+    shows the entry's size and mtime) and any cached file body.
+    """
+    changed_path = os.path.normpath(changed_path)
+    small_file_cache.pop(changed_path, None)
+    path_cache.pop(changed_path, None)
+    path_cache.pop(os.path.dirname(changed_path), None)
+    invalidate_directory_listing(os.path.dirname(changed_path))
+
+def on_user_file_change(directory, name):
+    """File watcher callback for directories with cached listings or files"""
+    if name is None:
+        # Directory gone or events lost - drop everything cached beneath it
+        prefix = os.path.normpath(os.path.relpath(directory)) + os.sep
+        for cache in (path_cache, small_file_cache):
+            for key in [key for key in cache if key.startswith(prefix)]:
+                cache.pop(key, None)
+        invalidate_path(os.path.relpath(directory))
+        # invalidate_path only drops the parent's scan - the directory's own entries may be stale too
+        invalidate_directory_listing(os.path.relpath(directory))
+        return
+    invalidate_path(os.path.relpath(os.path.join(directory, name)))
+
+# Batch file operations. Operations run in waves: consecutive operations on
+# unrelated paths share a wave and run in parallel on a bounded pool, while an
+# operation touching a path used earlier in the wave starts a new one, so the
+# batch behaves as if run in order.
+BATCH_OPERATIONS = ('delete', 'mkdir', 'move', 'copy', 'write')
+BATCH_MAX_OPERATIONS = 500
+FILE_OPERATION_WORKERS = int(os.environ.get('FILE_OPERATION_WORKERS', 4))
+# Bounds filesystem work across all concurrent requests, not just within one
+file_operation_slots = threading.BoundedSemaphore(FILE_OPERATION_WORKERS)
+
+def quota_exceeded_response(base_dir, additional_bytes):
+    """507 response if a write would exceed the hard quota, else None - a soft quota warning becomes a header"""
+    error, warning = check_quota(base_dir, additional_bytes)
+    if error:
+        return jsonify({'error': error, 'diskUsage': quota_status(base_dir)}), 507
+    if warning:
+        g.quota_warning = warning
+    return None
+
+def run_in_parallel(func, items, workers=FILE_OPERATION_WORKERS):
+    """Call func on every item using up to workers threads and the shared file operation slots.
+    
+    Under eventlet the threads are green, so calls only overlap where func
+    hands its blocking work to run_blocking - which also keeps the hub free.
+    Returns (result, exception) pairs in item order.
+    """
+    results = [None] * len(items)
+    indexes = iter(range(len(items)))
+    indexes_lock = threading.Lock()
+    
+    def worker():
+        while True:
+            with indexes_lock:
+                index = next(indexes, None)
+            if index is None:
+                return
+            with file_operation_slots:
+                try:
+                    results[index] = (func(items[index]), None)
+                except Exception as e:
+                    results[index] = (None, e)
+    
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def resolve_home_path(base_dir, path):
+    """Normalize a path relative to a home directory, or return None if it escapes it"""
+    home = os.path.normpath(base_dir)
+    target_path = os.path.normpath(os.path.join(home, path))
+    if target_path != home and not target_path.startswith(home + os.sep):
+        return None
+    return target_path
+
+def validate_batch_operation(base_dir, index, operation):
+    """Check one operation and resolve its paths. Returns (operation, error)."""
+    if not isinstance(operation, dict):
+        return None, 'Operation must be an object'
+    kind = operation.get('op')
+    if kind not in BATCH_OPERATIONS:
+        return None, f"Unknown operation, expected one of: {', '.join(BATCH_OPERATIONS)}"
+    
+    target_path = resolve_home_path(base_dir, operation.get('path') or '')
+    if target_path is None:
+        return None, 'Invalid path'
+    if target_path == os.path.normpath(base_dir) and kind != 'mkdir':
+        return None, 'Operation not allowed on the home directory'
+    
+    resolved = {
+        'index': index,
+        'op': kind,
+        'path': operation.get('path'),
+        'target': target_path,
+        'overwrite': bool(operation.get('overwrite', False))
+    }
+    if kind in ('move', 'copy'):
+        destination = resolve_home_path(base_dir, operation.get('to') or '')
+        if destination is None or destination == os.path.normpath(base_dir):
+            return None, 'Invalid destination'
+        if destination == target_path or destination.startswith(target_path + os.sep):
+            return None, 'Destination is inside the source'
+        resolved['destination'] = destination
+    if kind == 'write':
+        content = operation.get('content')
+        if not isinstance(content, str):
+            return None, 'Content is required'
+        try:
+            resolved['data'] = (base64.b64decode(content, validate=True) if operation.get('encoding') == 'base64'
+                                else content.encode('utf-8'))
+        except ValueError:
+            return None, 'Content is not valid base64'
+    return resolved, None
+
+def operation_paths(operation):
+    """Paths an operation reads or writes"""
+    return [operation['target']] + ([operation['destination']] if 'destination' in operation else [])
+
+def batch_added_bytes(operations):
+    """Bytes a batch may add to the home: written content and copied files (copied trees are not sized)"""
+    total = 0
+    for operation in operations:
+        if operation['op'] == 'write':
+            total += len(operation['data'])
+        elif operation['op'] == 'copy':
+            total += path_bytes(operation['target']) or 0
+    return total
+
+def paths_overlap(first, second):
+    """Whether one path is the other or contains it"""
+    return first == second or first.startswith(second + os.sep) or second.startswith(first + os.sep)
+
+def batch_waves(operations):
+    """Split operations into ordered groups whose paths do not overlap"""
+    waves = []
+    wave = []
+    touched = []
+    for operation in operations:
+        paths = operation_paths(operation)
+        if any(paths_overlap(path, used) for path in paths for used in touched):
+            waves.append(wave)
+            wave = []
+            touched = []
+        wave.append(operation)
+        touched.extend(paths)
+    if wave:
+        waves.append(wave)
+    return waves
+
+def run_batch_operation(base_dir, operation):
+    """Execute one validated operation, raising OSError on failure.
+    
+    Directory deletes are a rename into the trash, which takes the trash lock,
+    so they run here; all other filesystem work runs in an OS thread.
+    """
+    target_path = operation['target']
+    if operation['op'] == 'delete' and os.path.isdir(target_path) and not os.path.islink(target_path):
+        remove_tree(base_dir, target_path)
+        return
+    run_blocking(apply_batch_operation, operation)
+
+def apply_batch_operation(operation):
+    """Filesystem work of one operation - runs in an OS thread, so it touches no shared state"""
+    kind = operation['op']
+    target_path = operation['target']
+    destination = operation.get('destination')
+    
+    if kind == 'delete':
+        os.remove(target_path)
+    elif kind == 'mkdir':
+        os.makedirs(target_path, exist_ok=True)
+    elif kind in ('move', 'copy'):
+        if not os.path.lexists(target_path):
+            raise FileNotFoundError(errno.ENOENT, 'Source does not exist')
+        if os.path.lexists(destination):
+            if not operation['overwrite']:
+                raise FileExistsError(errno.EEXIST, 'Destination exists')
+            if os.path.isdir(destination) and not os.path.islink(destination):
+                raise IsADirectoryError(errno.EISDIR, 'Destination is a directory')
+            if kind == 'copy':
+                # Copying over a file writes through it - unlink first so a link there is replaced, not followed
+                os.unlink(destination)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if kind == 'move':
+            shutil.move(target_path, destination)
+        elif os.path.isdir(target_path) and not os.path.islink(target_path):
+            shutil.copytree(target_path, destination, symlinks=True)
+        else:
+            shutil.copy2(target_path, destination, follow_symlinks=False)
+    elif kind == 'write':
+        if os.path.lexists(target_path) and not operation['overwrite']:
+            raise FileExistsError(errno.EEXIST, 'File exists')
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        temp_path = f'{target_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(operation['data'])
+            os.replace(temp_path, target_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+def batch_operation_result(operation, error=None, skipped=False):
+    """Per-operation entry of the /files/batch response"""
+    result = {'index': operation['index'], 'op': operation['op'], 'path': operation['path'], 'ok': error is None}
+    if error is not None:
+        result['error'] = error
+    if skipped:
+        result['skipped'] = True
+    return result
+
+def invalidate_batch_paths(operations):
+    """Invalidate caches for every path a batch touched, once per path"""
+    removed = set()
+    changed = set()
+    for operation in operations:
+        if operation['op'] in ('delete', 'move'):
+            removed.add(operation['target'])
+        else:
+            changed.add(operation['target'])
+        if 'destination' in operation:
+            # A copied or moved directory replaces whatever was cached beneath the destination
+            removed.add(operation['destination'])
+    for removed_path in removed:
+        on_user_file_change(os.path.abspath(removed_path), None)
+    for changed_path in changed - removed:
+        invalidate_path(changed_path)
+
+# Resumable chunked uploads. Each upload keeps a manifest and a preallocated
+# partial file under .uploads in the session home, so an interrupted upload
+# resumes from the last committed offset, even after a restart. Only one chunk
+# is in flight per request, so the total size can exceed MAX_CONTENT_LENGTH.
+UPLOAD_STAGING_DIR = '.uploads'
+UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', 2 * 1024 * 1024 * 1024))
+UPLOAD_CHUNK_MAX_SIZE = int(os.environ.get('UPLOAD_CHUNK_MAX_SIZE', 8 * 1024 * 1024))
+UPLOAD_EXPIRY = int(os.environ.get('UPLOAD_EXPIRY', 86400))  # Abandoned uploads are removed after a day
+UPLOAD_BLOCK_SIZE = 256 * 1024  # Chunks are copied from the request stream in blocks of this size
+UPLOAD_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+upload_locks = {}
+upload_locks_lock = threading.Lock()
+
+def hidden_listing_names(base_dir, target_path):
+    """Names /files leaves out of a directory - the upload staging area in the home directory"""
+    return (UPLOAD_STAGING_DIR,) if target_path == os.path.normpath(base_dir) else ()
+
+def upload_paths(base_dir, upload_id):
+    """Manifest and partial file paths for an upload"""
+    staging_dir = os.path.join(base_dir, UPLOAD_STAGING_DIR)
+    return os.path.join(staging_dir, f'{upload_id}.json'), os.path.join(staging_dir, f'{upload_id}.part')
+
+def read_upload_manifest(base_dir, upload_id):
+    """Load an upload's manifest, or None if the id is unknown"""
+    if not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+        return None
+    manifest_path, _ = upload_paths(base_dir, upload_id)
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_upload_manifest(base_dir, manifest):
+    """Replace an upload's manifest atomically, so a crash leaves the old or the new offset"""
+    manifest_path, _ = upload_paths(base_dir, manifest['uploadId'])
+    manifest['updated'] = time.time()
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def get_upload_lock(base_dir, upload_id):
+    """Lock serializing chunk writes to one upload, or None if there is no such upload.
+    
+    Locks only exist for uploads with a manifest - remove_upload drops both
+    together - so requests for made-up ids cannot grow upload_locks.
+    """
+    if not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+        return None
+    manifest_path, _ = upload_paths(base_dir, upload_id)
+    with upload_locks_lock:
+        if not os.path.exists(manifest_path):
+            return None
+        return upload_locks.setdefault(upload_id, threading.Lock())
+
+def remove_upload(base_dir, upload_id):
+    """Delete an upload's manifest, lock and partial file"""
+    manifest_path, part_path = upload_paths(base_dir, upload_id)
+    with upload_locks_lock:
+        try:
+            os.remove(manifest_path)
+        except FileNotFoundError:
+            pass
+        upload_locks.pop(upload_id, None)
+    try:
+        with tracked_paths(base_dir, part_path):
+            os.remove(part_path)
+    except FileNotFoundError:
+        pass
+
+def reap_expired_uploads(base_dir):
+    """Remove uploads in a home that have not received a chunk within UPLOAD_EXPIRY"""
+    staging_dir = os.path.join(base_dir, UPLOAD_STAGING_DIR)
+    try:
+        names = os.listdir(staging_dir)
+    except FileNotFoundError:
+        return
+    current_time = time.time()
+    for name in names:
+        upload_id, extension = os.path.splitext(name)
+        if extension != '.json':
+            continue
+        manifest = read_upload_manifest(base_dir, upload_id)
+        if manifest is None or current_time - manifest['updated'] > UPLOAD_EXPIRY:
+            remove_upload(base_dir, upload_id)
+
+def preallocate_file(path, size):
+    """Create a file and reserve size bytes, so a full disk fails the upload up front"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if size:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError) as e:
+                # Filesystems without fallocate support still get a sparse file of the right size
+                if getattr(e, 'errno', None) not in (None, errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+                os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+def write_upload_chunk(part_path, offset, stream, length, digest):
+    """Copy up to length bytes from stream into part_path at offset and flush them to disk.
+    
+    Returns the number of bytes written, which is short if the client disconnected.
+    """
+    fd = os.open(part_path, os.O_WRONLY)
+    written = 0
+    try:
+        while written < length:
+            try:
+                block = stream.read(min(UPLOAD_BLOCK_SIZE, length - written))
+            except ClientDisconnected:
+                break
+            if not block:
+                break
+            view = memoryview(block)
+            while view:
+                count = os.pwrite(fd, view, offset + written)
+                view = view[count:]
+                written += count
+            digest.update(block)
+        # Only synced bytes are committed, so a crash never advances past lost data.
+        # The sync can take a while on a busy disk, so it runs off the hub.
+        run_blocking(getattr(os, 'fdatasync', os.fsync), fd)
+    finally:
+        os.close(fd)
+    return written
+
+def file_sha256(path):
+    """SHA-256 of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Recursive tree streaming limits for /files/tree
+TREE_DEFAULT_DEPTH = 4
+TREE_MAX_DEPTH = 32
+TREE_DEFAULT_ENTRIES = 10000
+TREE_MAX_ENTRIES = 100000
+TREE_BATCH_SIZE = 500  # Entries per chunk written to the client
+
+def walk_tree(root_dir, max_depth, max_entries, ignore_patterns):
+    """Breadth-first walk of root_dir yielding NDJSON-ready dicts.
+    
+    Yields one dict per entry (top levels first, so clients can render
+    progressively), an 'error' dict per unreadable directory and a final
+    summary. Symlinked directories are listed but not followed, so the walk
+    cannot loop or leave the home directory.
+    """
+    entries = 0
+    errors = 0
+    truncated = False
+    pending = [('', 1)]
+    while pending and not truncated:
+        next_level = []
+        for relative_dir, depth in pending:
+            dir_path = os.path.join(root_dir, relative_dir) if relative_dir else root_dir
+            try:
+                with os.scandir(dir_path) as scanned:
+                    dir_entries = sorted(scanned, key=lambda entry: entry.name)
+            except OSError as e:
+                errors += 1
+                yield {'path': relative_dir, 'error': e.strerror or str(e)}
+                continue
+            
+            for entry in dir_entries:
+                if any(fnmatch.fnmatchcase(entry.name, pattern) for pattern in ignore_patterns):
+                    continue
+                if entries >= max_entries:
+                    truncated = True
+                    break
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    item_stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                entry_path = os.path.join(relative_dir, entry.name) if relative_dir else entry.name
+                entries += 1
+                yield {
+                    'path': entry_path,
+                    'name': entry.name,
+                    'is_dir': is_dir,
+                    'size': item_stat.st_size,
+                    'modified': datetime.fromtimestamp(item_stat.st_mtime).isoformat(),
+                    'depth': depth
+                }
+                if is_dir and depth < max_depth:
+                    next_level.append((entry_path, depth + 1))
+            if truncated:
+                break
+        pending = next_level
+    
+    yield {'done': True, 'entries': entries, 'truncated': truncated, 'errors': errors}
+
+def file_etag(file_stat):
+    """Strong ETag derived from a file's mtime and size, so no read is needed to validate"""
+    return f"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"
+
+# Multi-range requests are answered with multipart/byteranges only while that
+# stays cheap - beyond this many ranges, or when the ranges add up to more than
+# the file, the whole file is sent instead (RFC 9110 allows ignoring Range)
+MAX_BYTE_RANGES = 16
+RANGE_BLOCK_SIZE = 256 * 1024
+
+def parse_byte_ranges(header):
+    """Parse a Range header into (start, stop) pairs, with a negative start for suffix ranges.
+    
+    Unlike werkzeug's parser this accepts unsorted and overlapping ranges,
+    which are merged rather than refused. Returns None if malformed.
+    """
+    units, _, specs = header.partition('=')
+    if units.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        first, dash, last = spec.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if not first:
+                suffix_length = int(last)
+                if suffix_length > 0:
+                    ranges.append((-suffix_length, None))
+                continue
+            start = int(first)
+            stop = int(last) + 1 if last else None
+        except ValueError:
+            return None
+        if start < 0 or (stop is not None and stop <= start):
+            return None
+        ranges.append((start, stop))
+    return ranges
+
+def resolve_byte_ranges(requested_ranges, size):
+    """Turn parsed ranges into sorted, merged (start, stop) pairs within size"""
+    ranges = []
+    for start, stop in requested_ranges:
+        if start < 0:
+            # Suffix range - the last -start bytes
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    ranges.sort()
+    
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def if_range_matches(etag, file_mtime):
+    """Whether a Range request's If-Range validator still matches the file"""
+    if 'If-Range' not in request.headers:
+        return True
+    return not is_resource_modified(request.environ, etag=etag, ignore_if_range=False,
+                                    last_modified=datetime.fromtimestamp(file_mtime, timezone.utc))
+
+def multipart_range_response(file_path, ranges, size, mimetype, etag, file_mtime):
+    """206 multipart/byteranges response streaming each range from disk"""
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (f'--{boundary}\r\nContent-Type: {mimetype}\r\n'
+         f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode('latin-1')
+        for start, stop in ranges
+    ]
+    closing = f'--{boundary}--\r\n'.encode('latin-1')
+    content_length = (sum(len(header) + (stop - start) + 2 for header, (start, stop) in zip(part_headers, ranges)) +
+                      len(closing))
+    
+    def generate():
+        with open(file_path, 'rb') as f:
+            for header, (start, stop) in zip(part_headers, ranges):
+                yield header
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    block = f.read(min(RANGE_BLOCK_SIZE, remaining))
+                    if not block:
+                        return
+                    remaining -= len(block)
+                    yield block
+                yield b'\r\n'
+        yield closing
+    
+    response = Response(generate(), status=206, direct_passthrough=True,
+                        content_type=f'multipart/byteranges; boundary={boundary}')
+    response.headers['Content-Length'] = str(content_length)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(etag)
+    response.last_modified = file_mtime
+    return response
 
 def register_file_management_endpoints(app, get_session):
     """
@@ -50,6 +817,14 @@ def register_file_management_endpoints(app, get_session):
         get_session: Function to retrieve a valid session
     """
     
+    @app.after_request
+    def add_quota_warning(response):
+        """Tell clients writing over the soft quota, without failing the write"""
+        warning = g.get('quota_warning')
+        if warning:
+            response.headers['X-Quota-Warning'] = warning
+        return response
+    
     @app.route('/files', methods=['GET'])
     def list_files():
         """List files and directories in a path relative to the user's home directory"""
@@ -78,37 +853,45 @@ def register_file_management_endpoints(app, get_session):
             if os.path.isfile(target_path):
                 return jsonify({'error': 'Path is a file, not a directory'}), 400
             
+            # Paging, sorting or filtering serve a slice of a cached sorted view
+            if any(arg in request.args for arg in ('limit', 'cursor', 'sort', 'order', 'filter', 'type')):
+                return list_files_page(path, base_dir, target_path, start_time)
+            
             # Check if we have a valid cached response
-            cache_key = (session_id, path)
+            cache_key = target_path
             current_time = time.time()
+            cached = path_cache.get(cache_key)
             
-            if (cache_key in path_cache and 
-                current_time - path_cache[cache_key]['timestamp'] < PATH_CACHE_TIMEOUT):
+            if (cached is not None and
+                current_time - cached['timestamp'] < cached['timeout']):
                 # Use cached directory listing
-                result = path_cache[cache_key]['data']
+                result = {'path': path, 'files': cached['files']}
                 response = jsonify(result)
                 # Add performance header for debugging
                 response.headers['X-Cache'] = 'HIT'
                 response.headers['X-Response-Time'] = f"{(time.time() - start_time):.4f}s"
                 return response
             
-            # Not in cache or expired, get fresh listing
-            files = []
-            dir_items, last_modified = get_directory_stats(target_path, None)
+            # Not in cache or expired, get fresh listing (validated by the directory's mtime)
+            dir_items, listing_hit = get_directory_stats(target_path)
             
-            for item in dir_items:
-                item['path'] = os.path.relpath(item['path'], base_dir)
-                files.append(item)
+            relative_dir = os.path.relpath(target_path, base_dir)
+            hidden = hidden_listing_names(base_dir, target_path)
+            files = [listing_item(item, relative_dir) for item in dir_items if item['name'] not in hidden]
             
             result = {
                 'path': path,
                 'files': files
             }
             
-            # Store in cache with timestamp
+            # Store in cache with timestamp - watched directories are invalidated
+            # on change, so they can be kept much longer
+            watched = watch_directory(target_path, on_user_file_change)
             path_cache[cache_key] = {
-                'data': result,
-                'timestamp': current_time
+                'files': files,
+                'timestamp': current_time,
+                'timeout': PATH_CACHE_WATCHED_TIMEOUT if watched else PATH_CACHE_TIMEOUT,
+                'size': listing_size(files)
             }
             
             # Keep cache size under control
@@ -125,17 +908,270 @@ def register_file_management_endpoints(app, get_session):
             # Add performance headers
             response = jsonify(result)
             response.headers['X-Cache'] = 'MISS'
+            response.headers['X-Listing-Cache'] = 'HIT' if listing_hit else 'MISS'
             response.headers['X-Response-Time'] = f"{(time.time() - start_time):.4f}s"
             return response
             
         except Exception as e:
             return jsonify({'error': f'Failed to list files: {str(e)}'}), 500
 
-    # Simple cache for small files - don't cache large files
-    small_file_cache = {}
-    SMALL_FILE_CACHE_SIZE = 50     # Maximum number of files to cache
-    SMALL_FILE_MAX_SIZE = 1024*128 # Only cache files under 128KB
-    
+    def list_files_page(path, base_dir, target_path, start_time):
+        """One page of a directory listing, from ?limit=, ?cursor=, ?sort=, ?order=, ?filter= and ?type="""
+        sort = request.args.get('sort', 'name')
+        if sort not in LISTING_SORT_KEYS:
+            return jsonify({'error': f"Invalid sort, expected one of: {', '.join(LISTING_SORT_KEYS)}"}), 400
+        order = request.args.get('order', 'asc')
+        if order not in ('asc', 'desc'):
+            return jsonify({'error': 'Invalid order, expected asc or desc'}), 400
+        kind = request.args.get('type') or None
+        if kind not in (None, 'file', 'dir'):
+            return jsonify({'error': 'Invalid type, expected file or dir'}), 400
+        limit = request.args.get('limit', type=int)
+        if limit is not None and limit < 1:
+            return jsonify({'error': 'Invalid limit'}), 400
+        limit = min(limit or LISTING_MAX_PAGE_SIZE, LISTING_MAX_PAGE_SIZE)
+        dirs_first = request.args.get('dirsFirst', 'true').lower() != 'false'
+        
+        view, version, listing_hit = get_directory_view(target_path, sort, order == 'desc', dirs_first,
+                                                        request.args.get('filter') or None, kind,
+                                                        hidden_listing_names(base_dir, target_path))
+        
+        start = 0
+        cursor = request.args.get('cursor')
+        if cursor:
+            state = decode_listing_cursor(cursor)
+            if state is None:
+                return jsonify({'error': 'Invalid cursor'}), 400
+            start = listing_page_start(view, version, state)
+        
+        page = view['items'][start:start + limit]
+        end = start + len(page)
+        relative_dir = os.path.relpath(target_path, base_dir)
+        
+        response = jsonify({
+            'path': path,
+            'files': [listing_item(item, relative_dir) for item in page],
+            'total': len(view['items']),
+            'nextCursor': encode_listing_cursor(page[-1]['name'], end, version) if end < len(view['items']) else None
+        })
+        response.headers['X-Listing-Cache'] = 'HIT' if listing_hit else 'MISS'
+        response.headers['X-Response-Time'] = f"{(time.time() - start_time):.4f}s"
+        return response
+
+    @app.route('/files/tree', methods=['GET'])
+    def file_tree():
+        """Stream a recursive listing as newline-delimited JSON while walking the directory"""
+        session_id = request.headers.get('X-Session-Id')
+        if not session_id:
+            return jsonify({'error': 'Session ID is required'}), 400
+            
+        session = get_session(session_id)
+        if not session:
+            return jsonify({'error': 'Invalid or expired session'}), 401
+        
+        path = request.args.get('path', '')
+        # Sanitize path to prevent path traversal
+        base_dir = session['home_dir']
+        target_path = os.path.normpath(os.path.join(base_dir, path))
+        
+        # Ensure the path is within the user's home directory
+        if not target_path.startswith(base_dir):
+            return jsonify({'error': 'Invalid path'}), 403
+        
+        if not os.path.isdir(target_path):
+            return jsonify({'error': 'Path is not a directory'}), 404
+        
+        depth = request.args.get('depth', TREE_DEFAULT_DEPTH, type=int)
+        max_entries = request.args.get('limit', TREE_DEFAULT_ENTRIES, type=int)
+        if depth < 1 or max_entries < 1:
+            return jsonify({'error': 'depth and limit must be positive'}), 400
+        depth = min(depth, TREE_MAX_DEPTH)
+        max_entries = min(max_entries, TREE_MAX_ENTRIES)
+        # Comma-separated glob patterns matched against entry names; upload staging is always hidden
+        ignore_patterns = [pattern.strip() for pattern in request.args.get('ignore', '').split(',') if pattern.strip()]
+        ignore_patterns.append(UPLOAD_STAGING_DIR)
+        
+        def generate():
+            batch = []
+            for item in walk_tree(target_path, depth, max_entries, ignore_patterns):
+                batch.append(json.dumps(item, separators=(',', ':')))
+                if len(batch) >= TREE_BATCH_SIZE:
+                    yield '\n'.join(batch) + '\n'
+                    batch = []
+            if batch:
+                yield '\n'.join(batch) + '\n'
+        
+        response = Response(generate(), mimetype='application/x-ndjson')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    @app.route('/files/archive', methods=['GET'])
+    def download_archive():
+        """Stream a zip or tar.gz archive of a directory without a temporary file"""
+        session_id = request.headers.get('X-Session-Id')
+        if not session_id:
+            return jsonify({'error': 'Session ID is required'}), 400
+            
+        session = get_session(session_id)
+        if not session:
+            return jsonify({'error': 'Invalid or expired session'}), 401
+        
+        path = request.args.get('path', '')
+        archive_format = request.args.get('format', 'zip')
+        if archive_format not in ARCHIVE_FORMATS:
+            return jsonify({'error': f"Invalid format, expected one of: {', '.join(ARCHIVE_FORMATS)}"}), 400
+        
+        # Sanitize path to prevent path traversal
+        base_dir = session['home_dir']
+        target_path = os.path.normpath(os.path.join(base_dir, path))
+        
+        # Ensure the path is within the user's home directory
+        if not target_path.startswith(base_dir):
+            return jsonify({'error': 'Invalid path'}), 403
+        
+        if not os.path.isdir(target_path):
+            return jsonify({'error': 'Path is not a directory'}), 404
+        
+        # Each archive keeps a worker compressing until it is sent, so only a
+        # few may run at once - the rest are told to retry
+        if not archive_slots.acquire(blocking=False):
+            response = jsonify({'error': 'Too many archives in progress, try again shortly'})
+            response.status_code = 503
+            response.headers['Retry-After'] = '5'
+            return response
+        
+        try:
+            mimetype, extension = ARCHIVE_FORMATS[archive_format]
+            arc_root = os.path.basename(target_path) if target_path != os.path.normpath(base_dir) else 'home'
+            response = Response(stream_archive(archive_format, target_path, arc_root, exclude={UPLOAD_STAGING_DIR}),
+                                mimetype=mimetype)
+        except Exception:
+            archive_slots.release()
+            raise
+        # Released when the server closes the response, including on client
+        # disconnect and for HEAD requests whose body is never generated
+        response.call_on_close(archive_slots.release)
+        response.headers['Content-Disposition'] = f'attachment; filename="{arc_root}{extension}"'
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    @app.route('/files/search', methods=['GET'])
+    def search_files():
+        """Stream filename or content matches below a directory as newline-delimited JSON"""
+        session_id = request.headers.get('X-Session-Id')
+        if not session_id:
+            return jsonify({'error': 'Session ID is required'}), 400
+            
+        session = get_session(session_id)
+        if not session:
+            return jsonify({'error': 'Invalid or expired session'}), 401
+        
+        query = request.args.get('q', '')
+        if not query:
+            return jsonify({'error': 'q is required'}), 400
+        mode = request.args.get('mode', 'content')
+        if mode not in ('content', 'name'):
+            return jsonify({'error': 'Invalid mode, expected content or name'}), 400
+        max_results = request.args.get('limit', SEARCH_DEFAULT_RESULTS, type=int)
+        if max_results < 1:
+            return jsonify({'error': 'limit must be positive'}), 400
+        max_results = min(max_results, SEARCH_MAX_RESULTS)
+        is_regex = request.args.get('regex', 'false').lower() == 'true'
+        case_sensitive = request.args.get('case', 'false').lower() == 'true'
+        use_index = request.args.get('index', str(SEARCH_INDEX_ENABLED)).lower() == 'true'
+        
+        if is_regex and len(query) > SEARCH_REGEX_MAX_LENGTH:
+            return jsonify({'error': f'Regular expressions are limited to {SEARCH_REGEX_MAX_LENGTH} characters'}), 400
+        
+        flags = re.MULTILINE if case_sensitive else re.MULTILINE | re.IGNORECASE
+        try:
+            pattern = re.compile(query if is_regex else re.escape(query), flags)
+        except re.error as e:
+            return jsonify({'error': f'Invalid regular expression: {str(e)}'}), 400
+        
+        path = request.args.get('path', '')
+        # Sanitize path to prevent path traversal
+        base_dir = session['home_dir']
+        target_path = os.path.normpath(os.path.join(base_dir, path))
+        
+        # Ensure the path is within the user's home directory
+        if not target_path.startswith(base_dir):
+            return jsonify({'error': 'Invalid path'}), 403
+        
+        if not os.path.isdir(target_path):
+            return jsonify({'error': 'Path is not a directory'}), 404
+        
+        # Comma-separated glob patterns: files to search, and names to leave out
+        include = [pattern.strip() for pattern in request.args.get('glob', '').split(',') if pattern.strip()]
+        ignore_patterns = [pattern.strip() for pattern in request.args.get('ignore', '').split(',') if pattern.strip()]
+        ignore_patterns.append(UPLOAD_STAGING_DIR)
+        
+        def generate():
+            # Files are read in OS threads, on the slots shared with batch operations
+            for results in stream_search(base_dir, target_path, pattern, FILE_OPERATION_WORKERS, file_operation_slots,
+                                         run_blocking, mode, None if is_regex else query, include, ignore_patterns,
+                                         max_results, use_index):
+                yield ''.join(json.dumps(result, separators=(',', ':')) + '\n' for result in results)
+        
+        response = Response(generate(), mimetype='application/x-ndjson')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    @app.route('/files/read', methods=['GET'])
+    def read_file():
+        """Return part of a file: a byte range, a range of lines, or the last lines"""
+        session_id = request.headers.get('X-Session-Id')
+        if not session_id:
+            return jsonify({'error': 'Session ID is required'}), 400
+            
+        session = get_session(session_id)
+        if not session:
+            return jsonify({'error': 'Invalid or expired session'}), 401
+        
+        path = request.args.get('path', '')
+        mode = request.args.get('mode', 'bytes')
+        if mode not in ('bytes', 'lines', 'tail'):
+            return jsonify({'error': 'mode must be bytes, lines or tail'}), 400
+        offset = request.args.get('offset', 0, type=int)
+        length = request.args.get('length', READ_DEFAULT_BYTES, type=int)
+        start_line = request.args.get('start', 1, type=int)
+        count = request.args.get('lines', READ_DEFAULT_LINES, type=int)
+        if length < 1 or start_line < 1 or not 1 <= count <= READ_MAX_LINES:
+            return jsonify({'error': f'length and start must be positive, lines between 1 and {READ_MAX_LINES}'}), 400
+        
+        # Sanitize path to prevent path traversal
+        base_dir = session['home_dir']
+        file_path = os.path.normpath(os.path.join(base_dir, path))
+        
+        # Ensure the path is within the user's home directory
+        if not file_path.startswith(base_dir):
+            return jsonify({'error': 'Invalid path'}), 403
+        
+        if not os.path.isfile(file_path):
+            return jsonify({'error': 'File not found'}), 404
+        
+        result = {'path': os.path.relpath(file_path, base_dir), 'mode': mode}
+        try:
+            # A cold line index can mean scanning a multi-GB log - keep that off the hub
+            file_stat, start, data, fields = run_blocking(read_file_slice, file_path, mode, offset, length,
+                                                          start_line, count)
+        except OSError as e:
+            return jsonify({'error': f'Failed to read file: {str(e)}'}), 500
+        
+        file_size = file_stat.st_size
+        result.update(fields)
+        result.update({
+            'size': file_size,
+            'etag': file_etag(file_stat),
+            'offset': start,
+            'nextOffset': start + len(data),
+            'eof': start + len(data) >= file_size,
+            'content': decode_text(data)
+        })
+        response = jsonify(result)
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
     @app.route('/files/download', methods=['GET'])
     def download_file():
         """Download a file from the user's directory"""
@@ -171,9 +1207,42 @@ def register_file_management_endpoints(app, get_session):
                 return jsonify({'error': 'Path is not a file'}), 400
             
             # Check file size for caching decision
-            file_size = os.path.getsize(target_path)
-            file_mtime = os.path.getmtime(target_path)
-            cache_key = f"{session_id}:{path}"
+            file_stat = os.stat(target_path)
+            file_size = file_stat.st_size
+            file_mtime = file_stat.st_mtime
+            etag = file_etag(file_stat)
+            cache_key = target_path
+            
+            # Single ranges and If-None-Match/If-Modified-Since are handled by
+            # make_conditional below. Several ranges need a multipart body,
+            # unless the file is unchanged for a conditional GET (304 first).
+            requested_ranges = parse_byte_ranges(request.headers.get('Range', ''))
+            if requested_ranges is not None and len(requested_ranges) > 1 and not (
+                    is_resource_modified(request.environ, etag=etag,
+                                         last_modified=datetime.fromtimestamp(file_mtime, timezone.utc)) and
+                    if_range_matches(etag, file_mtime)):
+                # A 304, or the whole file when If-Range does not match - make_conditional
+                # rejects several ranges with 416, so it must not see them
+                request.environ.pop('HTTP_RANGE', None)
+            elif requested_ranges is not None and len(requested_ranges) > 1:
+                ranges = resolve_byte_ranges(requested_ranges, file_size)
+                if not ranges:
+                    response = jsonify({'error': 'Requested range not satisfiable'})
+                    response.status_code = 416
+                    response.headers['Content-Range'] = f'bytes */{file_size}'
+                    return response
+                if len(ranges) > 1 and len(ranges) <= MAX_BYTE_RANGES and sum(stop - start for start, stop in ranges) <= file_size:
+                    part_type = content_type or mimetypes.guess_type(target_path)[0] or 'application/octet-stream'
+                    response = multipart_range_response(target_path, ranges, file_size, part_type, etag, file_mtime)
+                    response.headers['X-Response-Time'] = f"{(time.time() - start_time):.4f}s"
+                    return response
+                if len(ranges) == 1:
+                    # Overlapping ranges merged into one - serve it as a plain range
+                    start, stop = ranges[0]
+                    request.environ['HTTP_RANGE'] = f'bytes={start}-{stop - 1}'
+                else:
+                    # Too many ranges to be worth it - send the whole file
+                    request.environ.pop('HTTP_RANGE', None)
             
             # For small text files, we use caching
             if file_size <= SMALL_FILE_MAX_SIZE and path.endswith(('.txt', '.md', '.json', '.yml', '.yaml', '.csv', '.log')):
@@ -187,6 +1256,10 @@ def register_file_management_endpoints(app, get_session):
                     response = make_response(file_data)
                     response.headers['Content-Type'] = mimetype
                     response.headers['Content-Disposition'] = f'attachment; filename="{os.path.basename(target_path)}"'
+                    response.set_etag(etag)
+                    response.last_modified = file_mtime
+                    response.make_conditional(request, accept_ranges=True, complete_length=len(file_data))
+                    response.headers['Accept-Ranges'] = 'bytes'
                     response.headers['X-Cache'] = 'HIT'
                     response.headers['X-Response-Time'] = f"{(time.time() - start_time):.4f}s"
                     return response
@@ -208,7 +1281,9 @@ def register_file_management_endpoints(app, get_session):
                 elif path.endswith(('.yml', '.yaml')):
                     mimetype = 'application/x-yaml'
                 
-                # Store in cache
+                # Store in cache - entries are still validated by mtime, the
+                # watch only releases the memory as soon as the file changes
+                watch_directory(os.path.dirname(target_path), on_user_file_change)
                 small_file_cache[cache_key] = {
                     'data': file_data,
                     'mtime': file_mtime,
@@ -226,19 +1301,33 @@ def register_file_management_endpoints(app, get_session):
                 response = make_response(file_data)
                 response.headers['Content-Type'] = mimetype
                 response.headers['Content-Disposition'] = f'attachment; filename="{os.path.basename(target_path)}"'
+                response.set_etag(etag)
+                response.last_modified = file_mtime
+                response.make_conditional(request, accept_ranges=True, complete_length=len(file_data))
+                response.headers['Accept-Ranges'] = 'bytes'
                 response.headers['X-Cache'] = 'MISS'
                 response.headers['X-Response-Time'] = f"{(time.time() - start_time):.4f}s"
                 return response
             
-            # For larger or binary files, use the standard send_file
+            # For larger or binary files, send_file hands the open file to the
+            # server's wsgi.file_wrapper (sendfile where available) and answers
+            # conditional requests from the same mtime/size validator
             response = send_file(
-                target_path, 
+                os.path.abspath(target_path), 
                 as_attachment=True,
-                mimetype=content_type
+                mimetype=content_type,
+                etag=etag,
+                last_modified=file_mtime,
+                conditional=True
             )
+            # send_file only advertises ranges on 206 responses
+            response.headers['Accept-Ranges'] = 'bytes'
             response.headers['X-Response-Time'] = f"{(time.time() - start_time):.4f}s"
             return response
             
+        except HTTPException:
+            # 416 Range Not Satisfiable from make_conditional/send_file
+            raise
         except Exception as e:
             return jsonify({'error': f'Failed to download file: {str(e)}'}), 500
 
@@ -276,8 +1365,17 @@ def register_file_management_endpoints(app, get_session):
         filename = secure_filename(file.filename)
         file_path = os.path.join(target_dir, filename)
         
+        quota_error = quota_exceeded_response(base_dir, request.content_length or 0)
+        if quota_error:
+            return quota_error
+        
         try:
-            file.save(file_path)
+            with tracked_paths(base_dir, file_path):
+                if dedup_enabled():
+                    save_stream_deduplicated(base_dir, file.stream, file_path)
+                else:
+                    file.save(file_path)
+            invalidate_path(file_path)
             return jsonify({
                 'message': 'File uploaded successfully',
                 'path': os.path.relpath(file_path, base_dir),
@@ -287,6 +1385,131 @@ def register_file_management_endpoints(app, get_session):
         except Exception as e:
             return jsonify({'error': f'Failed to upload file: {str(e)}'}), 500
 
+    @app.route('/files/signature', methods=['GET'])
+    def get_file_signature():
+        """Block checksums of a file, for building a delta upload"""
+        session_id = request.headers.get('X-Session-Id')
+        if not session_id:
+            return jsonify({'error': 'Session ID is required'}), 400
+            
+        session = get_session(session_id)
+        if not session:
+            return jsonify({'error': 'Invalid or expired session'}), 401
+        
+        path = request.args.get('path', '')
+        # Sanitize path to prevent path traversal
+        base_dir = session['home_dir']
+        file_path = os.path.normpath(os.path.join(base_dir, path))
+        
+        # Ensure the path is within the user's home directory
+        if not file_path.startswith(base_dir):
+            return jsonify({'error': 'Invalid path'}), 403
+        
+        if not os.path.isfile(file_path):
+            return jsonify({'error': 'File not found'}), 404
+        
+        try:
+            file_stat = os.stat(file_path)
+            block_size = request.args.get('blockSize', default_block_size(file_stat.st_size), type=int)
+            if not DELTA_MIN_BLOCK_SIZE <= block_size <= DELTA_MAX_BLOCK_SIZE:
+                return jsonify({'error': f'blockSize must be between {DELTA_MIN_BLOCK_SIZE} and {DELTA_MAX_BLOCK_SIZE}'}), 400
+            with file_operation_slots:
+                weak, strong = run_blocking(file_signature, file_path, block_size)
+            # A file that changed while it was read has no consistent signature
+            if file_etag(os.stat(file_path)) != file_etag(file_stat):
+                return jsonify({'error': 'File changed while computing its signature, try again'}), 409
+        except OSError as e:
+            return jsonify({'error': f'Failed to compute signature: {str(e)}'}), 500
+        
+        response = jsonify({
+            'path': os.path.relpath(file_path, base_dir),
+            'size': file_stat.st_size,
+            'etag': file_etag(file_stat),
+            'blockSize': block_size,
+            'weak': weak,
+            'strong': strong
+        })
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    @app.route('/files/delta', methods=['POST'])
+    def upload_file_delta():
+        """Rebuild a file from its current version and the changed blocks uploaded by the client"""
+        session_id = request.headers.get('X-Session-Id')
+        if not session_id:
+            return jsonify({'error': 'Session ID is required'}), 400
+            
+        session = get_session(session_id)
+        if not session:
+            return jsonify({'error': 'Invalid or expired session'}), 401
+        
+        path = request.form.get('path', '')
+        # Sanitize path to prevent path traversal
+        base_dir = session['home_dir']
+        file_path = os.path.normpath(os.path.join(base_dir, path))
+        
+        # Ensure the path is within the user's home directory
+        if not file_path.startswith(base_dir):
+            return jsonify({'error': 'Invalid path'}), 403
+        
+        if not os.path.isfile(file_path):
+            return jsonify({'error': 'File not found, upload it in full instead'}), 404
+        
+        try:
+            script = json.loads(request.form.get('script', ''))
+        except ValueError:
+            return jsonify({'error': 'script must be valid JSON'}), 400
+        
+        # Literal bytes for the data ops, concatenated in op order. Parsing the form
+        # reads them off the socket here, into memory or a spooled temporary file,
+        # so apply_delta only does file work and can run in an OS thread.
+        data = request.files.get('data')
+        data_stream = data.stream if data is not None else io.BytesIO()
+        data_stream.seek(0, os.SEEK_END)
+        data_length = data_stream.tell()
+        data_stream.seek(0)
+        
+        temp_path = None
+        try:
+            base_stat = os.stat(file_path)
+            if not isinstance(script, dict) or script.get('baseEtag') != file_etag(base_stat):
+                return jsonify({'error': 'File changed since its signature was taken',
+                                'etag': file_etag(base_stat)}), 409
+            ops, error = validate_delta_script(script, base_stat.st_size, data_length, UPLOAD_MAX_SIZE)
+            if error:
+                return jsonify({'error': error}), 400
+            quota_error = quota_exceeded_response(base_dir, script['size'] - base_stat.st_size)
+            if quota_error:
+                return quota_error
+            
+            with file_operation_slots:
+                temp_path, checksum, error = run_blocking(apply_delta, file_path, ops, data_stream, base_stat)
+            if error:
+                return jsonify({'error': error, 'etag': file_etag(os.stat(file_path))}), 409
+            expected_checksum = (script.get('checksum') or '').lower()
+            if expected_checksum and checksum != expected_checksum:
+                remove_quietly(temp_path)
+                return jsonify({'error': 'Checksum mismatch'}), 422
+            with tracked_paths(base_dir, file_path):
+                os.replace(temp_path, file_path)
+            invalidate_path(file_path)
+        except OSError as e:
+            if temp_path:
+                remove_quietly(temp_path)
+            return jsonify({'error': f'Failed to apply delta: {str(e)}'}), 500
+        
+        transferred = request.content_length or data_length
+        return jsonify({
+            'message': 'File updated successfully',
+            'path': os.path.relpath(file_path, base_dir),
+            'size': script['size'],
+            'checksum': checksum,
+            'etag': file_etag(os.stat(file_path)),
+            'bytesUploaded': transferred,
+            'bytesReused': script['size'] - data_length,
+            'bytesSaved': max(0, script['size'] - transferred)
+        })
+
     @app.route('/files', methods=['DELETE'])
     def delete_file():
         """Delete a file or directory from the user's directory"""
@@ -315,10 +1538,15 @@ def register_file_management_endpoints(app, get_session):
                 return jsonify({'error': 'Path does not exist'}), 404
                 
             if os.path.isfile(target_path):
-                os.remove(target_path)
+                with tracked_paths(base_dir, target_path):
+                    os.remove(target_path)
+                invalidate_path(target_path)
                 return jsonify({'message': 'File deleted successfully'})
             else:
-                shutil.rmtree(target_path)
+                # Renamed into the trash and reaped in the background, so large trees return at once
+                with tracked_paths(base_dir, target_path):
+                    remove_tree(base_dir, target_path)
+                on_user_file_change(os.path.abspath(target_path), None)
                 return jsonify({'message': 'Directory deleted successfully'})
         except Exception as e:
             return jsonify({'error': f'Failed to delete: {str(e)}'}), 500
@@ -347,9 +1575,286 @@ def register_file_management_endpoints(app, get_session):
         
         try:
             os.makedirs(target_path, exist_ok=True)
+            invalidate_path(target_path)
             return jsonify({
                 'message': 'Directory created successfully',
                 'path': os.path.relpath(target_path, base_dir)
             })
         except Exception as e:
             return jsonify({'error': f'Failed to create directory: {str(e)}'}), 500
+
+    @app.route('/files/batch', methods=['POST'])
+    def batch_file_operations():
+        """Run an ordered list of delete, mkdir, move, copy and write operations"""
+        session_id = request.headers.get('X-Session-Id')
+        if not session_id:
+            return jsonify({'error': 'Session ID is required'}), 400
+            
+        session = get_session(session_id)
+        if not session:
+            return jsonify({'error': 'Invalid or expired session'}), 401
+        
+        data = request.json or {}
+        operations = data.get('operations')
+        if not isinstance(operations, list) or not operations:
+            return jsonify({'error': 'A list of operations is required'}), 400
+        if len(operations) > BATCH_MAX_OPERATIONS:
+            return jsonify({'error': f'At most {BATCH_MAX_OPERATIONS} operations per batch'}), 400
+        stop_on_error = bool(data.get('stopOnError', False))
+        
+        # Validate every path before touching the filesystem
+        base_dir = session['home_dir']
+        resolved = []
+        invalid = []
+        for index, operation in enumerate(operations):
+            operation, error = validate_batch_operation(base_dir, index, operation)
+            if error:
+                invalid.append({'index': index, 'error': error})
+            else:
+                resolved.append(operation)
+        if invalid:
+            return jsonify({'error': 'Invalid operations', 'invalid': invalid}), 400
+        
+        quota_error = quota_exceeded_response(base_dir, batch_added_bytes(resolved))
+        if quota_error:
+            return quota_error
+        
+        def run_tracked_operation(operation):
+            with tracked_paths(base_dir, *operation_paths(operation)):
+                run_batch_operation(base_dir, operation)
+        
+        results = {}
+        failed = False
+        executed = []
+        # Stopping at the first failure needs a strict order, so it runs one operation at a time
+        waves = [[operation] for operation in resolved] if stop_on_error else batch_waves(resolved)
+        for wave in waves:
+            if failed and stop_on_error:
+                for operation in wave:
+                    results[operation['index']] = batch_operation_result(
+                        operation, 'Skipped after an earlier failure', skipped=True)
+                continue
+            for operation, (_, error) in zip(wave, run_in_parallel(run_tracked_operation, wave)):
+                if error is None:
+                    results[operation['index']] = batch_operation_result(operation)
+                else:
+                    failed = True
+                    results[operation['index']] = batch_operation_result(
+                        operation, getattr(error, 'strerror', None) or str(error))
+                executed.append(operation)
+        
+        invalidate_batch_paths(executed)
+        
+        ordered = [results[index] for index in range(len(resolved))]
+        return jsonify({
+            'results': ordered,
+            'succeeded': sum(1 for result in ordered if result['ok']),
+            'failed': sum(1 for result in ordered if not result['ok'])
+        })
+
+    def get_upload_session():
+        """Resolve the request's session, or return (None, error response)"""
+        session_id = request.headers.get('X-Session-Id')
+        if not session_id:
+            return None, (jsonify({'error': 'Session ID is required'}), 400)
+            
+        session = get_session(session_id)
+        if not session:
+            return None, (jsonify({'error': 'Invalid or expired session'}), 401)
+        return session, None
+
+    @app.route('/files/uploads', methods=['POST'])
+    def create_upload():
+        """Start a resumable upload and preallocate its file"""
+        session, error = get_upload_session()
+        if error:
+            return error
+        
+        data = request.json or {}
+        filename = secure_filename(data.get('name', ''))
+        if not filename:
+            return jsonify({'error': 'File name is required'}), 400
+        
+        size = data.get('size')
+        if not isinstance(size, int) or size < 0:
+            return jsonify({'error': 'File size is required'}), 400
+        if size > UPLOAD_MAX_SIZE:
+            return jsonify({'error': f'File exceeds the {UPLOAD_MAX_SIZE} byte upload limit'}), 413
+        
+        # Sanitize path to prevent path traversal
+        base_dir = session['home_dir']
+        target_dir = os.path.normpath(os.path.join(base_dir, data.get('path', '')))
+        
+        # Ensure the path is within the user's home directory
+        if not target_dir.startswith(base_dir):
+            return jsonify({'error': 'Invalid path'}), 403
+        
+        # The preallocated file counts against the quota from the start
+        quota_error = quota_exceeded_response(base_dir, size)
+        if quota_error:
+            return quota_error
+        
+        try:
+            reap_expired_uploads(base_dir)
+            os.makedirs(os.path.join(base_dir, UPLOAD_STAGING_DIR), exist_ok=True)
+            
+            upload_id = uuid.uuid4().hex
+            _, part_path = upload_paths(base_dir, upload_id)
+            with tracked_paths(base_dir, part_path):
+                preallocate_file(part_path, size)
+            manifest = {
+                'uploadId': upload_id,
+                'path': os.path.relpath(os.path.join(target_dir, filename), base_dir),
+                'size': size,
+                'offset': 0,
+                'checksum': (data.get('checksum') or '').lower() or None,
+                'created': time.time()
+            }
+            write_upload_manifest(base_dir, manifest)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                return jsonify({'error': 'Not enough disk space for upload'}), 507
+            return jsonify({'error': f'Failed to start upload: {str(e)}'}), 500
+        
+        return jsonify({
+            'uploadId': upload_id,
+            'path': manifest['path'],
+            'size': size,
+            'offset': 0,
+            'chunkSize': UPLOAD_CHUNK_MAX_SIZE
+        }), 201
+
+    @app.route('/files/uploads/<upload_id>', methods=['GET'])
+    def get_upload_status(upload_id):
+        """Report the committed offset, where an interrupted upload resumes"""
+        session, error = get_upload_session()
+        if error:
+            return error
+        
+        manifest = read_upload_manifest(session['home_dir'], upload_id)
+        if manifest is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        return jsonify({
+            'uploadId': upload_id,
+            'path': manifest['path'],
+            'size': manifest['size'],
+            'offset': manifest['offset'],
+            'chunkSize': UPLOAD_CHUNK_MAX_SIZE
+        })
+
+    @app.route('/files/uploads/<upload_id>', methods=['PUT'])
+    def put_upload_chunk(upload_id):
+        """Write the request body at ?offset=, which must be the committed offset"""
+        session, error = get_upload_session()
+        if error:
+            return error
+        
+        base_dir = session['home_dir']
+        offset = request.args.get('offset', type=int)
+        length = request.content_length
+        if offset is None:
+            return jsonify({'error': 'Offset is required'}), 400
+        if length is None:
+            return jsonify({'error': 'Content-Length is required'}), 411
+        if length > UPLOAD_CHUNK_MAX_SIZE:
+            return jsonify({'error': f'Chunk exceeds {UPLOAD_CHUNK_MAX_SIZE} bytes'}), 413
+        
+        upload_lock = get_upload_lock(base_dir, upload_id)
+        if upload_lock is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        with upload_lock:
+            manifest = read_upload_manifest(base_dir, upload_id)
+            if manifest is None:
+                return jsonify({'error': 'Upload not found'}), 404
+            if offset != manifest['offset']:
+                # The client lost track of what was committed - tell it where to resume
+                return jsonify({'error': 'Offset does not match the committed offset',
+                                'offset': manifest['offset']}), 409
+            if offset + length > manifest['size']:
+                return jsonify({'error': 'Chunk extends past the declared file size'}), 400
+            
+            expected_checksum = request.headers.get('X-Chunk-Checksum')
+            digest = hashlib.sha256()
+            _, part_path = upload_paths(base_dir, upload_id)
+            try:
+                written = write_upload_chunk(part_path, offset, request.stream, length, digest)
+            except OSError as e:
+                return jsonify({'error': f'Failed to write chunk: {str(e)}'}), 500
+            
+            if expected_checksum:
+                # A verified chunk is all or nothing - the bytes are simply overwritten on retry
+                if written != length or digest.hexdigest() != expected_checksum.lower():
+                    return jsonify({'error': 'Chunk checksum mismatch', 'offset': offset}), 422
+            manifest['offset'] = offset + written
+            write_upload_manifest(base_dir, manifest)
+        
+        if written != length:
+            return jsonify({'error': 'Incomplete chunk', 'offset': manifest['offset']}), 400
+        return jsonify({
+            'uploadId': upload_id,
+            'size': manifest['size'],
+            'offset': manifest['offset'],
+            'complete': manifest['offset'] == manifest['size']
+        })
+
+    @app.route('/files/uploads/<upload_id>/complete', methods=['POST'])
+    def complete_upload(upload_id):
+        """Verify a fully received upload and move it into place"""
+        session, error = get_upload_session()
+        if error:
+            return error
+        
+        base_dir = session['home_dir']
+        upload_lock = get_upload_lock(base_dir, upload_id)
+        if upload_lock is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        with upload_lock:
+            manifest = read_upload_manifest(base_dir, upload_id)
+            if manifest is None:
+                return jsonify({'error': 'Upload not found'}), 404
+            if manifest['offset'] != manifest['size']:
+                return jsonify({'error': 'Upload is incomplete', 'offset': manifest['offset']}), 409
+            
+            data = request.get_json(silent=True) or {}
+            checksum = (data.get('checksum') or manifest['checksum'] or '').lower()
+            _, part_path = upload_paths(base_dir, upload_id)
+            file_path = os.path.normpath(os.path.join(base_dir, manifest['path']))
+            try:
+                digest = run_blocking(file_sha256, part_path) if checksum or dedup_enabled(manifest['size']) else None
+                if checksum and digest != checksum:
+                    return jsonify({'error': 'Checksum mismatch'}), 422
+                
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with tracked_paths(base_dir, part_path, file_path):
+                    if dedup_enabled(manifest['size']):
+                        add_to_store(base_dir, part_path, digest, file_path)
+                    else:
+                        os.replace(part_path, file_path)
+                remove_upload(base_dir, upload_id)
+                invalidate_path(file_path)
+            except OSError as e:
+                return jsonify({'error': f'Failed to complete upload: {str(e)}'}), 500
+        
+        return jsonify({
+            'message': 'File uploaded successfully',
+            'path': manifest['path'],
+            'name': os.path.basename(file_path),
+            'size': manifest['size']
+        })
+
+    @app.route('/files/uploads/<upload_id>', methods=['DELETE'])
+    def abort_upload(upload_id):
+        """Abandon an upload and release its preallocated space"""
+        session, error = get_upload_session()
+        if error:
+            return error
+        
+        base_dir = session['home_dir']
+        upload_lock = get_upload_lock(base_dir, upload_id)
+        if upload_lock is None:
+            return jsonify({'error': 'Upload not found'}), 404
+        with upload_lock:
+            if read_upload_manifest(base_dir, upload_id) is None:
+                return jsonify({'error': 'Upload not found'}), 404
+            remove_upload(base_dir, upload_id)
+        return jsonify({'message': 'Upload aborted'})
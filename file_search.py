@@ -0,0 +1,399 @@
+"""
+Filename and content search across a session's home directory.
+
+Files are scanned in parallel by a small pool of worker threads and matches
+are streamed as each file finishes, so the first results arrive before the
+whole tree has been read. Each file is read and matched through the caller's
+run function, which under eventlet hands it to an OS thread so a large file
+or a slow pattern does not stall the event loop. Binary files and files over
+SEARCH_MAX_FILE_SIZE are skipped, and symlinks are never followed out of the
+home directory. Regular expressions are held to SEARCH_REGEX_MAX_LENGTH
+characters, match line by line, only search files up to
+SEARCH_REGEX_MAX_FILE_SIZE, and stop matching a file after
+SEARCH_REGEX_FILE_TIMEOUT seconds.
+
+An optional per-home trigram index remembers, for every file, the set of
+three-byte sequences in its lowercased content along with the mtime and size
+it was built from. Repeated literal searches then only read the files that
+changed since the last search or that can contain the query, instead of the
+whole tree.
+"""
+
+import os
+import stat
+import time
+import array
+import queue
+import bisect
+import fnmatch
+import threading
+import eventlet
+from collections import OrderedDict
+from cache_registry import register_cache
+
+SEARCH_MAX_FILE_SIZE = int(os.environ.get('SEARCH_MAX_FILE_SIZE', 1024 * 1024))
+SEARCH_INDEX_ENABLED = os.environ.get('SEARCH_INDEX', 'False').lower() == 'true'
+SEARCH_INDEX_MAX_BYTES = int(os.environ.get('SEARCH_INDEX_MAX_BYTES', 32 * 1024 * 1024))
+SEARCH_DEFAULT_RESULTS = 1000
+SEARCH_MAX_RESULTS = 10000
+SEARCH_MAX_MATCHES_PER_FILE = 100
+SEARCH_LINE_MAX_CHARS = 400
+SEARCH_REGEX_MAX_LENGTH = 500
+SEARCH_REGEX_MAX_FILE_SIZE = int(os.environ.get('SEARCH_REGEX_MAX_FILE_SIZE', 256 * 1024))
+SEARCH_REGEX_FILE_TIMEOUT = float(os.environ.get('SEARCH_REGEX_FILE_TIMEOUT', 1.0))  # Seconds of matching per file
+BINARY_SNIFF_BYTES = 8192  # A NUL byte in the first block marks a file as binary, like grep
+# Files modified this recently may change again within the same mtime tick,
+# so their trigrams are not trusted and they are always read
+SEARCH_INDEX_RACY_WINDOW_NS = 1_000_000_000
+SEARCH_INDEX_ENTRY_BYTES = 200  # Approximate overhead of one indexed file besides its trigrams
+
+# Home directory -> {'files': {relative path: (mtime_ns, size, searchable, trigrams)}, 'size', 'lock'},
+# in least recently used order. trigrams is None for files that must always be read.
+search_indexes = OrderedDict()
+# Real locks, not green ones: files are searched in OS threads
+search_indexes_lock = eventlet.patcher.original('threading').Lock()
+
+_DONE = object()
+
+
+def trim_search_indexes(target_bytes):
+    """Drop whole per-home indexes, least recently used first, until they use at most target_bytes"""
+    with search_indexes_lock:
+        size = sum(index['size'] for index in search_indexes.values())
+        freed = 0
+        while search_indexes and size - freed > target_bytes:
+            _, index = search_indexes.popitem(last=False)
+            freed += index['size']
+        return freed
+
+
+register_cache('search_index', lambda: sum(index['size'] for index in list(search_indexes.values())),
+               lambda: sum(len(index['files']) for index in list(search_indexes.values())),
+               trim_search_indexes)
+
+
+def get_search_index(home_dir):
+    """The trigram index for a home directory, created empty on first use"""
+    with search_indexes_lock:
+        index = search_indexes.get(home_dir)
+        if index is None:
+            index = search_indexes[home_dir] = {'files': {}, 'size': 0,
+                                                'lock': eventlet.patcher.original('threading').Lock()}
+        search_indexes.move_to_end(home_dir)
+        return index
+
+
+def index_entry_size(relative_path, entry):
+    trigrams = entry[3]
+    return SEARCH_INDEX_ENTRY_BYTES + len(relative_path) + (trigrams.itemsize * len(trigrams) if trigrams else 0)
+
+
+def store_index_entry(index, relative_path, entry):
+    """Add or replace one file's entry, keeping the index's byte count current"""
+    with index['lock']:
+        previous = index['files'].get(relative_path)
+        if previous is not None:
+            index['size'] -= index_entry_size(relative_path, previous)
+        if entry is None:
+            index['files'].pop(relative_path, None)
+        else:
+            index['files'][relative_path] = entry
+            index['size'] += index_entry_size(relative_path, entry)
+
+
+def extract_trigrams(data):
+    """Sorted array of every distinct three-byte sequence in data, lowercased, packed as integers"""
+    data = data.lower()
+    trigrams = {data[i:i + 3] for i in range(len(data) - 2)}
+    return array.array('I', sorted(int.from_bytes(trigram, 'big') for trigram in trigrams))
+
+
+def query_trigrams(query):
+    """Trigrams every file containing a literal query must have, or None if the query is too short.
+
+    Content is lowercased byte-wise, which only folds ASCII, so other queries
+    cannot be filtered.
+    """
+    data = query.encode('utf-8').lower()
+    if len(data) < 3 or not data.isascii():
+        return None
+    return {int.from_bytes(data[i:i + 3], 'big') for i in range(len(data) - 2)}
+
+
+def has_trigrams(trigrams, wanted):
+    for trigram in wanted:
+        position = bisect.bisect_left(trigrams, trigram)
+        if position == len(trigrams) or trigrams[position] != trigram:
+            return False
+    return True
+
+
+def walk_search_entries(root_dir, base_dir, ignore_patterns):
+    """Depth-first walk yielding (path, relative path, name, is_dir, is_symlink, lstat) below root_dir.
+
+    Symlinked directories are reported but not entered.
+    """
+    pending = [root_dir]
+    while pending:
+        dir_path = pending.pop()
+        try:
+            with os.scandir(dir_path) as scanned:
+                dir_entries = sorted(scanned, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in dir_entries:
+            if any(fnmatch.fnmatchcase(entry.name, pattern) for pattern in ignore_patterns):
+                continue
+            try:
+                is_symlink = entry.is_symlink()
+                is_dir = entry.is_dir(follow_symlinks=False)
+                entry_stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            yield entry.path, os.path.relpath(entry.path, base_dir), entry.name, is_dir, is_symlink, entry_stat
+            if is_dir:
+                subdirs.append(entry.path)
+        pending.extend(reversed(subdirs))
+
+
+def stream_in_parallel(func, items, workers, slots, stop, run):
+    """Call func on items from an iterator using up to workers threads, yielding (result, exception) as each finishes.
+
+    Each call is made as run(func, item) and holds one of slots, a semaphore
+    shared with other requests' file operations. Workers stop taking items
+    once stop is set, which also happens when the caller closes this generator.
+    """
+    results = queue.Queue(maxsize=workers * 4)
+    items_lock = threading.Lock()
+
+    def put(value):
+        # A consumer that went away must not leave workers blocked on a full queue
+        while not stop.is_set():
+            try:
+                results.put(value, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def worker():
+        try:
+            while not stop.is_set():
+                with items_lock:
+                    item = next(items, _DONE)
+                if item is _DONE:
+                    return
+                with slots:
+                    try:
+                        result = (run(func, item), None)
+                    except Exception as e:
+                        result = (None, e)
+                put(result)
+                # Yield between files, in case run calls func in this thread
+                time.sleep(0)
+        finally:
+            put(_DONE)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        active = len(threads)
+        while active:
+            value = results.get()
+            if value is _DONE:
+                active -= 1
+                continue
+            yield value
+    finally:
+        stop.set()
+
+
+def read_searchable(path, size):
+    """File contents, or None if the file is too large or binary"""
+    if size > SEARCH_MAX_FILE_SIZE:
+        return None
+    with open(path, 'rb') as f:
+        data = f.read(SEARCH_MAX_FILE_SIZE + 1)
+    if len(data) > SEARCH_MAX_FILE_SIZE or b'\0' in data[:BINARY_SNIFF_BYTES]:
+        return None
+    return data
+
+
+def match_lines(pattern, text, deadline=None):
+    """
+    One match dict per matching line, with 1-based line and column numbers.
+
+    With a deadline the text is matched one line at a time, like grep, and
+    the deadline is checked after every line. Returns (matches, complete) -
+    complete is False if matching stopped at the deadline.
+    """
+    matches = []
+    line_number = 1
+    position = 0
+    last_line = 0
+    block_start = 0
+    while True:
+        block_end = len(text)
+        if deadline is not None:
+            block_end = text.find('\n', block_start)
+            if block_end == -1:
+                block_end = len(text)
+        for match in pattern.finditer(text, block_start, block_end):
+            start = match.start()
+            line_number += text.count('\n', position, start)
+            position = start
+            if line_number == last_line:
+                continue
+            last_line = line_number
+            line_start = text.rfind('\n', 0, start) + 1
+            line_end = text.find('\n', start)
+            line = text[line_start:line_end if line_end != -1 else len(text)].rstrip('\r')
+            matches.append({'line': line_number, 'column': start - line_start + 1, 'text': line[:SEARCH_LINE_MAX_CHARS]})
+            if len(matches) >= SEARCH_MAX_MATCHES_PER_FILE:
+                return matches, True
+        if block_end >= len(text):
+            return matches, True
+        if time.monotonic() > deadline:
+            return matches, False
+        block_start = block_end + 1
+
+
+def search_file(pattern, index, wanted, is_regex, item):
+    """
+    Search one file, consulting and refreshing the index if there is one.
+
+    Returns (status, relative path, matches) where status is 'scanned',
+    'skipped' (binary or too large), 'filtered' (ruled out by the index
+    without reading the file) or 'timed_out' (a regular expression ran out of
+    time, with the matches found until then).
+    """
+    path, relative_path, file_stat = item
+    entry = index['files'].get(relative_path) if index is not None else None
+    fresh = entry is not None and entry[0] == file_stat.st_mtime_ns and entry[1] == file_stat.st_size
+    if fresh:
+        if not entry[2]:
+            return 'skipped', relative_path, []
+        if wanted is not None and entry[3] is not None and not has_trigrams(entry[3], wanted):
+            return 'filtered', relative_path, []
+
+    data = read_searchable(path, file_stat.st_size)
+    if index is not None and not (fresh and entry[3] is not None):
+        trigrams = None
+        if data is not None and time.time_ns() - file_stat.st_mtime_ns > SEARCH_INDEX_RACY_WINDOW_NS:
+            trigrams = extract_trigrams(data)
+        store_index_entry(index, relative_path, (file_stat.st_mtime_ns, file_stat.st_size, data is not None, trigrams))
+    if data is None or (is_regex and len(data) > SEARCH_REGEX_MAX_FILE_SIZE):
+        return 'skipped', relative_path, []
+    deadline = time.monotonic() + SEARCH_REGEX_FILE_TIMEOUT if is_regex else None
+    matches, complete = match_lines(pattern, data.decode('utf-8', errors='replace'), deadline)
+    return 'scanned' if complete else 'timed_out', relative_path, matches
+
+
+def stream_search(base_dir, root_dir, pattern, workers, slots, run, mode='content', literal=None, include=(),
+                  ignore_patterns=(), max_results=SEARCH_DEFAULT_RESULTS, use_index=False):
+    """
+    Generator of search results below root_dir.
+
+    Yields lists of result dicts, one list per file with content matches (or
+    per batch of name matches), then a final list holding the summary.
+
+    Args:
+        base_dir: The session's home directory; result paths are relative to it
+        root_dir: Directory to search, inside base_dir
+        pattern: Compiled regular expression, with re.MULTILINE for content searches
+        workers: Threads reading files for a content search
+        slots: Semaphore bounding file reads across concurrent requests
+        run: Called as run(func, item) to search each file, e.g. in an OS thread
+        mode: 'content' to match file contents or 'name' to match entry names
+        literal: The query if it is a plain string, which lets the index rule out files -
+            None for a regular expression, which is held to the regex size and time limits
+        include: Glob patterns a file name must match to be searched
+        ignore_patterns: Glob patterns for names to leave out, directories included
+        max_results: Matching lines (or names) after which the search stops
+        use_index: Consult and update the home directory's trigram index
+    """
+    start_time = time.time()
+    stats = {'matches': 0, 'scanned': 0, 'skipped': 0, 'filtered': 0, 'timed_out': 0, 'errors': 0}
+    truncated = False
+    walk = walk_search_entries(root_dir, base_dir, ignore_patterns)
+
+    if mode == 'name':
+        batch = []
+        for _, relative_path, name, is_dir, _, _ in walk:
+            if include and not any(fnmatch.fnmatchcase(name, glob) for glob in include):
+                continue
+            if not pattern.search(name):
+                continue
+            if stats['matches'] >= max_results:
+                truncated = True
+                break
+            stats['matches'] += 1
+            batch.append({'path': relative_path, 'name': name, 'is_dir': is_dir})
+            if len(batch) >= 100:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    else:
+        index = get_search_index(os.path.normpath(base_dir)) if use_index else None
+        wanted = query_trigrams(literal) if index is not None and literal is not None else None
+        seen = set()
+        walk_state = {'complete': False}
+
+        def files():
+            for path, relative_path, name, _, _, file_stat in walk:
+                if not stat.S_ISREG(file_stat.st_mode):
+                    continue
+                seen.add(relative_path)
+                if include and not any(fnmatch.fnmatchcase(name, glob) for glob in include):
+                    continue
+                yield path, relative_path, file_stat
+            walk_state['complete'] = True
+
+        stop = threading.Event()
+        is_regex = literal is None
+        results = stream_in_parallel(lambda item: search_file(pattern, index, wanted, is_regex, item), files(),
+                                     workers, slots, stop, run)
+        try:
+            for result, error in results:
+                if error is not None:
+                    stats['errors'] += 1
+                    continue
+                status, relative_path, matches = result
+                stats[status] += 1
+                if not matches:
+                    continue
+                remaining = max_results - stats['matches']
+                if len(matches) > remaining:
+                    matches = matches[:remaining]
+                    truncated = True
+                stats['matches'] += len(matches)
+                yield [dict(match, path=relative_path) for match in matches]
+                if truncated or stats['matches'] >= max_results:
+                    truncated = True
+                    break
+        finally:
+            results.close()
+
+        if index is not None and walk_state['complete'] and not truncated:
+            # Forget files under the searched directory that no longer exist
+            root_relative = os.path.relpath(root_dir, base_dir)
+            prefix = '' if root_relative == '.' else root_relative + os.sep
+            for relative_path in [path for path in list(index['files']) if path.startswith(prefix)]:
+                if relative_path not in seen:
+                    store_index_entry(index, relative_path, None)
+            trim_search_indexes(SEARCH_INDEX_MAX_BYTES)
+
+    yield [{
+        'done': True,
+        'matches': stats['matches'],
+        'filesScanned': stats['scanned'],
+        'filesSkipped': stats['skipped'],
+        'filesFiltered': stats['filtered'],
+        'filesTimedOut': stats['timed_out'],
+        'errors': stats['errors'],
+        'truncated': truncated,
+        'index': 'used' if mode == 'content' and use_index else 'off',
+        'elapsed': round(time.time() - start_time, 4)
+    }]
@@ -0,0 +1,516 @@
+"""
+Partial reads of large files, and live following of growing ones.
+
+/files/read returns a slice of a file by byte offset, by line number, or the
+last N lines, reading only the blocks it needs instead of the whole file.
+Line numbers are resolved through a sparse index of every
+LINE_INDEX_STRIDE-th line's offset per file, so paging through a large log
+scans at most one stride of lines. The index survives appends: it is
+extended instead of rebuilt as long as the file has not shrunk and the bytes
+just before its indexed end are unchanged.
+
+Socket.IO clients can follow a file like `tail -f`. Followed files share one
+directory watch through file_watcher, changes are coalesced for
+FOLLOW_INTERVAL seconds, and appended bytes are read once per file and sent
+to every follower - no process is spawned per viewer.
+"""
+
+import os
+import codecs
+import threading
+import eventlet
+from array import array
+from collections import OrderedDict
+from flask import request
+from cache_registry import register_cache
+from file_watcher import watch_directory, unwatch_directory
+
+READ_DEFAULT_BYTES = 64 * 1024
+READ_MAX_BYTES = int(os.environ.get('READ_MAX_BYTES', 1024 * 1024))  # Largest slice returned by one read
+READ_DEFAULT_LINES = 100
+READ_MAX_LINES = 10000
+READ_BLOCK_SIZE = 64 * 1024
+LINE_INDEX_STRIDE = 1000  # Lines between indexed offsets
+LINE_INDEX_MAX_FILES = 256
+LINE_INDEX_SAMPLE_BYTES = 64  # Bytes before the indexed end, compared to detect rewritten files
+FOLLOW_MAX_FILES = int(os.environ.get('FOLLOW_MAX_FILES', 8))  # Followed files per session
+FOLLOW_INTERVAL = float(os.environ.get('FOLLOW_INTERVAL', 0.2))  # Seconds to coalesce appends
+FOLLOW_MAX_PUSH_BYTES = 256 * 1024  # Larger bursts are skipped to their last bytes
+
+# (st_dev, st_ino) -> {'checkpoints': offsets of lines 1, 1 + stride, ..., 'end': offset after the last
+# indexed newline, 'lines': newlines before end, 'sample': bytes just before end}, least recently used first
+line_indexes = OrderedDict()
+# A real lock, not a green one: /files/read scans files in run_blocking's OS threads
+line_indexes_lock = eventlet.patcher.original('threading').Lock()
+
+
+def line_index_size(index):
+    return index['checkpoints'].itemsize * len(index['checkpoints']) + len(index['sample']) + 64
+
+
+def trim_line_indexes(target_bytes):
+    """Drop line indexes, least recently used first, until they use at most target_bytes"""
+    with line_indexes_lock:
+        size = sum(line_index_size(index) for index in line_indexes.values())
+        freed = 0
+        while line_indexes and size - freed > target_bytes:
+            _, index = line_indexes.popitem(last=False)
+            freed += line_index_size(index)
+        return freed
+
+
+register_cache('line_index', lambda: sum(line_index_size(index) for index in list(line_indexes.values())),
+               lambda: len(line_indexes), trim_line_indexes)
+
+
+def decode_text(data):
+    return data.decode('utf-8', errors='replace')
+
+
+def read_byte_range(f, file_size, offset, length):
+    """Read up to length bytes at offset; a negative offset counts from the end. Returns (offset, data)."""
+    if offset < 0:
+        offset = max(0, file_size + offset)
+    offset = min(offset, file_size)
+    f.seek(offset)
+    return offset, f.read(min(length, READ_MAX_BYTES))
+
+
+def load_line_index(f, file_stat):
+    """The file's line index if it still describes the file's leading bytes, else a new empty one"""
+    key = (file_stat.st_dev, file_stat.st_ino)
+    with line_indexes_lock:
+        index = line_indexes.get(key)
+        if index is not None:
+            line_indexes.move_to_end(key)
+    if index is not None and index['end'] <= file_stat.st_size:
+        f.seek(index['end'] - len(index['sample']))
+        if f.read(len(index['sample'])) == index['sample']:
+            return index
+    return {'checkpoints': array('Q', [0]), 'end': 0, 'lines': 0, 'sample': b''}
+
+
+def save_line_index(f, file_stat, checkpoints, end, lines):
+    """Store an index extended to end, unless a stored one already reaches further"""
+    f.seek(max(0, end - LINE_INDEX_SAMPLE_BYTES))
+    index = {
+        'checkpoints': checkpoints,
+        'end': end,
+        'lines': lines,
+        'sample': f.read(min(end, LINE_INDEX_SAMPLE_BYTES))
+    }
+    key = (file_stat.st_dev, file_stat.st_ino)
+    with line_indexes_lock:
+        stored = line_indexes.get(key)
+        if stored is not None and stored['end'] >= end:
+            return
+        line_indexes[key] = index
+        line_indexes.move_to_end(key)
+        while len(line_indexes) > LINE_INDEX_MAX_FILES:
+            line_indexes.popitem(last=False)
+
+
+def find_line_offset(f, file_stat, line_number):
+    """Byte offset where a line starts (1-based), or None if the file has fewer lines"""
+    index = load_line_index(f, file_stat)
+    # Lines up to the one starting at the indexed end all have their checkpoint
+    extend = line_number > index['lines'] + 1
+    if extend:
+        checkpoints = array('Q', index['checkpoints'])
+        position, current_line = index['end'], index['lines'] + 1
+    else:
+        checkpoint = (line_number - 1) // LINE_INDEX_STRIDE
+        position, current_line = index['checkpoints'][checkpoint], checkpoint * LINE_INDEX_STRIDE + 1
+
+    line_start = position
+    f.seek(position)
+    while current_line < line_number:
+        block = f.read(READ_BLOCK_SIZE)
+        if not block:
+            break
+        next_line_of_interest = min(line_number, len(checkpoints) * LINE_INDEX_STRIDE + 1) if extend else line_number
+        newlines = block.count(b'\n')
+        if current_line + newlines < next_line_of_interest:
+            # Nothing to record in this block - skip it in one step
+            if newlines:
+                current_line += newlines
+                line_start = position + block.rfind(b'\n') + 1
+            position += len(block)
+            continue
+        newline = block.find(b'\n')
+        while newline != -1 and current_line < line_number:
+            current_line += 1
+            line_start = position + newline + 1
+            if extend and (current_line - 1) % LINE_INDEX_STRIDE == 0:
+                checkpoints.append(line_start)
+            newline = block.find(b'\n', newline + 1)
+        position += len(block)
+
+    if extend:
+        save_line_index(f, file_stat, checkpoints, line_start, current_line - 1)
+    if current_line < line_number or line_start >= file_stat.st_size:
+        return None
+    return line_start
+
+
+def read_lines(f, offset, count):
+    """Read count lines starting at offset, stopping at READ_MAX_BYTES. Returns (data, lines read)."""
+    f.seek(offset)
+    chunks = []
+    total = 0
+    lines = 0
+    while lines < count and total < READ_MAX_BYTES:
+        block = f.read(min(READ_BLOCK_SIZE, READ_MAX_BYTES - total))
+        if not block:
+            break
+        newline = -1
+        while lines < count:
+            found = block.find(b'\n', newline + 1)
+            if found == -1:
+                break
+            newline = found
+            lines += 1
+        if lines == count:
+            block = block[:newline + 1]
+        chunks.append(block)
+        total += len(block)
+    data = b''.join(chunks)
+    if data and not data.endswith(b'\n') and lines < count:
+        # A final line without a newline still counts
+        lines += 1
+    return data, lines
+
+
+def find_tail_offset(f, file_size, count):
+    """Offset where the last count lines start, reading backwards. Returns (offset, truncated)."""
+    position = file_size
+    # A newline ending the file does not start another line
+    f.seek(max(0, file_size - 1))
+    needed = count + (1 if file_size and f.read(1) == b'\n' else 0)
+    while position > 0:
+        if file_size - position >= READ_MAX_BYTES:
+            return file_size - READ_MAX_BYTES, True
+        block_start = max(0, position - READ_BLOCK_SIZE)
+        f.seek(block_start)
+        block = f.read(position - block_start)
+        end = len(block)
+        while True:
+            found = block.rfind(b'\n', 0, end)
+            if found == -1:
+                break
+            needed -= 1
+            if needed == 0:
+                start = block_start + found + 1
+                if file_size - start > READ_MAX_BYTES:
+                    return file_size - READ_MAX_BYTES, True
+                return start, False
+            end = found
+        position = block_start
+    if file_size > READ_MAX_BYTES:
+        return file_size - READ_MAX_BYTES, True
+    return 0, False
+
+
+def read_file_slice(file_path, mode, offset, length, start_line, count):
+    """
+    Read the part of a file /files/read asked for - blocking, meant for run_blocking.
+
+    Returns:
+        tuple: (file_stat, offset, data, fields) - fields are the mode-specific response fields
+    """
+    with open(file_path, 'rb') as f:
+        # Sizes and offsets refer to the file as it was opened, even if it grows meanwhile
+        file_stat = os.fstat(f.fileno())
+        file_size = file_stat.st_size
+        if mode == 'bytes':
+            start, data = read_byte_range(f, file_size, offset, length)
+            fields = {'truncated': length > READ_MAX_BYTES and start + len(data) < file_size}
+        elif mode == 'lines':
+            start = find_line_offset(f, file_stat, start_line)
+            if start is None:
+                start, data, read = file_size, b'', 0
+            else:
+                data, read = read_lines(f, start, count)
+            fields = {'startLine': start_line, 'lines': read,
+                      'truncated': len(data) >= READ_MAX_BYTES and read < count}
+        else:
+            start, truncated = find_tail_offset(f, file_size, count)
+            f.seek(start)
+            data = f.read(file_size - start)
+            fields = {'truncated': truncated}
+    return file_stat, start, data[:max(0, file_size - start)], fields
+
+
+# Absolute file path -> {'directory', 'ino', 'followers': {sid: {'offset', 'path', 'decoder'}}}
+followed_files = {}
+# Directory -> number of followed files in it, so its watch is removed with the last one
+followed_directories = {}
+# Socket ID -> {'session_id', 'files': set of absolute paths}
+socket_follows = {}
+follow_lock = threading.Lock()
+follow_state = {
+    'timer': None,
+    'emit': None,
+    'pending': set(),
+    'rewatch': set(),  # Directories whose watch was dropped, watched again on the next flush
+    'pushes': 0,
+    'bytes': 0
+}
+
+
+def on_followed_change(directory, name):
+    """File watcher callback - note the changed file and start the coalescing timer"""
+    with follow_lock:
+        if name is None:
+            changed = [path for path, followed in followed_files.items() if followed['directory'] == directory]
+            if changed:
+                # The watch may have been dropped (evicted or overflowed) - not re-added here,
+                # since an eviction calls back from inside another watch_directory call
+                follow_state['rewatch'].add(directory)
+        else:
+            path = os.path.join(directory, name)
+            changed = [path] if path in followed_files else []
+        if not changed:
+            return
+        follow_state['pending'].update(changed)
+        if follow_state['timer'] is None:
+            timer = threading.Timer(FOLLOW_INTERVAL, flush_followed_files)
+            timer.daemon = True
+            follow_state['timer'] = timer
+            timer.start()
+
+
+def push_appended(path, emit):
+    """Read what was appended to one followed file since each follower's offset and send it"""
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        # Deleted or rotated away - keep following, the next file at this path starts from 0
+        return
+    with f:
+        file_stat = os.fstat(f.fileno())
+        with follow_lock:
+            followed = followed_files.get(path)
+            if followed is None:
+                return
+            notices = []
+            if followed['ino'] != file_stat.st_ino:
+                followed['ino'] = file_stat.st_ino
+                for sid, follower in followed['followers'].items():
+                    follower['offset'] = 0
+                    follower['decoder'].reset()
+                    notices.append((sid, follower['path'], 'replaced'))
+            for sid, follower in followed['followers'].items():
+                if follower['offset'] > file_stat.st_size:
+                    follower['offset'] = 0
+                    follower['decoder'].reset()
+                    notices.append((sid, follower['path'], 'truncated'))
+            followers = [(sid, follower) for sid, follower in followed['followers'].items()
+                         if follower['offset'] < file_stat.st_size]
+        for sid, relative_path, reason in notices:
+            emit('file_truncated', {'path': relative_path, 'reason': reason}, to=sid)
+        if not followers:
+            return
+
+        # One read covers every follower, most of which are at the same offset
+        start = max(min(follower['offset'] for _, follower in followers), file_stat.st_size - FOLLOW_MAX_PUSH_BYTES)
+        f.seek(start)
+        data = f.read(file_stat.st_size - start)
+
+    end = start + len(data)
+    for sid, follower in followers:
+        offset = max(follower['offset'], start)
+        if offset > follower['offset']:
+            # Skipped bytes may end inside a character
+            follower['decoder'].reset()
+        chunk = data[offset - start:]
+        text = follower['decoder'].decode(chunk)
+        emit('file_appended', {
+            'path': follower['path'],
+            'offset': offset,
+            'nextOffset': end,
+            'skipped': offset - follower['offset'],
+            'data': text
+        }, to=sid)
+        follower['offset'] = end
+        follow_state['pushes'] += 1
+        follow_state['bytes'] += len(chunk)
+
+
+def flush_followed_files():
+    """Send appended data for every file changed during the coalescing window"""
+    with follow_lock:
+        pending = follow_state['pending']
+        follow_state['pending'] = set()
+        rewatch = follow_state['rewatch']
+        follow_state['rewatch'] = set()
+        follow_state['timer'] = None
+        emit = follow_state['emit']
+    for directory in rewatch:
+        with follow_lock:
+            still_followed = any(followed['directory'] == directory for followed in followed_files.values())
+        if still_followed:
+            watch_directory(directory, on_followed_change)
+    for path in pending:
+        try:
+            push_appended(path, emit)
+        except Exception as e:
+            print(f"Error pushing appended data for {path}: {str(e)}")
+
+
+def follow_file(sid, session_id, relative_path, file_path, offset):
+    """
+    Start sending a socket the bytes appended to a file from offset on.
+
+    Returns (offset following starts at, error message or None).
+    """
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return None, 'File not found'
+    if offset is None:
+        offset = file_stat.st_size
+    elif offset < 0:
+        offset = max(0, file_stat.st_size + offset)
+    offset = min(offset, file_stat.st_size)
+
+    directory = os.path.dirname(file_path)
+    with follow_lock:
+        follows = socket_follows.get(sid)
+        already = follows is not None and file_path in follows['files']
+        session_follows = sum(len(other['files']) for other in socket_follows.values()
+                              if other['session_id'] == session_id)
+        if not already and session_follows >= FOLLOW_MAX_FILES:
+            return None, f'At most {FOLLOW_MAX_FILES} files can be followed per session'
+
+        followed = followed_files.get(file_path)
+        first_in_directory = False
+        if followed is None:
+            followed = followed_files[file_path] = {'directory': directory, 'ino': file_stat.st_ino, 'followers': {}}
+            followed_directories[directory] = followed_directories.get(directory, 0) + 1
+            first_in_directory = followed_directories[directory] == 1
+        followed['followers'][sid] = {
+            'offset': offset,
+            'path': relative_path,
+            'decoder': codecs.getincrementaldecoder('utf-8')(errors='replace')
+        }
+        socket_follows.setdefault(sid, {'session_id': session_id, 'files': set()})['files'].add(file_path)
+
+    if first_in_directory and not watch_directory(directory, on_followed_change):
+        unfollow_file(sid, file_path)
+        return None, 'File watcher is not running'
+    # Anything appended between the stat and the watch is picked up right away
+    on_followed_change(directory, os.path.basename(file_path))
+    return offset, None
+
+
+def unfollow_file(sid, file_path):
+    """Stop following a file for one socket, and drop its watch once nothing in the directory is followed"""
+    unwatch = None
+    with follow_lock:
+        follows = socket_follows.get(sid)
+        if follows is not None:
+            follows['files'].discard(file_path)
+            if not follows['files']:
+                del socket_follows[sid]
+        followed = followed_files.get(file_path)
+        if followed is None:
+            return
+        followed['followers'].pop(sid, None)
+        if followed['followers']:
+            return
+        del followed_files[file_path]
+        directory = followed['directory']
+        followed_directories[directory] -= 1
+        if not followed_directories[directory]:
+            del followed_directories[directory]
+            unwatch = directory
+    if unwatch:
+        unwatch_directory(unwatch, on_followed_change)
+
+
+def release_file_follows(sid):
+    """Stop every follow of a disconnected socket"""
+    with follow_lock:
+        follows = socket_follows.get(sid)
+        files = list(follows['files']) if follows else []
+    for file_path in files:
+        unfollow_file(sid, file_path)
+
+
+def get_file_follow_stats():
+    """Follow counts for health reporting"""
+    return {
+        'files': len(followed_files),
+        'sockets': len(socket_follows),
+        'pushes': follow_state['pushes'],
+        'bytes': follow_state['bytes'],
+        'lineIndexes': len(line_indexes)
+    }
+
+
+def register_file_follow_handlers(socketio, get_session):
+    """
+    Register the Socket.IO handlers for following files.
+
+    Args:
+        socketio: The SocketIO instance
+        get_session: Function to retrieve a valid session
+    """
+    follow_state['emit'] = socketio.emit
+
+    def resolve_follow_path(data):
+        """Session and file for a follow request, or None after reporting the error"""
+        session_id = data.get('session_id')
+        if not session_id:
+            socketio.emit('error', {'error': 'No session ID provided'}, to=request.sid)
+            return None
+
+        session = get_session(session_id)
+        if not session:
+            socketio.emit('session_expired', {'message': 'Session expired or invalid'}, to=request.sid)
+            return None
+
+        path = data.get('path', '')
+        # Sanitize path to prevent path traversal
+        base_dir = session['home_dir']
+        file_path = os.path.abspath(os.path.normpath(os.path.join(base_dir, path)))
+
+        # Ensure the path is within the user's home directory
+        if not file_path.startswith(os.path.abspath(base_dir) + os.sep):
+            socketio.emit('file_follow_error', {'path': path, 'error': 'Invalid path'}, to=request.sid)
+            return None
+        return session_id, path, file_path
+
+    @socketio.on('follow_file')
+    def handle_follow_file(data):
+        """Push bytes appended to a file to this socket"""
+        resolved = resolve_follow_path(data)
+        if resolved is None:
+            return
+        session_id, path, file_path = resolved
+
+        if not os.path.isfile(file_path):
+            socketio.emit('file_follow_error', {'path': path, 'error': 'Path is not a file'}, to=request.sid)
+            return
+
+        offset = data.get('offset')
+        if offset is not None and not isinstance(offset, int):
+            socketio.emit('file_follow_error', {'path': path, 'error': 'offset must be an integer'}, to=request.sid)
+            return
+
+        offset, error = follow_file(request.sid, session_id, path, file_path, offset)
+        if error:
+            socketio.emit('file_follow_error', {'path': path, 'error': error}, to=request.sid)
+            return
+        socketio.emit('file_following', {'path': path, 'offset': offset}, to=request.sid)
+
+    @socketio.on('unfollow_file')
+    def handle_unfollow_file(data):
+        """Stop pushing appended bytes of a file to this socket"""
+        resolved = resolve_follow_path(data)
+        if resolved is None:
+            return
+        _, path, file_path = resolved
+        unfollow_file(request.sid, file_path)
+        socketio.emit('file_unfollowed', {'path': path}, to=request.sid)
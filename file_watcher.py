@@ -0,0 +1,318 @@
+"""
+Directory watcher used to invalidate caches when files change on disk.
+
+Uses inotify through ctypes on Linux and falls back to polling directory
+snapshots elsewhere. Callers register a callback per directory; it is called
+as callback(directory, name) for every changed entry, and with name=None when
+the directory itself is gone or its events may have been lost (queue overflow,
+watch evicted), in which case everything cached for it must be dropped.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from collections import OrderedDict
+
+FILE_WATCH_BACKEND = os.environ.get('FILE_WATCH_BACKEND', 'auto').lower()  # auto, inotify or polling
+FILE_WATCH_MAX_DIRECTORIES = int(os.environ.get('FILE_WATCH_MAX_DIRECTORIES', 4096))
+FILE_WATCH_POLL_INTERVAL = float(os.environ.get('FILE_WATCH_POLL_INTERVAL', 2.0))
+
+# inotify event flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+
+# Directory -> {'callbacks': set, 'wd': inotify watch descriptor, 'snapshot': polling state}
+# in least recently registered order, so the oldest watch is evicted when full
+watched_directories = OrderedDict()
+watch_descriptors = {}  # inotify watch descriptor -> directory
+file_watcher_lock = threading.Lock()
+file_watcher_state = {
+    'backend': None,
+    'inotify_fd': None,
+    'events': 0,
+    'overflows': 0,
+    'evictions': 0
+}
+
+libc = None
+
+
+def load_inotify():
+    """Return libc if it provides inotify, otherwise None"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        library = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        library.inotify_init1.argtypes = [ctypes.c_int]
+        library.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        library.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return library
+    except (OSError, AttributeError):
+        return None
+
+
+def add_inotify_watch(directory):
+    """Add an inotify watch - caller must hold file_watcher_lock"""
+    wd = libc.inotify_add_watch(file_watcher_state['inotify_fd'], os.fsencode(directory), WATCH_MASK)
+    if wd < 0:
+        error = ctypes.get_errno()
+        if error != errno.ENOENT:
+            print(f"Warning: Could not watch {directory}: {os.strerror(error)}")
+        return None
+    watch_descriptors[wd] = directory
+    return wd
+
+
+def take_snapshot(directory):
+    """Snapshot of a directory's entries for the polling backend"""
+    snapshot = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                    snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+                except OSError:
+                    continue
+    except OSError:
+        return None
+    return snapshot
+
+
+def dispatch(directory, name, callbacks):
+    """Invoke callbacks for one change, isolating failures"""
+    for callback in callbacks:
+        try:
+            callback(directory, name)
+        except Exception as e:
+            print(f"Error in file watch callback for {directory}: {str(e)}")
+
+
+def remove_watch(directory):
+    """Stop watching a directory - caller must hold file_watcher_lock. Returns its callbacks."""
+    watch = watched_directories.pop(directory, None)
+    if watch is None:
+        return set()
+    wd = watch.get('wd')
+    if wd is not None:
+        watch_descriptors.pop(wd, None)
+        libc.inotify_rm_watch(file_watcher_state['inotify_fd'], wd)
+    return watch['callbacks']
+
+
+def watch_directory(directory, callback):
+    """
+    Watch a directory's direct entries and call callback(directory, name) on changes.
+
+    Returns True when the watcher is running and the directory is watched, so
+    callers can rely on invalidation instead of short TTLs. When the watch
+    cannot be added (missing directory, permissions, inotify limits) the
+    callback is not registered and False is returned.
+    """
+    directory = os.path.abspath(directory)
+    evicted = None
+    with file_watcher_lock:
+        watch = watched_directories.get(directory)
+        if watch is not None:
+            watch['callbacks'].add(callback)
+            watched_directories.move_to_end(directory)
+            return file_watcher_state['backend'] is not None
+
+        watch = {'callbacks': {callback}, 'wd': None, 'snapshot': None}
+        if file_watcher_state['backend'] == 'inotify':
+            watch['wd'] = add_inotify_watch(directory)
+            if watch['wd'] is None:
+                return False
+        elif file_watcher_state['backend'] == 'polling':
+            watch['snapshot'] = take_snapshot(directory)
+            if watch['snapshot'] is None:
+                return False
+
+        if len(watched_directories) >= FILE_WATCH_MAX_DIRECTORIES:
+            oldest = next(iter(watched_directories))
+            evicted = (oldest, remove_watch(oldest))
+            file_watcher_state['evictions'] += 1
+        watched_directories[directory] = watch
+        watched = file_watcher_state['backend'] is not None
+
+    # Whatever was cached for the evicted directory can no longer be kept fresh
+    if evicted:
+        dispatch(evicted[0], None, evicted[1])
+    return watched
+
+
+def unwatch_directory(directory, callback=None):
+    """Stop watching a directory, or only remove one callback and keep watching for the others"""
+    directory = os.path.abspath(directory)
+    with file_watcher_lock:
+        watch = watched_directories.get(directory)
+        if watch is None:
+            return
+        if callback is not None:
+            watch['callbacks'].discard(callback)
+            if watch['callbacks']:
+                return
+        remove_watch(directory)
+
+
+def read_inotify_events():
+    """Block until inotify has events, then dispatch them"""
+    fd = file_watcher_state['inotify_fd']
+    ready, _, _ = select.select([fd], [], [], 1.0)
+    if not ready:
+        return
+    try:
+        data = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return
+
+    changes = []
+    offset = 0
+    with file_watcher_lock:
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            raw_name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length]
+            offset += EVENT_HEADER.size + length
+            file_watcher_state['events'] += 1
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped - every watched directory may be stale
+                file_watcher_state['overflows'] += 1
+                changes.extend((directory, None, set(watch['callbacks']))
+                               for directory, watch in watched_directories.items())
+                continue
+
+            directory = watch_descriptors.get(wd)
+            if directory is None:
+                continue
+            watch = watched_directories.get(directory)
+            callbacks = set(watch['callbacks']) if watch else set()
+
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                # The kernel dropped the watch, or the directory is gone
+                if mask & IN_IGNORED:
+                    watch_descriptors.pop(wd, None)
+                    watched_directories.pop(directory, None)
+                elif mask & IN_MOVE_SELF and watch and watch.get('wd') == wd:
+                    # The kernel watch follows the directory to its new path, where
+                    # its events would be reported under the old one
+                    remove_watch(directory)
+                changes.append((directory, None, callbacks))
+                continue
+
+            name = os.fsdecode(raw_name.rstrip(b'\0')) or None
+            changes.append((directory, name, callbacks))
+
+    for directory, name, callbacks in changes:
+        dispatch(directory, name, callbacks)
+
+
+def poll_directories():
+    """Compare snapshots of every watched directory and dispatch differences"""
+    with file_watcher_lock:
+        directories = list(watched_directories.keys())
+
+    for directory in directories:
+        snapshot = take_snapshot(directory)
+        with file_watcher_lock:
+            watch = watched_directories.get(directory)
+            if watch is None:
+                continue
+            previous = watch['snapshot']
+            watch['snapshot'] = snapshot
+            callbacks = set(watch['callbacks'])
+            if snapshot is None:
+                watched_directories.pop(directory, None)
+
+        if snapshot is None:
+            dispatch(directory, None, callbacks)
+        elif previous is not None:
+            for name in set(previous) | set(snapshot):
+                if previous.get(name) != snapshot.get(name):
+                    file_watcher_state['events'] += 1
+                    dispatch(directory, name, callbacks)
+
+
+def run_file_watcher():
+    """Watcher thread main loop"""
+    while True:
+        try:
+            if file_watcher_state['backend'] == 'inotify':
+                read_inotify_events()
+            else:
+                poll_directories()
+                time.sleep(FILE_WATCH_POLL_INTERVAL)
+        except Exception as e:
+            print(f"File watcher error: {str(e)}")
+            time.sleep(1)
+
+
+def start_file_watcher():
+    """Start the watcher thread once, choosing inotify when available. Returns the backend name."""
+    global libc
+    with file_watcher_lock:
+        if file_watcher_state['backend'] is not None:
+            return file_watcher_state['backend']
+
+        backend = 'polling'
+        if FILE_WATCH_BACKEND in ('auto', 'inotify'):
+            libc = load_inotify()
+            if libc is not None:
+                fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+                if fd >= 0:
+                    file_watcher_state['inotify_fd'] = fd
+                    backend = 'inotify'
+                else:
+                    print(f"inotify unavailable ({os.strerror(ctypes.get_errno())}), falling back to polling")
+        file_watcher_state['backend'] = backend
+
+        # Directories registered before the watcher started
+        failed = []
+        for directory, watch in list(watched_directories.items()):
+            if backend == 'inotify':
+                watch['wd'] = add_inotify_watch(directory)
+                if watch['wd'] is None:
+                    failed.append((directory, watched_directories.pop(directory)['callbacks']))
+            else:
+                watch['snapshot'] = take_snapshot(directory)
+
+    # Those that could not be watched are not kept fresh, so their callers must drop what they cached
+    for directory, callbacks in failed:
+        dispatch(directory, None, callbacks)
+
+    threading.Thread(target=run_file_watcher, daemon=True).start()
+    print(f"File watcher started with {backend} backend")
+    return backend
+
+
+def get_file_watcher_stats():
+    """Watcher status for health reporting"""
+    return {
+        'backend': file_watcher_state['backend'],
+        'directories': len(watched_directories),
+        'events': file_watcher_state['events'],
+        'overflows': file_watcher_state['overflows'],
+        'evictions': file_watcher_state['evictions']
+    }
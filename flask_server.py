@@ -9,23 +9,44 @@ import subprocess
 import threading
 import atexit
 import functools
+import hashlib
+import hmac
+from collections import OrderedDict
 from datetime import datetime
-from flask import Flask, request, jsonify, send_from_directory, send_file, render_template, make_response
+from flask import Flask, Response, request, jsonify, send_from_directory, send_file, render_template, make_response, g
 from flask_cors import CORS
 from flask_compress import Compress
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from werkzeug.security import generate_password_hash, check_password_hash
-import cachetools.func
+from werkzeug.wsgi import FileWrapper
 import select
 import io
 import eventlet
 from file_management import register_file_management_endpoints
-
-# Use eventlet for WebSocket support
-eventlet.monkey_patch()
+from file_events import register_file_event_handlers, release_file_subscriptions, get_file_event_stats
+from file_viewer import register_file_follow_handlers, release_file_follows, get_file_follow_stats
+from trash import start_trash_reaper, get_trash_stats
+from activity_log import log_activity, start_activity_log_writer, flush_activity_log, get_activity_log_stats
+from dedup_store import start_dedup_collector, get_dedup_stats
+from metrics import observe, register_gauge, render_metrics, instrument_socketio
+from profiler import (start_profiling, stop_profiling, instrument_socketio_profiling, configure_profiler,
+                      reset_profile, export_collapsed, export_speedscope, get_profiler_stats)
+from disk_usage import (command_preexec, mark_dirty, untrack_home, start_usage_reconciler, quota_status,
+                        get_disk_usage_stats)
+from static_assets import (build_static_asset_store, refresh_static_asset, get_static_asset_response,
+                           get_static_asset_stats, guess_content_type, STATIC_DIR, STATIC_ASSET_MAX_AGE)
+from file_watcher import start_file_watcher, watch_directory, get_file_watcher_stats
+from shared_assets import load_shared_segment, fingerprint_tree, get_shared_segment_stats
+from cache_registry import register_cache, enforce_cache_budget, relieve_memory_pressure, get_cache_stats
+
+# Use eventlet for WebSocket support. The runner scripts patch before importing
+# this module, so only patch here when nothing has done it yet.
+if not eventlet.patcher.is_monkey_patched('socket'):
+    eventlet.monkey_patch()
 
 # Create a Flask app with optimized settings
-app = Flask(__name__, static_folder='static')
+# The built-in static route is disabled so /static/<path> reaches serve_static() and its cache
+app = Flask(__name__, static_folder=None)
 app.config['JSON_SORT_KEYS'] = False  # Faster JSON responses
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 86400  # Cache static files for 1 day
 app.config['COMPRESS_ALGORITHM'] = ['gzip', 'deflate']  # Enable response compression
@@ -41,17 +62,27 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev_key_change_in_produ
 print(f"Flask app initialization starting at {time.time()}")
 print(f"Python version: {sys.version}")
 print(f"System platform: {sys.platform}")
-try:
-    import psutil
-    mem = psutil.virtual_memory()
-    print(f"Available memory: {mem.available / (1024*1024):.1f}MB / {mem.total / (1024*1024):.1f}MB")
-except ImportError:
-    print("psutil not available - skipping memory check")
 
-# Initialize Flask-Compress for response compression
+# Initialize Flask-Compress for response compression. Its after_request hook is
+# registered below so routes serving precompressed bodies can skip it.
+app.config['COMPRESS_REGISTER'] = False
 compress = Compress()
 compress.init_app(app)
 
+# Endpoints that never need on-the-fly compression - precompressed bodies, and
+# streams that Flask-Compress would buffer whole before sending
+COMPRESS_EXEMPT_ENDPOINTS = {'serve_static', 'file_tree', 'download_archive', 'search_files'}
+
+@app.after_request
+def compress_response(response):
+    """Compress responses with Flask-Compress unless the endpoint is exempt"""
+    if request.endpoint in COMPRESS_EXEMPT_ENDPOINTS:
+        return response
+    # Byte ranges refer to the identity body, so partial content is never encoded
+    if response.status_code == 206:
+        return response
+    return compress.after_request(response)
+
 # Enable CORS with optimized settings
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True, max_age=86400)
 
@@ -59,6 +90,26 @@ CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True, max_ag
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', ping_timeout=30, 
                     ping_interval=15, max_http_buffer_size=1024 * 1024)
 print(f"SocketIO initialized with mode: {socketio.async_mode}")
+instrument_socketio(socketio)
+instrument_socketio_profiling(socketio)
+
+# Servers without a native wsgi.file_wrapper (eventlet, the werkzeug dev server)
+# get one that reads in large blocks. Servers that provide one - gunicorn uses
+# os.sendfile() - keep theirs, so file bodies never pass through Python there.
+FILE_WRAPPER_BLOCK_SIZE = 256 * 1024
+
+def large_block_file_wrapper(file, buffer_size=8192):
+    """wsgi.file_wrapper fallback that ignores werkzeug's 8KB default block size"""
+    return FileWrapper(file, max(buffer_size, FILE_WRAPPER_BLOCK_SIZE))
+
+def add_file_wrapper(wsgi_app):
+    """WSGI middleware installing large_block_file_wrapper when the server has none"""
+    def wrapped_app(environ, start_response):
+        environ.setdefault('wsgi.file_wrapper', large_block_file_wrapper)
+        return wsgi_app(environ, start_response)
+    return wrapped_app
+
+app.wsgi_app = add_file_wrapper(app.wsgi_app)
 
 # Map of active WebSocket sessions to their corresponding terminal sessions
 socket_sessions = {}
@@ -66,10 +117,6 @@ socket_sessions = {}
 # Map of terminal session IDs to active command processes
 socket_processes = {}
 
-# Add at app startup to enable WebSocket support
-import eventlet
-eventlet.monkey_patch()
-
 # Debug WebSocket connection issues
 print("WebSocket support enabled with eventlet")
 print(f"Current eventlet version: {eventlet.__version__}")
@@ -87,6 +134,9 @@ def handle_connect():
 def handle_disconnect():
     """Handle client disconnection"""
     print(f"Client disconnected: {request.sid}")
+    # Stop watching directories and files this socket subscribed to
+    release_file_subscriptions(request.sid)
+    release_file_follows(request.sid)
     # Clean up any running processes for this socket
     if request.sid in socket_sessions:
         session_id = socket_sessions[request.sid]
@@ -447,7 +497,7 @@ def handle_execute_command(data):
             bufsize=1,  # Line buffered
             cwd=session['home_dir'],
             env=env,
-            preexec_fn=os.setsid  # Create new process group
+            preexec_fn=command_preexec(session['home_dir'])  # New process group, file sizes capped by quota
         )
         
         # Store process information
@@ -456,6 +506,9 @@ def handle_execute_command(data):
             'start_time': time.time()
         }
         
+        # The request context is not available inside the streaming thread
+        client_sid = request.sid
+        
         # Stream output in a separate thread to avoid blocking
         def stream_output():
             try:
@@ -477,29 +530,30 @@ def handle_execute_command(data):
                         output = os.read(fd_stdout, 1024).decode('utf-8', errors='replace')
                         if output:
                             # Emit output to client
-                            socketio.emit('command_output', {'output': output}, to=request.sid)
+                            socketio.emit('command_output', {'output': output}, to=client_sid)
                             stdout_buffer += output
                     
                     if fd_stderr in ready:
                         error = os.read(fd_stderr, 1024).decode('utf-8', errors='replace')
                         if error:
                             # Emit error to client
-                            socketio.emit('command_output', {'output': error}, to=request.sid)
+                            socketio.emit('command_output', {'output': error}, to=client_sid)
                             stderr_buffer += error
                 
                 # Get any remaining output
                 stdout_remainder = process.stdout.read()
                 if stdout_remainder:
-                    socketio.emit('command_output', {'output': stdout_remainder}, to=request.sid)
+                    socketio.emit('command_output', {'output': stdout_remainder}, to=client_sid)
                     stdout_buffer += stdout_remainder
                 
                 stderr_remainder = process.stderr.read()
                 if stderr_remainder:
-                    socketio.emit('command_output', {'output': stderr_remainder}, to=request.sid)
+                    socketio.emit('command_output', {'output': stderr_remainder}, to=client_sid)
                     stderr_buffer += stderr_remainder
                 
                 # Process finished
                 exit_code = process.wait()
+                mark_dirty(session['home_dir'])
                 
                 # Clean up process tracking
                 if session_id in socket_processes:
@@ -512,7 +566,7 @@ def handle_execute_command(data):
                             # Extract working directory from output
                             if stdout_buffer:
                                 working_dir = stdout_buffer.strip()
-                                socketio.emit('working_directory', {'path': working_dir}, to=request.sid)
+                                socketio.emit('working_directory', {'path': working_dir}, to=client_sid)
                         elif command.strip().startswith('cd '):
                             # Get working directory after cd command
                             pwd_process = subprocess.Popen(
@@ -527,7 +581,7 @@ def handle_execute_command(data):
                             pwd_output, _ = pwd_process.communicate(timeout=5)
                             if pwd_output:
                                 working_dir = pwd_output.strip()
-                                socketio.emit('working_directory', {'path': working_dir}, to=request.sid)
+                                socketio.emit('working_directory', {'path': working_dir}, to=client_sid)
                     except Exception as e:
                         print(f"Error updating working directory: {str(e)}")
                 
@@ -537,7 +591,7 @@ def handle_execute_command(data):
                     'sessionRenewed': auto_renewed,
                     'newSessionId': session_id if auto_renewed else None,
                     'workingDirectory': None  # Would be set by working_directory event
-                }, to=request.sid)
+                }, to=client_sid)
                 
             except Exception as e:
                 print(f"Error in stream_output thread: {str(e)}")
@@ -545,7 +599,7 @@ def handle_execute_command(data):
                     'error': f"Error streaming command output: {str(e)}",
                     'sessionRenewed': auto_renewed,
                     'newSessionId': session_id if auto_renewed else None
-                }, to=request.sid)
+                }, to=client_sid)
         
         # Start output streaming in a separate thread
         threading.Thread(target=stream_output, daemon=True).start()
@@ -558,28 +612,111 @@ def handle_execute_command(data):
             'newSessionId': session_id if auto_renewed else None
         }, to=request.sid)
 
-# Route to serve WebSocket terminal page
-@app.route('/ws')
-@cached_response(timeout=3600)  # Cache for 1 hour
-def websocket_terminal():
-    """Serve WebSocket terminal interface"""
-    return send_file('static/socket-terminal.html')
-
-# In-memory cache for responses
-response_cache = {}
+# In-memory cache for responses - serialized bodies and headers in LRU order
+# (OrderedDict: oldest entry first) bounded by entry count and total bytes
+response_cache = OrderedDict()
 response_cache_size = 1000  # Maximum cache entries
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = 64 * 1024  # Only tiny hot bodies - larger files stream from disk
+response_cache_bytes = 0
 response_cache_hits = 0
 response_cache_misses = 0
+response_cache_lock = threading.Lock()
+
+# Headers that describe one transfer rather than the cached representation
+UNCACHEABLE_HEADERS = {'content-length', 'content-encoding', 'transfer-encoding', 'set-cookie', 'etag', 'x-cache'}
+
+def compute_etag(body):
+    """Strong ETag for a response body"""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
 
-# Simple LRU cache for file content
-file_content_cache = cachetools.func.lru_cache(maxsize=100)
+def etag_matches(etag, if_none_match):
+    """Check an If-None-Match header against a strong ETag.
+    
+    Flask-Compress appends ':<algorithm>' to the ETag of compressed responses,
+    so a validator for any encoded variant matches the cached representation.
+    """
+    if not if_none_match:
+        return False
+    opaque = etag.strip('"')
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate.strip('"').split(':')[0] == opaque:
+            return True
+    return False
+
+def remove_response_cache_entry(cache_key):
+    """Drop one entry from response_cache - caller must hold response_cache_lock"""
+    global response_cache_bytes
+    entry = response_cache.pop(cache_key, None)
+    if entry is not None:
+        response_cache_bytes -= entry['size']
+
+def trim_response_cache(target_bytes):
+    """Evict least recently used responses until the cache holds at most target_bytes"""
+    freed = response_cache_bytes
+    with response_cache_lock:
+        while response_cache and response_cache_bytes > target_bytes:
+            remove_response_cache_entry(next(iter(response_cache)))
+    return freed - response_cache_bytes
+
+def clear_response_cache():
+    """Drop every cached response"""
+    global response_cache_bytes
+    with response_cache_lock:
+        response_cache.clear()
+        response_cache_bytes = 0
+
+def store_response_cache_entry(cache_key, entry):
+    """Insert an entry and evict least recently used entries until within limits"""
+    global response_cache_bytes
+    with response_cache_lock:
+        remove_response_cache_entry(cache_key)
+        response_cache[cache_key] = entry
+        response_cache_bytes += entry['size']
+        while response_cache and (len(response_cache) > response_cache_size or
+                                  response_cache_bytes > RESPONSE_CACHE_MAX_BYTES):
+            oldest_key = next(iter(response_cache))
+            remove_response_cache_entry(oldest_key)
+
+def build_cached_response(entry, cache_status):
+    """Build a fresh Response from a cache entry, or a 304 if the client's validator matches"""
+    if etag_matches(entry['etag'], request.headers.get('If-None-Match')):
+        response = Response(status=304)
+    else:
+        response = Response(entry['body'], status=entry['status'])
+    for name, value in entry['headers']:
+        response.headers[name] = value
+    response.headers['ETag'] = entry['etag']
+    response.headers['Cache-Control'] = entry['cache_control']
+    response.headers['X-Cache'] = cache_status
+    return response
 
-# Caching decorator for route responses
-def cached_response(timeout=300):
+def invalidate_static_response_cache(relative_path):
+    """Drop cached responses built from one file under static/"""
+    source = os.path.normpath(os.path.join(STATIC_DIR, relative_path))
+    key_prefix = f"/static/{relative_path.replace(os.sep, '/')}?"
+    with response_cache_lock:
+        stale_keys = [key for key, entry in response_cache.items()
+                      if entry['source'] == source or key.startswith(key_prefix)]
+        for key in stale_keys:
+            remove_response_cache_entry(key)
+    return len(stale_keys)
+
+register_cache('response_cache', lambda: response_cache_bytes, lambda: len(response_cache), trim_response_cache)
+
+# Caching decorator for route responses. source_file names the file a route
+# serves so the file watcher can invalidate it; /static/<path> entries are
+# matched by their request path.
+def cached_response(timeout=300, source_file=None):
     def decorator(f):
         @functools.wraps(f)
         def decorated_function(*args, **kwargs):
-            global response_cache, response_cache_hits, response_cache_misses
+            global response_cache_hits, response_cache_misses
             
             # Skip cache for authenticated/session routes
             if 'X-Session-Id' in request.headers or 'X-API-Key' in request.headers:
@@ -590,50 +727,60 @@ def cached_response(timeout=300):
             
             # Check if we have the response cached and it's not expired
             current_time = time.time()
-            if cache_key in response_cache:
-                cached_data, expiry_time = response_cache[cache_key]
-                if current_time < expiry_time:
-                    response_cache_hits += 1
-                    return cached_data
+            with response_cache_lock:
+                entry = response_cache.get(cache_key)
+                if entry is not None:
+                    if current_time < entry['expires']:
+                        response_cache.move_to_end(cache_key)
+                    else:
+                        remove_response_cache_entry(cache_key)
+                        entry = None
+            
+            if entry is not None:
+                response_cache_hits += 1
+                return build_cached_response(entry, 'HIT')
             
             # Cache miss - generate response
             response_cache_misses += 1
-            response = f(*args, **kwargs)
+            response = make_response(f(*args, **kwargs))
             
-            # Only cache successful responses that are not too large
-            # Don't cache streaming responses or file downloads
-            if not isinstance(response, tuple) or (isinstance(response, tuple) and response[1] < 300):
-                # Store in cache with expiry time
-                response_cache[cache_key] = (response, current_time + timeout)
-                
-                # Trim cache if it's too large
-                if len(response_cache) > response_cache_size:
-                    # Remove oldest entries
-                    oldest_keys = sorted(
-                        response_cache.keys(), 
-                        key=lambda k: response_cache[k][1]
-                    )[:len(response_cache) - response_cache_size]
-                    
-                    for key in oldest_keys:
-                        del response_cache[key]
-                
-            return response
+            # Only cache complete 200 responses that are not too large. Streamed
+            # file bodies are read once into bytes so every hit gets a fresh Response.
+            if (response.status_code != 200 or
+                    (response.content_length or 0) > RESPONSE_CACHE_MAX_ENTRY_BYTES or
+                    (response.is_streamed and not response.direct_passthrough)):
+                return response
+            
+            response.direct_passthrough = False
+            body = response.get_data()
+            if len(body) > RESPONSE_CACHE_MAX_ENTRY_BYTES:
+                return response
+            
+            headers = [(name, value) for name, value in response.headers.items()
+                       if name.lower() not in UNCACHEABLE_HEADERS and name.lower() != 'cache-control']
+            entry = {
+                'body': body,
+                'status': response.status_code,
+                'headers': headers,
+                'etag': compute_etag(body),
+                'cache_control': response.headers.get('Cache-Control') or f'public, max-age={timeout}',
+                'expires': current_time + timeout,
+                'source': os.path.normpath(source_file) if source_file else None,
+                'size': len(body) + sum(len(name) + len(value) for name, value in headers)
+            }
+            store_response_cache_entry(cache_key, entry)
+            
+            return build_cached_response(entry, 'MISS')
         return decorated_function
     return decorator
 
-# Function to get file contents with caching
-@file_content_cache
-def get_cached_file_content(file_path):
-    """Get file content with caching for frequently accessed files"""
-    with open(file_path, 'rb') as f:
-        return f.read()
-
 # Configuration
 DEBUG = os.environ.get('DEBUG', 'False').lower() == 'true'
 PORT = int(os.environ.get('PORT', 3000))
 SESSION_TIMEOUT = int(os.environ.get('SESSION_TIMEOUT', 3600))  # 1 hour in seconds
 USE_AUTH = os.environ.get('USE_AUTH', 'False').lower() == 'true'
 API_KEY = os.environ.get('API_KEY', 'change-this-in-production')
+ADMIN_API_KEY = os.environ.get('ADMIN_API_KEY', '')  # Unset disables the /admin endpoints
 COMMAND_TIMEOUT = int(os.environ.get('COMMAND_TIMEOUT', 300))  # 5 minutes in seconds
 ENABLE_SYSTEM_COMMANDS = os.environ.get('ENABLE_SYSTEM_COMMANDS', 'True').lower() == 'true'
 
@@ -641,9 +788,9 @@ ENABLE_SYSTEM_COMMANDS = os.environ.get('ENABLE_SYSTEM_COMMANDS', 'True').lower(
 SESSION_POOL_SIZE = int(os.environ.get('SESSION_POOL_SIZE', 10))
 MAX_POOL_AGE = int(os.environ.get('MAX_POOL_AGE', 1800))  # 30 minutes in seconds
 
-# Create required directories
-os.makedirs('logs', exist_ok=True)
-os.makedirs('user_data', exist_ok=True)
+# Fast-start mode defers the session pool, cleanup timers, memory monitor and
+# script cache warm-up until after the listener is bound
+FAST_START = os.environ.get('FAST_START', 'True').lower() == 'true'
 
 # Setup memory monitor to prevent OOM killer
 def monitor_memory_usage():
@@ -694,31 +841,24 @@ def monitor_memory_usage():
             # Always log status for debugging worker failures
             logging.info(f"Memory usage: {mem_percent:.1f}% ({mem_mb:.1f} MB)")
             
-            # Warning level - run garbage collection
+            # Keep all caches together within the global byte budget
+            freed = enforce_cache_budget()
+            if freed:
+                logging.info(f"Cache budget enforced - evicted {freed / (1024 * 1024):.1f} MB")
+            
+            # Warning level and above - shrink caches in proportion to pressure, then collect
             if mem_percent > WARNING_THRESHOLD:
                 logging.warning(f"Worker {worker_pid} high memory usage: {mem_percent:.1f}% ({mem_mb:.1f} MB)")
+                cache_target, freed = relieve_memory_pressure(mem_percent, WARNING_THRESHOLD, EMERGENCY_THRESHOLD)
+                logging.info(f"Cache target {cache_target / (1024 * 1024):.1f} MB - evicted {freed / (1024 * 1024):.1f} MB")
+                if mem_percent > CRITICAL_THRESHOLD:
+                    logging.warning(f"Worker {worker_pid} critical memory usage")
                 logging.info("Running garbage collection")
                 gc.collect()
                 
                 # Log memory after GC
                 gc_mem = psutil.Process(worker_pid).memory_info().rss / (1024 * 1024)
-                logging.info(f"Memory after GC: {gc_mem:.1f} MB (saved {mem_mb - gc_mem:.1f} MB)")
-            
-            # Critical level - release caches
-            if mem_percent > CRITICAL_THRESHOLD:
-                logging.warning(f"Worker {worker_pid} critical memory usage - releasing caches")
-                # Clear file content cache
-                file_content_cache.cache_clear()
-                # Clear response cache
-                response_cache.clear()
-                # Reset script cache
-                script_cache.clear()
-                # Force garbage collection
-                gc.collect()
-                
-                # Log memory after cache clearing
-                cache_clear_mem = psutil.Process(worker_pid).memory_info().rss / (1024 * 1024)
-                logging.info(f"Memory after cache clearing: {cache_clear_mem:.1f} MB (saved {mem_mb - cache_clear_mem:.1f} MB)")
+                logging.info(f"Memory after eviction and GC: {gc_mem:.1f} MB (saved {mem_mb - gc_mem:.1f} MB)")
             
             # Emergency level - take drastic action
             if mem_percent > EMERGENCY_THRESHOLD:
@@ -752,21 +892,22 @@ def monitor_memory_usage():
         # Sleep before next check
         time.sleep(CHECK_INTERVAL)
 
-# Start memory monitor in background thread
-try:
-    import psutil
-    # Print memory info before starting monitor to help diagnose worker failures
-    process = psutil.Process(os.getpid())
-    mem_info = process.memory_info()
-    print(f"Worker {os.getpid()} starting with {mem_info.rss / (1024 * 1024):.1f} MB memory usage")
-    
-    memory_monitor_thread = threading.Thread(target=monitor_memory_usage, daemon=True)
-    memory_monitor_thread.start()
-except ImportError:
-    print("Warning: psutil not installed. Memory monitoring disabled.")
-except Exception as e:
-    print(f"Failed to start memory monitor: {str(e)}")
-    # Continue without memory monitoring
+def start_memory_monitor():
+    """Start the memory monitor in a background thread"""
+    try:
+        import psutil
+        # Print memory info before starting monitor to help diagnose worker failures
+        process = psutil.Process(os.getpid())
+        mem_info = process.memory_info()
+        print(f"Worker {os.getpid()} starting with {mem_info.rss / (1024 * 1024):.1f} MB memory usage")
+        
+        memory_monitor_thread = threading.Thread(target=monitor_memory_usage, daemon=True)
+        memory_monitor_thread.start()
+    except ImportError:
+        print("Warning: psutil not installed. Memory monitoring disabled.")
+    except Exception as e:
+        print(f"Failed to start memory monitor: {str(e)}")
+        # Continue without memory monitoring
 
 # Session storage
 sessions = {}
@@ -774,19 +915,6 @@ running_processes = {}  # Stores active subprocesses by session_id
 session_lock = threading.Lock()
 
 
-def log_activity(log_type, data):
-    """Log activity to a file"""
-    log_file = os.path.join('logs', f"{log_type}.log")
-    timestamp = datetime.now().isoformat()
-    log_entry = {
-        'timestamp': timestamp,
-        **data
-    }
-    
-    with open(log_file, 'a') as f:
-        f.write(json.dumps(log_entry) + '\n')
-
-
 # Templates for fast file creation
 BASHRC_TEMPLATE = """
 # Auto-activate Python virtual environment
@@ -861,9 +989,65 @@ Tips
 - Long-running commands will continue in background
 """
 
-# Cache for faster session creation
+# Cache for faster session creation. Values are bytes, or memoryviews into
+# the shared segment when warmed from it.
 script_cache = {}
 
+def private_script_cache_bytes():
+    """Bytes of cached scripts held in this worker's heap rather than the shared segment"""
+    return sum(len(content) for content in list(script_cache.values()) if isinstance(content, bytes))
+
+def trim_script_cache(target_bytes):
+    """Drop private cached scripts until at most target_bytes remain - they are re-read on demand"""
+    size = private_script_cache_bytes()
+    freed = 0
+    for script_path in list(script_cache.keys()):
+        if size - freed <= target_bytes:
+            break
+        if not isinstance(script_cache.get(script_path), bytes):
+            continue
+        content = script_cache.pop(script_path, None)
+        if content is not None:
+            freed += len(content)
+    return freed
+
+register_cache('script_cache', private_script_cache_bytes, lambda: len(script_cache), trim_script_cache)
+
+def read_tool_artifacts(scripts_dir):
+    """Read every user script for the shared segment"""
+    blobs = {}
+    for script_file in sorted(os.listdir(scripts_dir)):
+        script_path = os.path.join(scripts_dir, script_file)
+        if os.path.isfile(script_path):
+            with open(script_path, 'rb') as f:
+                blobs[script_path] = f.read()
+    return {}, blobs
+
+def warm_tool_artifacts():
+    """Load all user scripts into script_cache so new homes are written from memory"""
+    scripts_dir = 'user_scripts'
+    if not os.path.exists(scripts_dir):
+        return 0
+    
+    # Map the scripts from the segment shared by all workers when possible
+    shared = load_shared_segment('scripts', fingerprint_tree(scripts_dir),
+                                 lambda: read_tool_artifacts(scripts_dir))
+    if shared is not None:
+        script_cache.update(shared[1])
+        return len(shared[1])
+    
+    loaded = 0
+    for script_file in os.listdir(scripts_dir):
+        script_path = os.path.join(scripts_dir, script_file)
+        try:
+            if os.path.isfile(script_path) and script_path not in script_cache:
+                with open(script_path, 'rb') as f:
+                    script_cache[script_path] = f.read()
+                loaded += 1
+        except Exception as e:
+            print(f"Warning: Failed to cache script {script_file}: {str(e)}")
+    return loaded
+
 def setup_user_environment(home_dir):
     """Set up a user environment with necessary files and directories - optimized for speed and reliability"""
     start_time = time.time()
@@ -964,13 +1148,16 @@ fi
                         if os.path.exists(dest_path) and os.path.getsize(dest_path) == os.path.getsize(script_path):
                             continue
                             
-                        if script_path not in script_cache:
+                        # The memory monitor may evict the entry at any time
+                        content = script_cache.get(script_path)
+                        if content is None:
                             with open(script_path, 'rb') as f:
-                                script_cache[script_path] = f.read()
+                                content = f.read()
+                            script_cache[script_path] = content
                         
                         # Write from cache
                         with open(dest_path, 'wb') as f:
-                            f.write(script_cache[script_path])
+                            f.write(content)
                         
                         # Set executable permissions
                         os.chmod(dest_path, 0o755)
@@ -1157,6 +1344,7 @@ done
         
         # Log the setup time for performance monitoring
         setup_time = time.time() - start_time
+        observe('setup_user_environment_seconds', setup_time)
         print(f"User environment setup completed in {setup_time:.2f} seconds")
         
         return True
@@ -1200,6 +1388,7 @@ def cleanup_sessions():
                 'session_id': session_id,
                 'user_id': sessions[session_id]['user_id']
             })
+            untrack_home(sessions[session_id]['home_dir'])
             del sessions[session_id]
             
     # Schedule next cleanup
@@ -1213,9 +1402,7 @@ def cleanup_on_exit():
         terminate_process(session_id)
 
 atexit.register(cleanup_on_exit)
-
-# Start session cleanup thread
-cleanup_sessions()
+atexit.register(flush_activity_log, wait=True)
 
 
 def authenticate():
@@ -1230,6 +1417,13 @@ def authenticate():
     return True
 
 
+def authenticate_admin():
+    """Check the admin key, required for /admin endpoints whether or not USE_AUTH is set"""
+    if not ADMIN_API_KEY:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Admin-Key', '').encode(), ADMIN_API_KEY.encode())
+
+
 def get_session(session_id):
     """Get and validate a session"""
     with session_lock:
@@ -1250,48 +1444,61 @@ def get_session(session_id):
 
 
 # Web Terminal Interface Routes
+# The pages are served from the shared precompressed store once it is loaded,
+# and from the per-worker response cache until then
 @app.route('/')
-@cached_response(timeout=3600)  # Cache for 1 hour
 def index():
     """Serve web terminal interface"""
+    response = get_static_asset_response('simple-terminal.html')
+    return response if response is not None else index_from_disk()
+
+@cached_response(timeout=86400, source_file='static/simple-terminal.html')  # Invalidated by the file watcher
+def index_from_disk():
     return send_file('static/simple-terminal.html')
 
+# Route to serve WebSocket terminal page
+@app.route('/ws')
+def websocket_terminal():
+    """Serve WebSocket terminal interface"""
+    response = get_static_asset_response('socket-terminal.html')
+    return response if response is not None else websocket_terminal_from_disk()
+
+@cached_response(timeout=86400, source_file='static/socket-terminal.html')  # Invalidated by the file watcher
+def websocket_terminal_from_disk():
+    return send_file('static/socket-terminal.html')
+
 @app.route('/status')
-@cached_response(timeout=60)  # Cache for 1 minute only to keep data fresh
 def status_dashboard():
     """Serve server status dashboard for monitoring"""
+    response = get_static_asset_response('status.html')
+    return response if response is not None else status_dashboard_from_disk()
+
+@cached_response(timeout=86400, source_file='static/status.html')  # Invalidated by the file watcher
+def status_dashboard_from_disk():
     return send_file('static/status.html')
 
 
 @app.route('/static/<path:path>')
-@cached_response(timeout=86400)  # Cache for 1 day
 def serve_static(path):
-    """Serve static files"""
-    # Use cached file content for common static files
-    if path.endswith(('.js', '.css', '.html')):
-        try:
-            file_path = os.path.join('static', path)
-            if os.path.exists(file_path) and os.path.isfile(file_path):
-                content = get_cached_file_content(file_path)
-                
-                # Set content type based on file extension
-                content_type = 'text/plain'
-                if path.endswith('.js'):
-                    content_type = 'application/javascript'
-                elif path.endswith('.css'):
-                    content_type = 'text/css'
-                elif path.endswith('.html'):
-                    content_type = 'text/html'
-                
-                response = make_response(content)
-                response.headers['Content-Type'] = content_type
-                response.headers['Cache-Control'] = 'public, max-age=86400'
-                return response
-        except Exception:
-            # Fall back to standard method if caching fails
-            pass
-            
-    return send_from_directory('static', path)
+    """Serve static files, preferring the precompressed asset store"""
+    # Precompressed variants carry their own ETags and must not share a cache
+    # entry across encodings, so they bypass the response cache
+    response = get_static_asset_response(path)
+    if response is not None:
+        return response
+    return serve_static_file(path)
+
+
+@cached_response(timeout=86400)  # Cache for 1 day
+def serve_static_file(path):
+    """Serve a static file that is not in the precompressed store.
+    
+    The body is handed to the server's wsgi.file_wrapper instead of being read
+    into memory, with mtime/size validators for conditional requests. Only tiny
+    files are copied into the response cache.
+    """
+    return send_from_directory(os.path.abspath(STATIC_DIR), path, mimetype=guess_content_type(path),
+                               max_age=STATIC_ASSET_MAX_AGE, conditional=True)
 
 
 # API Endpoints
@@ -1302,8 +1509,12 @@ MAX_POOL_AGE = 1800  # Maximum age of a pooled session (30 minutes)
 session_pool_lock = threading.Lock()
 pool_initialization_in_progress = False  # Flag to prevent multiple initializations
 
-def initialize_session_pool():
-    """Pre-create sessions for the pool to speed up session allocation"""
+def initialize_session_pool(wait=False):
+    """Pre-create sessions for the pool to speed up session allocation
+    
+    With wait=True the environment setup threads are joined before returning,
+    which the startup phase uses to know when the pool is warm.
+    """
     global pool_initialization_in_progress
     
     # Use a flag to prevent multiple threads from initializing at once
@@ -1312,6 +1523,7 @@ def initialize_session_pool():
         
     # Set flag before acquiring lock to prevent race conditions
     pool_initialization_in_progress = True
+    setup_threads = []
     
     try:
         with session_pool_lock:
@@ -1360,11 +1572,13 @@ def initialize_session_pool():
             # Now process the environment setup for each new session in background
             for session in new_sessions:
                 # Set up the complete environment in a separate thread
-                threading.Thread(
+                setup_thread = threading.Thread(
                     target=setup_user_environment,
                     args=(session['home_dir'],),
                     daemon=True
-                ).start()
+                )
+                setup_thread.start()
+                setup_threads.append(setup_thread)
                 
             print(f"Session pool initialized with {len(session_pool)} sessions (added {len(new_sessions)} new)")
     except Exception as e:
@@ -1373,11 +1587,146 @@ def initialize_session_pool():
         # Reset flag when done
         pool_initialization_in_progress = False
     
+    if wait:
+        for setup_thread in setup_threads:
+            setup_thread.join()
+    
     # Schedule next pool refill
     threading.Timer(30.0, initialize_session_pool).start()  # Run more frequently for better availability
 
-# Start session pool initialization
-initialize_session_pool()
+
+# Startup phases - nothing heavy runs at import time
+startup_state = {
+    'started': False,
+    'artifacts_ready': False,
+    'pool_ready': False
+}
+startup_timings = {}  # Phase name -> duration in seconds
+startup_lock = threading.Lock()
+
+def run_startup_phase(name, func, *args, **kwargs):
+    """Run one startup phase and record how long it took"""
+    phase_start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        startup_timings[name] = round(time.time() - phase_start, 4)
+        print(f"Startup phase '{name}' completed in {startup_timings[name]:.3f} seconds")
+
+def prepare_runtime():
+    """Create required directories and report memory before serving"""
+    os.makedirs('logs', exist_ok=True)
+    os.makedirs('user_data', exist_ok=True)
+    try:
+        import psutil
+        mem = psutil.virtual_memory()
+        print(f"Available memory: {mem.available / (1024*1024):.1f}MB / {mem.total / (1024*1024):.1f}MB")
+    except ImportError:
+        print("psutil not available - skipping memory check")
+
+def run_deferred_startup():
+    """Warm tool artifacts and the session pool, then start maintenance timers"""
+    run_startup_phase('tool_artifacts', warm_tool_artifacts)
+    run_startup_phase('static_assets', build_static_asset_store)
+    run_startup_phase('file_watcher', start_cache_invalidation)
+    startup_state['artifacts_ready'] = True
+    
+    run_startup_phase('activity_log', start_activity_log_writer)
+    run_startup_phase('memory_monitor', start_memory_monitor)
+    run_startup_phase('session_cleanup', cleanup_sessions)
+    run_startup_phase('disk_usage', start_usage_reconciler)
+    run_startup_phase('trash_reaper', start_trash_reaper)
+    run_startup_phase('dedup_store', start_dedup_collector)
+    
+    run_startup_phase('session_pool', initialize_session_pool, wait=True)
+    startup_state['pool_ready'] = True
+    
+    total = time.time() - app.config['START_TIME']
+    print(f"Server ready {total:.3f} seconds after start: {json.dumps(startup_timings)}")
+
+def on_static_file_change(directory, name):
+    """File watcher callback - refresh the precompressed store and drop cached responses"""
+    if name is None:
+        # Directory gone or events lost - rebuild everything derived from static/
+        build_static_asset_store()
+        clear_response_cache()
+        return
+    
+    file_path = os.path.join(directory, name)
+    relative_path = os.path.relpath(file_path, os.path.abspath(STATIC_DIR))
+    if os.path.isdir(file_path):
+        watch_static_tree(file_path)
+        return
+    
+    refresh_static_asset(relative_path)
+    invalidate_static_response_cache(relative_path)
+
+def watch_static_tree(root=STATIC_DIR):
+    """Watch static/ and its subdirectories"""
+    for directory, _, _ in os.walk(root):
+        watch_directory(directory, on_static_file_change)
+
+def start_cache_invalidation():
+    """Start the file watcher and register the static tree"""
+    backend = start_file_watcher()
+    watch_static_tree()
+    return backend
+
+def start_background_services():
+    """
+    Run the explicit startup phase. Safe to call more than once.
+    
+    Only directory creation happens inline. In fast-start mode everything else
+    is handed to a background task, which eventlet does not schedule until the
+    caller yields - when called right before socketio.run() that is after the
+    listening socket is bound. With FAST_START=false the heavy work runs
+    synchronously before returning.
+    """
+    with startup_lock:
+        if startup_state['started']:
+            return
+        startup_state['started'] = True
+    
+    run_startup_phase('prepare_runtime', prepare_runtime)
+    
+    if FAST_START:
+        socketio.start_background_task(run_deferred_startup)
+    else:
+        run_deferred_startup()
+
+@app.before_request
+def ensure_background_services():
+    """Start background services on the first request for runners that do not call start_background_services()"""
+    if not startup_state['started']:
+        start_background_services()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Observe request latency, plus the session-specific histograms for commands and session creation"""
+    start = g.get('request_start')
+    if start is None:
+        return response
+    duration = time.perf_counter() - start
+    observe('http_request_duration_seconds', duration, request.endpoint or 'unmatched', response.status_code)
+    if request.endpoint == 'execute_command' and 'command_session' in g:
+        observe('command_duration_seconds', duration, g.command_session)
+    elif request.endpoint == 'create_session' and 'session_source' in g:
+        observe('create_session_duration_seconds', duration, g.session_source)
+    return response
+
+@app.before_request
+def start_request_profiling():
+    if start_profiling(request.endpoint or 'unmatched'):
+        g.profiled = True
+
+@app.teardown_request
+def stop_request_profiling(exception=None):
+    if g.get('profiled'):
+        stop_profiling()
 
 @app.route('/create-session', methods=['POST'])
 def create_session():
@@ -1419,8 +1768,10 @@ def create_session():
             'client_ip': client_ip,
             'created': time.time(),
             'last_accessed': time.time(),
-            'home_dir': home_dir
+            'home_dir': home_dir,
+            'from_pool': pooled_session is not None
         }
+    g.session_source = 'pool' if pooled_session else 'new'
     
     # Initialize environment in a background thread to avoid blocking response
     def background_init(session_home_dir):
@@ -1562,6 +1913,7 @@ def execute_command():
         auto_renewed = True
     else:
         auto_renewed = False
+    g.command_session = 'renewed' if auto_renewed else ('pooled' if session.get('from_pool') else 'new')
         
     data = request.json or {}
     command = data.get('command')
@@ -1908,7 +2260,7 @@ def execute_command():
             text=True,
             cwd=session['home_dir'],
             env=env,
-            preexec_fn=os.setsid  # Create new process group
+            preexec_fn=command_preexec(session['home_dir'])  # New process group, file sizes capped by quota
         )
         
         # Store process information
@@ -1919,6 +2271,7 @@ def execute_command():
         
         try:
             stdout, stderr = process.communicate(timeout=COMMAND_TIMEOUT)
+            mark_dirty(session['home_dir'])
             # Remove from running processes if completed
             if session_id in running_processes:
                 del running_processes[session_id]
@@ -1963,6 +2316,7 @@ def execute_command():
             return response
             
         except subprocess.TimeoutExpired:
+            mark_dirty(session['home_dir'])
             # Keep process running but return timeout message
             timeout_response = {
                 'error': f'Command exceeded {COMMAND_TIMEOUT} second timeout limit. ' + 
@@ -2012,7 +2366,8 @@ def session_info():
         'userId': session['user_id'],
         'created': datetime.fromtimestamp(session['created']).isoformat(),
         'lastAccessed': datetime.fromtimestamp(session['last_accessed']).isoformat(),
-        'expiresIn': int(SESSION_TIMEOUT - (time.time() - session['last_accessed'])) * 1000  # ms
+        'expiresIn': int(SESSION_TIMEOUT - (time.time() - session['last_accessed'])) * 1000,  # ms
+        'diskUsage': quota_status(session['home_dir'])
     })
 
 
@@ -2037,6 +2392,7 @@ def delete_session():
             # Cleanup session data
             home_dir = sessions[session_id]['home_dir']
             del sessions[session_id]
+            untrack_home(home_dir)
             
             # Could delete user data here, but we'll leave it for now
             # import shutil
@@ -2055,6 +2411,15 @@ def health_check():
     mem_info = process.memory_info()
     mem_percent = process.memory_percent()
     
+    # USS and PSS split shared pages (such as the shared asset segment) between
+    # workers, unlike RSS - they need /proc/<pid>/smaps, so may be unavailable
+    try:
+        full_info = process.memory_full_info()
+        uss_mb = full_info.uss / (1024 * 1024)
+        pss_mb = getattr(full_info, 'pss', 0) / (1024 * 1024)
+    except (psutil.AccessDenied, AttributeError, OSError):
+        uss_mb = pss_mb = None
+    
     # Gather session information
     with session_lock:
         active_sessions = len(sessions)
@@ -2084,6 +2449,9 @@ def health_check():
         'memory': {
             'percent': f"{mem_percent:.1f}%",
             'used_mb': mem_info.rss / (1024 * 1024),
+            'uss_mb': uss_mb,
+            'pss_mb': pss_mb,
+            'shared_mb': getattr(mem_info, 'shared', 0) / (1024 * 1024),
             'status': memory_status
         },
         'pooledSessions': available_pool_sessions,
@@ -2095,17 +2463,111 @@ def health_check():
         'cacheStats': {
             'responseCache': {
                 'size': len(response_cache),
+                'bytes': response_cache_bytes,
                 'hits': response_cache_hits,
                 'misses': response_cache_misses
             },
-            'fileCache': getattr(file_content_cache, 'currsize', 0)
-        }
+            'fileCache': get_static_asset_stats()['assets'],
+            'staticAssets': get_static_asset_stats(),
+            'registry': get_cache_stats(),
+            'sharedSegments': get_shared_segment_stats()
+        },
+        'fileWatcher': get_file_watcher_stats(),
+        'fileEvents': get_file_event_stats(),
+        'fileFollow': get_file_follow_stats(),
+        'diskUsage': get_disk_usage_stats(),
+        'trash': get_trash_stats(),
+        'dedup': get_dedup_stats(),
+        'profiler': get_profiler_stats(),
+        'activityLog': get_activity_log_stats()
     })
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics - histograms are recorded as requests run, gauges read here"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/profiler', methods=['GET', 'POST', 'DELETE'])
+def admin_profiler():
+    """Show, change or reset the sampling profiler"""
+    if not authenticate_admin():
+        return jsonify({'error': 'Admin authentication failed'}), 403
+
+    if request.method == 'DELETE':
+        reset_profile()
+        return jsonify(get_profiler_stats())
+
+    if request.method == 'POST':
+        data = request.json or {}
+        try:
+            sample_rate = float(data['sampleRate']) if data.get('sampleRate') is not None else None
+            interval = float(data['interval']) if data.get('interval') is not None else None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'sampleRate and interval must be numbers'}), 400
+        enabled = bool(data['enabled']) if 'enabled' in data else None
+        status, error = configure_profiler(enabled, sample_rate, interval)
+        if error:
+            return jsonify({'error': error}), 400
+        return jsonify(status)
+
+    return jsonify(get_profiler_stats())
+
+
+@app.route('/admin/profiler/profile', methods=['GET'])
+def download_profile():
+    """Aggregated stacks as collapsed stacks (default) or a speedscope file"""
+    if not authenticate_admin():
+        return jsonify({'error': 'Admin authentication failed'}), 403
+
+    label = request.args.get('label')
+    profile_format = request.args.get('format', 'collapsed')
+    if profile_format == 'speedscope':
+        response = Response(json.dumps(export_speedscope(label)), mimetype='application/json')
+        filename = 'profile.speedscope.json'
+    elif profile_format == 'collapsed':
+        response = Response(export_collapsed(label), mimetype='text/plain')
+        filename = 'profile.collapsed.txt'
+    else:
+        return jsonify({'error': 'format must be collapsed or speedscope'}), 400
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness endpoint - reports whether the session pool and tool artifacts are warm"""
+    with session_pool_lock:
+        available_pool_sessions = len(session_pool)
+    
+    ready = startup_state['artifacts_ready'] and startup_state['pool_ready']
+    
+    return jsonify({
+        'status': 'ready' if ready else 'starting',
+        'artifactsReady': startup_state['artifacts_ready'],
+        'poolReady': startup_state['pool_ready'],
+        'pooledSessions': available_pool_sessions,
+        'fastStart': FAST_START,
+        'startupPhases': dict(startup_timings)
+    }), 200 if ready else 503
+
+
+register_gauge('sessions_active', 'Sessions currently registered', lambda: len(sessions))
+register_gauge('session_pool_available', 'Pre-created sessions waiting in the pool', lambda: len(session_pool))
+register_gauge('running_processes', 'Commands still running, by transport',
+               lambda: [(('http',), len(running_processes)), (('socketio',), len(socket_processes))], ('transport',))
+register_gauge('cache_bytes', 'Bytes held by each in-memory cache',
+               lambda: [((name,), cache['bytes']) for name, cache in get_cache_stats()['caches'].items()], ('cache',))
+register_gauge('trash_pending', 'Deleted trees waiting for the trash reaper', lambda: get_trash_stats()['pending'])
+register_gauge('activity_log_dropped_total', 'Activity log entries dropped because the writer fell behind',
+               lambda: get_activity_log_stats()['dropped'], metric_type='counter')
+
 # Register file management endpoints with Flask app
 # Moved here after get_session is defined to avoid NameError
 register_file_management_endpoints(app, get_session)
+register_file_event_handlers(socketio, get_session)
+register_file_follow_handlers(socketio, get_session)
 
 # Serve the file browser interface
 @app.route('/files-browser')
@@ -2120,4 +2582,5 @@ if __name__ == '__main__':
     print(f"Web terminal available at http://localhost:{PORT}")
     print(f"File browser available at http://localhost:{PORT}/files-browser")
     
+    start_background_services()
     app.run(host='0.0.0.0', port=PORT, debug=DEBUG)
@@ -0,0 +1,152 @@
+"""
+Prometheus metrics in the text exposition format, without a client library.
+
+Counters and histograms are plain lists updated in place, without a lock.
+Green threads never switch in the middle of an update, so under eventlet
+nothing is lost; with OS threads an occasional increment may be, which is
+acceptable for metrics and keeps recording to a dict lookup and two list
+additions on the hot path. Histogram buckets are stored as individual counts
+and only made cumulative when /metrics is rendered.
+
+Gauges are functions evaluated at scrape time, so values that are expensive
+to compute are only computed when someone asks for them.
+"""
+
+import os
+import bisect
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Metric name -> {'type', 'help', 'labels': label names, 'buckets'}
+metric_definitions = {}
+# Metric name -> {label values: [count per bucket..., count above the last bucket, sum, count]} for
+# histograms, or {label values: [value]} for counters
+metric_values = {}
+# Metric name -> {'help', 'labels', 'type', 'collect': fn() returning a number or [(label values, number)]}
+gauge_collectors = {}
+
+
+def define_counter(name, help_text, labels=()):
+    metric_definitions[name] = {'type': 'counter', 'help': help_text, 'labels': labels, 'buckets': None}
+    # An unlabelled counter is reported as 0 before anything is counted
+    metric_values[name] = {} if labels else {(): [0]}
+
+
+def define_histogram(name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+    metric_definitions[name] = {'type': 'histogram', 'help': help_text, 'labels': labels, 'buckets': buckets}
+    metric_values[name] = {}
+
+
+def register_gauge(name, help_text, collect, labels=(), metric_type='gauge'):
+    """Report a value read at scrape time - metric_type 'counter' for totals kept elsewhere"""
+    gauge_collectors[name] = {'help': help_text, 'labels': labels, 'type': metric_type, 'collect': collect}
+
+
+def increment(name, amount=1, *label_values):
+    series = metric_values[name].get(label_values)
+    if series is None:
+        series = metric_values[name].setdefault(label_values, [0])
+    series[0] += amount
+
+
+def observe(name, value, *label_values):
+    """Record one histogram sample"""
+    series = metric_values[name].get(label_values)
+    if series is None:
+        buckets = metric_definitions[name]['buckets']
+        series = metric_values[name].setdefault(label_values, [0] * (len(buckets) + 3))
+    series[bisect.bisect_left(metric_definitions[name]['buckets'], value)] += 1
+    series[-2] += value
+    series[-1] += 1
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value == float('inf'):
+            return '+Inf'
+        if value == float('-inf'):
+            return '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def render_metrics():
+    """All metrics in the Prometheus text format, version 0.0.4"""
+    lines = []
+    for name, definition in sorted(metric_definitions.items()):
+        lines.append(f'# HELP {name} {definition["help"]}')
+        lines.append(f'# TYPE {name} {definition["type"]}')
+        for label_values, series in sorted(list(metric_values[name].items())):
+            labels = definition['labels']
+            if definition['type'] == 'counter':
+                lines.append(f'{name}{format_labels(labels, label_values)} {format_value(series[0])}')
+                continue
+            cumulative = 0
+            for bound, count in zip(definition['buckets'] + (float('inf'),), series[:-2]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{format_labels(labels, label_values, ("le", le))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels, label_values)} {format_value(float(series[-2]))}')
+            lines.append(f'{name}_count{format_labels(labels, label_values)} {series[-1]}')
+
+    for name, gauge in sorted(gauge_collectors.items()):
+        try:
+            collected = gauge['collect']()
+        except Exception as e:
+            print(f"Error collecting metric {name}: {str(e)}")
+            continue
+        lines.append(f'# HELP {name} {gauge["help"]}')
+        lines.append(f'# TYPE {name} {gauge["type"]}')
+        if isinstance(collected, (int, float)):
+            collected = [((), collected)]
+        for label_values, value in collected:
+            lines.append(f'{name}{format_labels(gauge["labels"], label_values)} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def resident_memory_bytes():
+    """RSS from /proc/self/statm - one small read instead of a psutil call"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def instrument_socketio(socketio):
+    """Count Socket.IO emits by event, and bytes handed to Engine.IO, by wrapping the two send paths"""
+    emit = socketio.emit
+    eio_send = socketio.server.eio.send
+
+    def counted_emit(event, *args, **kwargs):
+        increment('socketio_emits_total', 1, event)
+        return emit(event, *args, **kwargs)
+
+    def counted_send(sid, data):
+        increment('socketio_sent_bytes_total', len(data) if isinstance(data, (str, bytes)) else 0)
+        return eio_send(sid, data)
+
+    socketio.emit = counted_emit
+    socketio.server.eio.send = counted_send
+
+
+define_histogram('http_request_duration_seconds', 'Time to produce a response, by endpoint (streams: until headers)',
+                 ('endpoint', 'status'))
+define_histogram('command_duration_seconds', 'Latency of /execute-command by how the session was obtained',
+                 ('session',))
+define_histogram('create_session_duration_seconds', 'Latency of /create-session by session source', ('source',))
+define_histogram('setup_user_environment_seconds', 'Time to set up a new home directory')
+define_counter('socketio_emits_total', 'Socket.IO events emitted, by event name', ('event',))
+define_counter('socketio_sent_bytes_total', 'Encoded Socket.IO packet bytes sent to clients')
+register_gauge('process_resident_memory_bytes', 'Resident memory of this worker', resident_memory_bytes)
+register_gauge('process_cpu_seconds_total', 'User and system CPU time of this worker',
+               lambda: sum(os.times()[:2]), metric_type='counter')
@@ -0,0 +1,248 @@
+"""
+Sampling profiler for HTTP requests and Socket.IO handlers.
+
+Off by default. An administrator turns it on through /admin/profiler with a
+sample rate; that fraction of requests and Socket.IO events is then profiled.
+While it is on, an interval timer raises SIGALRM every PROFILER_INTERVAL
+seconds and the handler records the stack of every profiled request in
+flight: the interrupted frame for the one running, and the suspended frame
+for the others, so time spent waiting on a command or a lock is counted as
+well as time on the CPU. Stacks are aggregated per endpoint or event into
+counts, ready to download as collapsed stacks (flamegraph.pl, speedscope) or
+a speedscope file.
+
+When the profiler is off no timer is armed and each request pays for one
+dictionary lookup.
+"""
+
+import os
+import sys
+import time
+import random
+import signal
+import threading
+
+import greenlet
+
+PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', 0.1))  # Fraction of requests profiled
+PROFILER_INTERVAL = float(os.environ.get('PROFILER_INTERVAL', 0.005))  # Seconds between stack samples
+PROFILER_MAX_STACKS = 20000  # Distinct stacks kept; further samples are counted as truncated
+PROFILER_MAX_DEPTH = 128
+
+# Profiled greenlet -> (label, thread id)
+profiled_requests = {}
+# Label -> {stack as a tuple of code objects, root first: sample count}
+profile_stacks = {}
+# Code object -> frame name, so the signal handler never formats strings twice
+frame_names = {}
+profiler_lock = threading.Lock()
+profiler_state = {
+    'enabled': False,
+    'sample_rate': PROFILER_SAMPLE_RATE,
+    'interval': PROFILER_INTERVAL,
+    'enabled_at': None,
+    'requests': 0,
+    'samples': 0,
+    'stacks': 0,
+    'truncated': 0,
+    'previous_handler': None
+}
+
+
+def frame_name(code):
+    name = frame_names.get(code)
+    if name is None:
+        name = frame_names[code] = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+    return name
+
+
+def record_stack(label, frame):
+    stack = []
+    while frame is not None and len(stack) < PROFILER_MAX_DEPTH:
+        stack.append(frame.f_code)
+        frame = frame.f_back
+    stack.reverse()
+    stack = tuple(stack)
+
+    stacks = profile_stacks.get(label)
+    if stacks is None:
+        stacks = profile_stacks[label] = {}
+    if stack in stacks:
+        stacks[stack] += 1
+    elif profiler_state['stacks'] < PROFILER_MAX_STACKS:
+        stacks[stack] = 1
+        profiler_state['stacks'] += 1
+    else:
+        profiler_state['truncated'] += 1
+        return
+    profiler_state['samples'] += 1
+
+
+def take_sample(signum, frame):
+    """SIGALRM handler: record one stack for every profiled request in flight"""
+    if not profiled_requests:
+        return
+    current = greenlet.getcurrent()
+    thread_frames = None
+    for glet, (label, thread_id) in list(profiled_requests.items()):
+        if glet is current:
+            sampled_frame = frame
+        elif glet.gr_frame is not None:
+            # Suspended green thread - where it is waiting
+            sampled_frame = glet.gr_frame
+        else:
+            # Running in another OS thread, when the server is not using eventlet
+            if thread_frames is None:
+                thread_frames = sys._current_frames()
+            sampled_frame = thread_frames.get(thread_id)
+        if sampled_frame is not None:
+            record_stack(label, sampled_frame)
+
+
+def start_profiling(label):
+    """Profile the calling request if the profiler is on and it is picked by the sample rate.
+
+    Returns True if it was, in which case stop_profiling must be called when it ends.
+    """
+    if not profiler_state['enabled'] or random.random() >= profiler_state['sample_rate']:
+        return False
+    profiled_requests[greenlet.getcurrent()] = (label, threading.get_ident())
+    profiler_state['requests'] += 1
+    return True
+
+
+def stop_profiling():
+    profiled_requests.pop(greenlet.getcurrent(), None)
+
+
+def instrument_socketio_profiling(socketio):
+    """Profile Socket.IO event handlers, by wrapping the call Flask-SocketIO makes to each of them"""
+    handle_event = socketio._handle_event
+
+    def profiled_handle_event(handler, message, namespace, sid, *args):
+        if not start_profiling(f'socketio:{message}'):
+            return handle_event(handler, message, namespace, sid, *args)
+        try:
+            return handle_event(handler, message, namespace, sid, *args)
+        finally:
+            stop_profiling()
+
+    socketio._handle_event = profiled_handle_event
+
+
+def configure_profiler(enabled=None, sample_rate=None, interval=None):
+    """
+    Turn the profiler on or off and change its settings.
+
+    Returns:
+        tuple: (status, error) - error is a message if the settings are invalid
+    """
+    if sample_rate is not None and not 0 < sample_rate <= 1:
+        return None, 'sampleRate must be greater than 0 and at most 1'
+    if interval is not None and not 0.001 <= interval <= 1:
+        return None, 'interval must be between 0.001 and 1 seconds'
+
+    with profiler_lock:
+        if sample_rate is not None:
+            profiler_state['sample_rate'] = sample_rate
+        if interval is not None:
+            profiler_state['interval'] = interval
+        try:
+            if enabled and not profiler_state['enabled']:
+                # Signal handlers can only be installed from the main thread
+                profiler_state['previous_handler'] = signal.signal(signal.SIGALRM, take_sample)
+                profiler_state['enabled'] = True
+                profiler_state['enabled_at'] = time.time()
+                print(f"Profiler enabled for {profiler_state['sample_rate']:.0%} of requests")
+            elif enabled is False and profiler_state['enabled']:
+                profiler_state['enabled'] = False
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, profiler_state['previous_handler'] or signal.SIG_DFL)
+                profiled_requests.clear()
+                print("Profiler disabled")
+        except ValueError as e:
+            profiler_state['enabled'] = False
+            return None, f'Profiler cannot run here: {str(e)}'
+        if profiler_state['enabled']:
+            signal.setitimer(signal.ITIMER_REAL, profiler_state['interval'], profiler_state['interval'])
+    return get_profiler_stats(), None
+
+
+def reset_profile():
+    """Discard the samples collected so far"""
+    with profiler_lock:
+        profile_stacks.clear()
+        profiler_state['requests'] = 0
+        profiler_state['samples'] = 0
+        profiler_state['stacks'] = 0
+        profiler_state['truncated'] = 0
+
+
+def collected_stacks(label=None):
+    """(label, stack, count) for every aggregated stack, optionally for one label"""
+    return [(stack_label, stack, count)
+            for stack_label, stacks in list(profile_stacks.items())
+            if label is None or stack_label == label
+            for stack, count in list(stacks.items())]
+
+
+def export_collapsed(label=None):
+    """Brendan Gregg's collapsed stack format: one 'label;frame;frame count' line per stack"""
+    lines = []
+    for stack_label, stack, count in collected_stacks(label):
+        frames = ';'.join([stack_label] + [frame_name(code).replace(';', ':') for code in stack])
+        lines.append(f'{frames} {count}')
+    lines.sort()
+    return '\n'.join(lines) + '\n'
+
+
+def export_speedscope(label=None):
+    """A speedscope file with one sampled profile per endpoint or event, weighted in seconds"""
+    frames = []
+    frame_indexes = {}
+    profiles = {}
+    interval = profiler_state['interval']
+    for stack_label, stack, count in collected_stacks(label):
+        indexes = []
+        for code in stack:
+            index = frame_indexes.get(code)
+            if index is None:
+                index = frame_indexes[code] = len(frames)
+                frames.append({'name': code.co_name, 'file': code.co_filename, 'line': code.co_firstlineno})
+            indexes.append(index)
+        profile = profiles.setdefault(stack_label, {'samples': [], 'weights': []})
+        profile['samples'].append(indexes)
+        profile['weights'].append(count * interval)
+
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': 'terminal-server profile',
+        'exporter': 'terminal-server profiler',
+        'activeProfileIndex': 0,
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': stack_label,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': sum(profile['weights']),
+            'samples': profile['samples'],
+            'weights': profile['weights']
+        } for stack_label, profile in sorted(profiles.items())]
+    }
+
+
+def get_profiler_stats():
+    """Profiler settings and sample counts for /admin/profiler and health reporting"""
+    return {
+        'enabled': profiler_state['enabled'],
+        'sampleRate': profiler_state['sample_rate'],
+        'interval': profiler_state['interval'],
+        'enabledAt': profiler_state['enabled_at'],
+        'inFlight': len(profiled_requests),
+        'requests': profiler_state['requests'],
+        'samples': profiler_state['samples'],
+        'stacks': profiler_state['stacks'],
+        'truncated': profiler_state['truncated'],
+        'labels': sorted(profile_stacks)
+    }
@@ -16,7 +16,7 @@ eventlet.monkey_patch()
 def run_server():
     """Run the Flask app with Socket.IO support"""
     # Import the app and socketio instance here after monkey patching
-    from flask_server import app, socketio
+    from flask_server import app, socketio, start_background_services
     
     # Get port from environment or use default
     port = int(os.environ.get('PORT', 3000))
@@ -29,6 +29,9 @@ def run_server():
     print(f"Debug mode: {debug}")
     print(f"WebSocket mode: {socketio.async_mode}")
     
+    # Startup phase - heavy work is deferred until the listener is bound
+    start_background_services()
+    
     # Start the socketio server with allow_unsafe_werkzeug=True for production
     # This ensures that the server starts even in production environments
     socketio.run(
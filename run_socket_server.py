@@ -8,7 +8,7 @@ os.environ['EVENTLET_NO_GREENDNS'] = '1'  # Avoid DNS resolution issues
 eventlet.monkey_patch()
 
 # Import the Flask app and socketio instance
-from flask_server import app, socketio
+from flask_server import app, socketio, start_background_services
 
 if __name__ == "__main__":
     # Get port from environment or use default
@@ -19,6 +19,9 @@ if __name__ == "__main__":
     
     print(f"Starting WebSocket server on port {port} with debug={debug}")
     
+    # Startup phase - heavy work is deferred until the listener is bound
+    start_background_services()
+    
     # Start the socketio server
     socketio.run(
         app,
@@ -0,0 +1,180 @@
+"""
+Read-only shared memory segments for startup artifacts.
+
+Every worker used to precompress the static assets and read the user scripts
+into its own heap. Instead, the first process to start packs them into one
+file under SHARED_ASSETS_DIR (tmpfs /dev/shm by default) and every worker maps
+it read-only, so the pages live once in the page cache and resident memory
+stays flat as workers are added. Segments are named by a fingerprint of their
+source files, so a deploy or an edit builds a new one instead of reusing stale
+data.
+"""
+
+import os
+import json
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import tempfile
+import threading
+
+SHARED_ASSETS_ENABLED = os.environ.get('SHARED_ASSETS', 'True').lower() == 'true'
+SHARED_ASSETS_DIR = os.environ.get('SHARED_ASSETS_DIR',
+                                   '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+SEGMENT_PREFIX = 'termux-assets'
+
+# Segment layout: magic, index length, JSON index, then the blobs back to back
+SEGMENT_MAGIC = b'TXASSET1'
+SEGMENT_HEADER = struct.Struct('<8sQ')
+
+# Segment name -> {'path', 'mmap', 'bytes', 'entries', 'built'} for the segments this process mapped
+shared_segments = {}
+shared_segments_lock = threading.Lock()
+
+
+def fingerprint_tree(directory, version=''):
+    """Hash of every file's path, size and mtime under a directory"""
+    digest = hashlib.blake2b(version.encode(), digest_size=12)
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            digest.update(f'{os.path.relpath(file_path, directory)}\0{stat.st_size}\0{stat.st_mtime_ns}\0'.encode())
+    return digest.hexdigest()
+
+
+def segment_path(name, fingerprint):
+    return os.path.join(SHARED_ASSETS_DIR, f'{SEGMENT_PREFIX}-{name}-{fingerprint}.bin')
+
+
+def write_segment(path, meta, blobs):
+    """Write a segment to a temporary file and rename it into place, so readers never see it half written"""
+    index = {}
+    offset = 0
+    for key, data in blobs.items():
+        index[key] = [offset, len(data)]
+        offset += len(data)
+    header = json.dumps({'meta': meta, 'blobs': index}).encode('utf-8')
+
+    fd, temp_path = tempfile.mkstemp(dir=SHARED_ASSETS_DIR, prefix=f'.{SEGMENT_PREFIX}-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, len(header)))
+            f.write(header)
+            for data in blobs.values():
+                f.write(data)
+        os.chmod(temp_path, 0o444)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def map_segment(path):
+    """Map a segment read-only. Returns (mmap, meta, {key: memoryview})."""
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, header_length = SEGMENT_HEADER.unpack_from(mapped, 0)
+    if magic != SEGMENT_MAGIC:
+        mapped.close()
+        raise ValueError(f'{path} is not a shared asset segment')
+    header = json.loads(mapped[SEGMENT_HEADER.size:SEGMENT_HEADER.size + header_length])
+
+    base = SEGMENT_HEADER.size + header_length
+    view = memoryview(mapped)
+    blobs = {key: view[base + offset:base + offset + length]
+             for key, (offset, length) in header['blobs'].items()}
+    return mapped, header['meta'], blobs
+
+
+def acquire_build_lock(name):
+    """Take the per-segment build lock without blocking the event loop"""
+    lock_file = open(os.path.join(SHARED_ASSETS_DIR, f'.{SEGMENT_PREFIX}-{name}.lock'), 'a')
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except BlockingIOError:
+            time.sleep(0.05)
+
+
+def remove_stale_segments(name, keep_path):
+    """Unlink older segments of the same name - workers still mapping them keep their pages"""
+    prefix = f'{SEGMENT_PREFIX}-{name}-'
+    for entry in os.listdir(SHARED_ASSETS_DIR):
+        stale_path = os.path.join(SHARED_ASSETS_DIR, entry)
+        if entry.startswith(prefix) and stale_path != keep_path:
+            try:
+                os.unlink(stale_path)
+            except OSError:
+                pass
+
+
+def load_shared_segment(name, fingerprint, build):
+    """
+    Map the segment for name and fingerprint, building it first if no process has yet.
+
+    Args:
+        name: Segment name, e.g. 'static'
+        fingerprint: Identifies the source data, see fingerprint_tree()
+        build: Function returning (meta, blobs) - JSON-serializable metadata
+            and a dict of key -> bytes. Only called by the first process.
+
+    Returns:
+        (meta, {key: memoryview}), or None when shared segments are disabled
+        or unavailable, in which case the caller keeps a private copy.
+    """
+    if not SHARED_ASSETS_ENABLED:
+        return None
+
+    path = segment_path(name, fingerprint)
+    built = False
+    try:
+        if not os.path.exists(path):
+            lock_file = acquire_build_lock(name)
+            try:
+                # Another worker may have built it while we waited for the lock
+                if not os.path.exists(path):
+                    meta, blobs = build()
+                    write_segment(path, meta, blobs)
+                    remove_stale_segments(name, path)
+                    built = True
+            finally:
+                lock_file.close()
+        mapped, meta, blobs = map_segment(path)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Shared segment {name} unavailable, using private memory: {str(e)}")
+        return None
+
+    with shared_segments_lock:
+        # Views handed out earlier keep a replaced mapping alive until they are dropped
+        shared_segments[name] = {
+            'path': path,
+            'mmap': mapped,
+            'bytes': len(mapped),
+            'entries': len(blobs),
+            'built': built
+        }
+    return meta, blobs
+
+
+def get_shared_segment_stats():
+    """Mapped segments for health reporting"""
+    with shared_segments_lock:
+        segments = {name: {'bytes': segment['bytes'], 'entries': segment['entries'], 'built': segment['built']}
+                    for name, segment in shared_segments.items()}
+    return {
+        'enabled': SHARED_ASSETS_ENABLED,
+        'directory': SHARED_ASSETS_DIR,
+        'segments': segments
+    }
@@ -0,0 +1,284 @@
+"""
+Precompressed static asset store.
+
+Static files never change at runtime, so text assets are compressed once at
+startup into gzip and brotli variants and kept in memory. Requests pick a
+variant from Accept-Encoding without spending any CPU on compression. The
+store is built once per deployment and shared read-only between workers
+through shared_assets, falling back to a private copy when that is unavailable.
+"""
+
+import os
+import gzip
+import time
+import hashlib
+import mimetypes
+import threading
+from flask import Response, request
+from cache_registry import register_cache
+from shared_assets import load_shared_segment, fingerprint_tree
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = 'static'
+STATIC_ASSET_STORE_MAX_BYTES = int(os.environ.get('STATIC_ASSET_STORE_MAX_BYTES', 16 * 1024 * 1024))
+STATIC_ASSET_MAX_FILE_BYTES = 2 * 1024 * 1024  # Larger files are served from disk
+STATIC_ASSET_MAX_AGE = 86400  # Cache static files for 1 day
+STATIC_ASSET_BLOCK_SIZE = 64 * 1024  # Body blocks for servers that only write bytes
+
+# Content types used by serve_static() before the store existed
+STATIC_CONTENT_TYPES = {
+    '.js': 'application/javascript',
+    '.css': 'text/css',
+    '.html': 'text/html'
+}
+
+# Only text-like assets benefit from compression
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+
+# Relative path -> asset dict with the identity body and its compressed variants.
+# Variants are bytes, or memoryviews into the shared segment for 'shared' assets.
+static_asset_store = {}
+static_asset_store_bytes = 0
+static_asset_store_shared_bytes = 0
+static_asset_store_lock = threading.Lock()
+
+
+def guess_content_type(path):
+    """Content type for a static file, or None if unknown"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in STATIC_CONTENT_TYPES:
+        return STATIC_CONTENT_TYPES[extension]
+    return mimetypes.guess_type(path)[0]
+
+
+def compress_variants(body):
+    """Compress a body with every available encoding, keeping only variants that are smaller"""
+    variants = {}
+    gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+    if len(gzipped) < len(body):
+        variants['gzip'] = gzipped
+    if brotli is not None:
+        compressed = brotli.compress(body, quality=11)
+        if len(compressed) < len(body):
+            variants['br'] = compressed
+    return variants
+
+
+def load_static_asset(static_dir, relative_path):
+    """Read and precompress one static file, or return None if it should stay on disk"""
+    file_path = os.path.join(static_dir, relative_path)
+    content_type = guess_content_type(relative_path)
+    if not content_type or not content_type.startswith(COMPRESSIBLE_TYPES):
+        return None
+
+    stat = os.stat(file_path)
+    if stat.st_size > STATIC_ASSET_MAX_FILE_BYTES:
+        return None
+
+    with open(file_path, 'rb') as f:
+        body = f.read()
+
+    digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+    variants = compress_variants(body)
+    variants['identity'] = body
+
+    return {
+        'content_type': content_type,
+        'variants': variants,
+        # Each encoding is its own representation, so each gets its own strong ETag
+        'etags': {encoding: f'"{digest}"' if encoding == 'identity' else f'"{digest}:{encoding}"'
+                  for encoding in variants},
+        'last_modified': stat.st_mtime,
+        'size': sum(len(data) for data in variants.values())
+    }
+
+
+def collect_static_assets(static_dir):
+    """Precompress static assets, smallest first, until the byte budget is used. Returns (store, skipped)."""
+    candidates = []
+    for root, _, files in os.walk(static_dir):
+        for name in files:
+            file_path = os.path.join(root, name)
+            try:
+                candidates.append((os.path.getsize(file_path), os.path.relpath(file_path, static_dir)))
+            except OSError:
+                continue
+    candidates.sort()
+
+    store = {}
+    store_bytes = 0
+    skipped = 0
+    for _, relative_path in candidates:
+        try:
+            asset = load_static_asset(static_dir, relative_path)
+        except OSError as e:
+            print(f"Warning: Could not precompress static asset {relative_path}: {str(e)}")
+            continue
+        if asset is None:
+            continue
+        if store_bytes + asset['size'] > STATIC_ASSET_STORE_MAX_BYTES:
+            skipped += 1
+            continue
+        store[relative_path.replace(os.sep, '/')] = asset
+        store_bytes += asset['size']
+    return store, skipped
+
+
+def pack_static_assets(store, skipped):
+    """Split a store into segment metadata and blobs keyed by path and encoding"""
+    meta = {'skipped': skipped, 'assets': {}}
+    blobs = {}
+    for key, asset in store.items():
+        meta['assets'][key] = {name: value for name, value in asset.items() if name != 'variants'}
+        for encoding, data in asset['variants'].items():
+            blobs[f'{key}\0{encoding}'] = data
+    return meta, blobs
+
+
+def unpack_static_assets(meta, blobs):
+    """Rebuild a store whose variants are views into the shared segment"""
+    store = {}
+    for key, asset in meta['assets'].items():
+        store[key] = dict(asset, shared=True,
+                          variants={encoding: blobs[f'{key}\0{encoding}'] for encoding in asset['etags']})
+    return store, meta['skipped']
+
+
+def build_static_asset_store(static_dir=STATIC_DIR):
+    """Load the precompressed store from the shared segment, building it if this is the first worker"""
+    global static_asset_store_bytes, static_asset_store_shared_bytes
+    start_time = time.time()
+
+    # Budget and brotli availability change the store's contents, not just the files
+    fingerprint = fingerprint_tree(static_dir, f'{STATIC_ASSET_STORE_MAX_BYTES}:{brotli is not None}')
+    shared = load_shared_segment('static', fingerprint,
+                                 lambda: pack_static_assets(*collect_static_assets(static_dir)))
+    if shared is not None:
+        store, skipped = unpack_static_assets(*shared)
+    else:
+        store, skipped = collect_static_assets(static_dir)
+    store_bytes = sum(asset['size'] for asset in store.values())
+
+    with static_asset_store_lock:
+        static_asset_store.clear()
+        static_asset_store.update(store)
+        static_asset_store_bytes = store_bytes
+        static_asset_store_shared_bytes = store_bytes if shared is not None else 0
+
+    encodings = 'gzip, br' if brotli is not None else 'gzip (brotli not installed)'
+    location = 'shared' if shared is not None else 'private'
+    print(f"Loaded {len(store)} precompressed static assets ({store_bytes / 1024:.1f} KB {location}, {encodings}) "
+          f"in {time.time() - start_time:.3f} seconds, {skipped} skipped over budget")
+    return len(store)
+
+
+def refresh_static_asset(relative_path, static_dir=STATIC_DIR):
+    """Reload one asset after it changed on disk, or drop it if it is gone or no longer fits.
+    
+    The reloaded copy is private to this worker - the shared segment is
+    rebuilt with a new fingerprint on the next deploy.
+    """
+    global static_asset_store_bytes, static_asset_store_shared_bytes
+    key = relative_path.replace(os.sep, '/')
+    try:
+        asset = load_static_asset(static_dir, relative_path)
+    except OSError:
+        asset = None
+
+    with static_asset_store_lock:
+        previous = static_asset_store.pop(key, None)
+        if previous is not None:
+            static_asset_store_bytes -= previous['size']
+            if previous.get('shared'):
+                static_asset_store_shared_bytes -= previous['size']
+        if asset is not None and static_asset_store_bytes + asset['size'] <= STATIC_ASSET_STORE_MAX_BYTES:
+            static_asset_store[key] = asset
+            static_asset_store_bytes += asset['size']
+
+
+def private_static_asset_bytes():
+    """Bytes of the store held in this worker's heap rather than the shared segment"""
+    return static_asset_store_bytes - static_asset_store_shared_bytes
+
+
+def trim_static_asset_store(target_bytes):
+    """Drop the largest private assets until they use at most target_bytes - they are then served from disk.
+    
+    Shared assets are left alone, since dropping them frees no memory.
+    """
+    global static_asset_store_bytes
+    with static_asset_store_lock:
+        before = static_asset_store_bytes
+        private = [key for key, asset in static_asset_store.items() if not asset.get('shared')]
+        for key in sorted(private, key=lambda k: static_asset_store[k]['size'], reverse=True):
+            if private_static_asset_bytes() <= target_bytes:
+                break
+            static_asset_store_bytes -= static_asset_store.pop(key)['size']
+        return before - static_asset_store_bytes
+
+
+register_cache('static_asset_store', private_static_asset_bytes, lambda: len(static_asset_store),
+               trim_static_asset_store)
+
+
+def choose_encoding(asset):
+    """Pick the best available variant for the request's Accept-Encoding"""
+    available = [encoding for encoding in ('br', 'gzip') if encoding in asset['variants']]
+    if not available:
+        return 'identity'
+    return request.accept_encodings.best_match(available, default='identity')
+
+
+def asset_body(variant):
+    """Response body for a variant that does not copy a shared (mmap'd) variant into the heap.
+
+    eventlet's server writes buffers as they are. Servers that only accept
+    bytes (gunicorn, werkzeug) get the variant in blocks, so a response holds
+    at most one block of it.
+    """
+    if isinstance(variant, bytes) or 'eventlet.posthooks' in request.environ:
+        return [variant]
+    return (bytes(variant[offset:offset + STATIC_ASSET_BLOCK_SIZE])
+            for offset in range(0, len(variant), STATIC_ASSET_BLOCK_SIZE))
+
+
+def get_static_asset_response(path):
+    """Serve a precompressed asset, or return None if the path is not in the store"""
+    asset = static_asset_store.get(path)
+    if asset is None:
+        return None
+
+    encoding = choose_encoding(asset)
+    etag = asset['etags'][encoding]
+
+    if_none_match = request.headers.get('If-None-Match', '')
+    candidates = {candidate.strip().replace('W/', '', 1) for candidate in if_none_match.split(',')}
+    if etag in candidates or '*' in candidates:
+        response = Response(status=304)
+    else:
+        variant = asset['variants'][encoding]
+        response = Response(asset_body(variant), content_type=asset['content_type'])
+        response.content_length = len(variant)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+
+    response.headers['ETag'] = etag
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = f'public, max-age={STATIC_ASSET_MAX_AGE}'
+    response.last_modified = asset['last_modified']
+    response.headers['X-Cache'] = 'PRECOMPRESSED'
+    return response
+
+
+def get_static_asset_stats():
+    """Size of the store for health reporting"""
+    return {
+        'assets': len(static_asset_store),
+        'bytes': static_asset_store_bytes,
+        'sharedBytes': static_asset_store_shared_bytes,
+        'brotli': brotli is not None
+    }
@@ -0,0 +1,171 @@
+"""
+Deferred deletion of directory trees.
+
+Removing a large tree (node_modules, a virtualenv) inline takes seconds of
+unlink calls, and under eventlet every other session's output stalls while
+it runs. Instead the tree is renamed into a per-session trash directory next
+to the home - a single atomic rename on the same filesystem - and a
+background reaper deletes it afterwards at a limited rate, yielding between
+batches. Trash lives outside the home, so listings, search and archives never
+see trashed entries and the space leaves the session's quota right away.
+"""
+
+import os
+import time
+import uuid
+import errno
+import shutil
+import threading
+from collections import OrderedDict
+
+TRASH_DIR_NAME = '.trash'
+TRASH_REAP_RATE = int(os.environ.get('TRASH_REAP_RATE', 5000))  # Entries deleted per second
+TRASH_REAP_BATCH = 100  # Entries between pauses while reaping
+
+# Trashed path -> time it was queued, oldest first
+trash_pending = OrderedDict()
+trash_lock = threading.Lock()
+trash_available = threading.Event()
+trash_state = {
+    'started': False,
+    'reaped': 0,
+    'entries': 0,
+    'errors': 0,
+    'fallbacks': 0
+}
+
+
+def trash_dir_for(home_dir):
+    """Trash directory of a session home: a sibling of the home, so renames stay on one filesystem"""
+    home = os.path.normpath(home_dir)
+    return os.path.join(os.path.dirname(home), TRASH_DIR_NAME, os.path.basename(home))
+
+
+def queue_for_reaping(trash_path):
+    with trash_lock:
+        trash_pending[trash_path] = time.time()
+    trash_available.set()
+
+
+def move_to_trash(home_dir, target_path):
+    """Rename a path into the session's trash. Returns False if it is on another filesystem."""
+    trash_dir = trash_dir_for(home_dir)
+    trash_path = os.path.join(trash_dir, uuid.uuid4().hex)
+    # Under the lock, so the reaper cannot remove the trash directory between the two calls
+    with trash_lock:
+        os.makedirs(trash_dir, exist_ok=True)
+        try:
+            os.rename(target_path, trash_path)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                return False
+            raise
+    queue_for_reaping(trash_path)
+    return True
+
+
+def remove_tree(home_dir, target_path):
+    """Delete a directory tree without waiting for it, falling back to rmtree across filesystems"""
+    if not move_to_trash(home_dir, target_path):
+        trash_state['fallbacks'] += 1
+        shutil.rmtree(target_path)
+
+
+def reap_path(trash_path):
+    """Delete one trashed tree bottom-up, throttled to TRASH_REAP_RATE entries per second"""
+    removed = 0
+    batch_start = time.time()
+
+    def remove(path, remove_function):
+        nonlocal removed, batch_start
+        try:
+            remove_function(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            trash_state['errors'] += 1
+        removed += 1
+        trash_state['entries'] += 1
+        if removed % TRASH_REAP_BATCH == 0:
+            pause = TRASH_REAP_BATCH / TRASH_REAP_RATE - (time.time() - batch_start)
+            time.sleep(max(0, pause))
+            batch_start = time.time()
+
+    if os.path.isdir(trash_path) and not os.path.islink(trash_path):
+        for dir_path, dir_names, file_names in os.walk(trash_path, topdown=False):
+            for name in file_names:
+                remove(os.path.join(dir_path, name), os.unlink)
+            for name in dir_names:
+                path = os.path.join(dir_path, name)
+                # Symlinks to directories are listed with directories but are not followed
+                remove(path, os.unlink if os.path.islink(path) else os.rmdir)
+        remove(trash_path, os.rmdir)
+    else:
+        remove(trash_path, os.unlink)
+
+    # Drop the session's trash directory once it is empty
+    with trash_lock:
+        try:
+            os.rmdir(os.path.dirname(trash_path))
+        except OSError:
+            pass
+
+
+def run_trash_reaper():
+    """Reaper thread main loop"""
+    while True:
+        trash_available.wait()
+        with trash_lock:
+            if not trash_pending:
+                trash_available.clear()
+                continue
+            trash_path = next(iter(trash_pending))
+        try:
+            reap_path(trash_path)
+        except Exception as e:
+            print(f"Trash reaper error for {trash_path}: {str(e)}")
+            trash_state['errors'] += 1
+        with trash_lock:
+            trash_pending.pop(trash_path, None)
+        trash_state['reaped'] += 1
+
+
+def start_trash_reaper(data_dir='user_data'):
+    """Start the reaper thread once, queueing anything left in the trash by an earlier run"""
+    with trash_lock:
+        if trash_state['started']:
+            return
+        trash_state['started'] = True
+
+    trash_root = os.path.join(data_dir, TRASH_DIR_NAME)
+    try:
+        session_dirs = os.listdir(trash_root)
+    except FileNotFoundError:
+        session_dirs = []
+    leftovers = 0
+    for session_dir in session_dirs:
+        try:
+            names = os.listdir(os.path.join(trash_root, session_dir))
+        except OSError:
+            continue
+        for name in names:
+            queue_for_reaping(os.path.join(trash_root, session_dir, name))
+            leftovers += 1
+
+    threading.Thread(target=run_trash_reaper, daemon=True).start()
+    print(f"Trash reaper started with {leftovers} leftover trees")
+
+
+def get_trash_stats():
+    """Reaper backlog for health reporting"""
+    with trash_lock:
+        pending = len(trash_pending)
+        oldest = next(iter(trash_pending.values()), None)
+    return {
+        'pending': pending,
+        'oldestSeconds': round(time.time() - oldest, 1) if oldest is not None else None,
+        'reaped': trash_state['reaped'],
+        'entriesRemoved': trash_state['entries'],
+        'errors': trash_state['errors'],
+        'fallbacks': trash_state['fallbacks']
+    }